@@ -1,15 +1,137 @@
 
+import multiprocessing
+import threading
 from apphost.protocols import app_controller_server
-from apphost.base import app_exec
+from apphost.base import app_exec, local_log
+
+
+class CoreAllocator(object):
+
+    """
+        CoreAllocator hands out CPU cores to the applications hosted
+        on this machine.  Latency-sensitive applications are given
+        dedicated cores which no other hosted application may run on.
+        All other applications share whatever cores are not dedicated.
+        The reserved cores are left for the host itself (agents,
+        discovery, event sockets) and are never handed out.
+
+        When a dedicated allocation shrinks the shared pool, the
+        applications already running on the shared pool are re-pinned
+        through their repin_cback.  The callbacks are called after the
+        allocator lock is released, as re-pinning spawns a process.
+        Each set of repins is stamped with a generation and the repins
+        are serialized by a second lock, so a set computed before the
+        one last applied is stale and skipped.
+    """
+
+    def __init__(self, nr_cores=None, reserved=[0]):
+        if nr_cores is None:
+            nr_cores = multiprocessing.cpu_count()
+
+        self.lock = threading.Lock()
+        self.repin_lock = threading.Lock()
+        # Generation of the last repins computed, and applied
+        self.generation = 0
+        self.repinned = 0
+        self.cores = [core for core in range(nr_cores)
+                        if core not in reserved]
+        if len(self.cores) == 0:
+            # Single core machine.  Nothing can be reserved.
+            self.cores = range(nr_cores)
+        self.dedicated = {}
+        self.shared = {}
+
+    def allocate(self, owner, latency_sensitive, nr_cores=1,
+                 repin_cback=None):
+        repins = None
+        self.lock.acquire()
+        try:
+            assert(owner not in self.dedicated)
+            assert(owner not in self.shared)
+
+            cores = None
+            if latency_sensitive is True:
+                free = self.__shared_pool()
+                # Always leave at least one core for the shared pool.
+                if len(free) > nr_cores:
+                    # Hand out cores from the top end of the pool so
+                    # the low cores stay with the host and shared apps.
+                    cores = free[-nr_cores:]
+                    self.dedicated[owner] = cores
+                    repins = self.__repins()
+                    cores = cores[:]
+                else:
+                    local_log.Llog.LogInfo("No free cores to dedicate to "
+                                           + str(owner)
+                                           + ", using the shared pool.")
+
+            if cores is None:
+                self.shared[owner] = repin_cback
+                cores = self.__shared_pool()
+        finally:
+            self.lock.release()
+        self.__repin(repins)
+        return cores
+
+    def release(self, owner):
+        repins = None
+        self.lock.acquire()
+        try:
+            if owner in self.dedicated:
+                del self.dedicated[owner]
+                repins = self.__repins()
+            elif owner in self.shared:
+                del self.shared[owner]
+        finally:
+            self.lock.release()
+        self.__repin(repins)
+
+    def __shared_pool(self):
+        dedicated = []
+        for cores in self.dedicated.values():
+            dedicated += cores
+        return [core for core in self.cores if core not in dedicated]
+
+    def __repins(self):
+        # The generation and (repin_cback, cores) of the shared
+        # applications.  Called with the lock held.
+        self.generation += 1
+        cores = self.__shared_pool()
+        return (self.generation,
+                [(repin_cback, cores[:])
+                 for repin_cback in self.shared.values()
+                 if repin_cback is not None])
+
+    def __repin(self, repins):
+        if repins is None:
+            return
+        generation, cbacks = repins
+        self.repin_lock.acquire()
+        try:
+            if generation < self.repinned:
+                # A later set has already been applied
+                return
+            self.repinned = generation
+            for repin_cback, cores in cbacks:
+                repin_cback(cores)
+        finally:
+            self.repin_lock.release()
 
 
 class AppHostAgent(object):
 
+    # One allocator per host, shared by every agent in this process.
+    core_allocator = CoreAllocator()
+
     def AppHostAgentFactory(user_name):
         return AppHostAgent(user_name)
 
-    def __init__(self, user_name):
+    def __init__(self, user_name, latency_sensitive=False, profile=None):
         self.user_name = user_name
+        self.latency_sensitive = latency_sensitive
+        if profile is None:
+            profile = app_exec.ResourceProfile()
+        self.profile = profile
         self.acs = app_controller_server.AppControlServer(self.user_name,
                                                           self.__acs_event_cback)
         self.app = None
@@ -23,6 +145,7 @@ class AppHostAgent(object):
         if event_name == "STDERR":
             self.acs.event("STDERR", event_args)
         if event_name == "FINISHED":
+            self.core_allocator.release(self)
             self.acs.finished(event_args[0])
 
     def __acs_event_cback(self, event_name, event_args=[]):
@@ -41,7 +164,14 @@ class AppHostAgent(object):
         if event_name == "RUN":
             assert(self.app is not None)
             command = event_args[0]
-            self.app.run([command])
+            cpus = self.core_allocator.allocate(self,
+                                                self.latency_sensitive,
+                                                1,
+                                                self.app.set_cpu_affinity)
+            if self.app.run([command], self.profile.copy(cpus)) is False:
+                # No FINISHED event will follow to release the cores.
+                self.core_allocator.release(self)
+                self.acs.finished(-1)
         if event_name == "STOP":
             assert(self.app is not None)
             self.app.stop()
@@ -0,0 +1,25 @@
+import sys
+import time
+sys.path.append("../base")
+import event_broker
+import local_log
+
+if __name__ == '__main__':
+
+    local_log.Llog.SetLevel("I")
+
+    # Optional argument: seconds between statistics reports
+    period = 10
+    if len(sys.argv) >= 2:
+        period = int(sys.argv[1])
+
+    broker = event_broker.EventBroker()
+
+    while True:
+        time.sleep(period)
+        rates = broker.get_rates()
+        print " ".join(["sources:", str(rates['sources']),
+                        "msgs/s:", "%.1f" % rates['msgs_per_sec'],
+                        "bytes/s:", "%.1f" % rates['bytes_per_sec'],
+                        "queue depth:", str(rates['queue_depth']),
+                        "max:", str(rates['max_queue_depth'])])
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+sys.path.append("../base")
+import event_collector
+import event_store
+import local_log
+
+
+class EventStoreAgent():
+
+    """
+        Collects every event matching the user name and writes it to an
+        EventStore.  Expired events are compacted away once an hour.
+    """
+
+    compact_period = 3600
+
+    def __init__(self, store_dir, user_name="", retention_days=7):
+        self.store = event_store.EventStore(store_dir)
+        self.retention = retention_days * 24 * 3600
+        self.last_compact = time.time()
+        # The sources are cached next to the store, so a restarted
+        # agent reconnects to them without waiting for their beacons.
+        # An agent storing every user's events has nothing to lose by
+        # taking them from the broker.
+        self.collector = event_collector.EventCollector(
+                            ["*"],
+                            self.event_cback,
+                            user_name,
+                            use_broker=(user_name == ""),
+                            discovery_cache=os.path.join(store_dir,
+                                                         "discovery.cache"))
+
+    def event_cback(self, event):
+        self.store.append(event)
+
+    def run(self):
+        while True:
+            time.sleep(1)
+            self.store.flush()
+            if time.time() - self.last_compact > self.compact_period:
+                self.last_compact = time.time()
+                min_timestamp_ns = int((time.time() - self.retention)
+                                       * 1000000000)
+                removed = self.store.compact(min_timestamp_ns)
+                local_log.Llog.LogInfo("Compacted " + str(removed)
+                                       + " segments")
+
+
+if __name__ == '__main__':
+
+    local_log.Llog.SetLevel("I")
+
+    store_dir = "events"
+    if len(sys.argv) >= 2:
+        store_dir = sys.argv[1]
+
+    user_name = ""
+    if len(sys.argv) >= 3:
+        # Caller specified username argument
+        user_name = sys.argv[2]
+
+    agent = EventStoreAgent(store_dir, user_name)
+    agent.run()
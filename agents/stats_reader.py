@@ -0,0 +1,34 @@
+import fnmatch
+import sys
+import time
+sys.path.append("../base")
+import stats_page
+
+# Print the stats pages of every apphost process on this host.
+#
+#   stats_reader.py [pattern] [period]
+#
+# pattern - only the counters matching this shell pattern, e.g.
+#           "zsocket.*.rx_ok".  Defaults to every counter.
+# period  - repeat every period seconds.  Defaults to printing once.
+
+if __name__ == '__main__':
+
+    pattern = "*"
+    if len(sys.argv) >= 2:
+        pattern = sys.argv[1]
+    period = None
+    if len(sys.argv) >= 3:
+        period = float(sys.argv[2])
+
+    while True:
+        for page in stats_page.read_all():
+            print str(page['pid']) + " " + page['process']
+            for name in sorted(page['values'].keys()):
+                if fnmatch.fnmatch(name, pattern):
+                    print "   " + name + " " + "%g" % page['values'][name]
+            if page['dropped'] > 0:
+                print "   (" + str(page['dropped']) + " counters dropped)"
+        if period is None:
+            break
+        time.sleep(period)
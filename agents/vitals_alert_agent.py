@@ -0,0 +1,61 @@
+import sys
+import time
+sys.path.append("../base")
+import local_log
+import system
+import vital_alerts
+
+# Check the vitals of every application against a file of rules, one
+# per line, and send the alerts as ALERT events (see vital_alerts.py):
+#
+#   vitals_alert_agent.py <rules file> [user name]
+#
+# e.g.
+#
+#   # <rule name> <pattern> <condition>
+#   hot         temperature     value > 80
+#   failing     requests_failed rate > 10/min
+#   quiet       heartbeat       absent 30s
+
+
+def read_rules(path):
+    rules = []
+    for line in open(path):
+        line = line.split("#")[0].strip()
+        if line != "":
+            rules.append(vital_alerts.AlertRule.Parse(line))
+    return rules
+
+
+class VitalsAlertAgent():
+
+    def __init__(self, rules, user_name=""):
+        system.System.Init("sysadmin", "vitals", "alert_agent")
+        self.alerter = vital_alerts.AlertCollector(rules,
+                                                   self.alert_cback,
+                                                   user_name)
+
+    def alert_cback(self, alert):
+        print alert['timestamp'] + " " + " ".join([alert['name']]
+                                                  + alert['contents'])
+
+    def run(self):
+        while True:
+            time.sleep(1)
+
+
+if __name__ == '__main__':
+
+    local_log.Llog.SetLevel("I")
+
+    if len(sys.argv) < 2:
+        print "usage: vitals_alert_agent.py <rules file> [user name]"
+        sys.exit(1)
+    rules = read_rules(sys.argv[1])
+
+    user_name = ""
+    if len(sys.argv) >= 3:
+        user_name = sys.argv[2]
+
+    agent = VitalsAlertAgent(rules, user_name)
+    agent.run()
@@ -4,8 +4,97 @@ import zmq
 import threading
 import select
 import os
+import time
 import types
+import resource
 from apphost.base import interface, zsocket, log, override
+from apphost.base import event_source, system, shm_ring
+from apphost.base.timestamp import Timestamp
+
+
+class ResourceProfile(object):
+
+    """
+        ResourceProfile describes the resources a hosted application
+        is allowed to consume.  The profile is applied to the child
+        process between fork() and exec(), so the limits are in place
+        before the application executes its first instruction.
+
+        cpus         - list of CPU core numbers the application is
+                       pinned to.  An empty list means no pinning.
+        nice         - nice level increment for the application.
+        max_memory   - address space limit (RLIMIT_AS), in bytes.
+        max_cpu_time - CPU time limit (RLIMIT_CPU), in seconds.
+        cgroup       - optional cgroup v2 path, relative to cgroup_root,
+                       the application is placed in.
+    """
+    cgroup_root = "/sys/fs/cgroup"
+
+    def __init__(self, cpus=[], nice=0, max_memory=0, max_cpu_time=0,
+                 cgroup=""):
+        assert(isinstance(cpus, types.ListType))
+        assert(nice >= 0)
+        assert(max_memory >= 0)
+        assert(max_cpu_time >= 0)
+
+        self.cpus = cpus[:]
+        self.nice = nice
+        self.max_memory = max_memory
+        self.max_cpu_time = max_cpu_time
+        self.cgroup = cgroup
+
+    def copy(self, cpus=None):
+        # Profiles handed to the AppHostAgent act as templates.  The
+        # CPU set is filled in per-application at run time.
+        if cpus is None:
+            cpus = self.cpus
+        return ResourceProfile(cpus,
+                               self.nice,
+                               self.max_memory,
+                               self.max_cpu_time,
+                               self.cgroup)
+
+    def wrap_cmdline(self, cmdline):
+        # Python 2 has no sched_setaffinity(), so CPU pinning is done
+        # by launching the application through taskset.
+        if len(self.cpus) == 0:
+            return cmdline
+        return ['taskset', '-c', self.cpu_list()] + cmdline
+
+    def cpu_list(self):
+        return ",".join([str(cpu) for cpu in self.cpus])
+
+    def apply(self):
+        # Called in the child process, just before exec().
+        # Any exception raised here is re-raised by Popen in the parent:
+        # OSError from nice()/makedirs(), IOError from the cgroup write
+        # and ValueError from setrlimit().
+        if self.nice > 0:
+            os.nice(self.nice)
+
+        if self.max_memory > 0:
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (self.max_memory, self.max_memory))
+
+        if self.max_cpu_time > 0:
+            # Give the application a SIGXCPU warning at the soft limit
+            # before the hard limit kills it.
+            resource.setrlimit(resource.RLIMIT_CPU,
+                               (self.max_cpu_time, self.max_cpu_time + 1))
+
+        if self.cgroup != "":
+            cgroup_dir = os.path.join(self.cgroup_root, self.cgroup)
+            if not os.path.isdir(cgroup_dir):
+                os.makedirs(cgroup_dir)
+            with open(os.path.join(cgroup_dir, "cgroup.procs"), "w") as f:
+                f.write(str(os.getpid()))
+
+    def __str__(self):
+        return " ".join(["cpus=" + self.cpu_list(),
+                         "nice=" + str(self.nice),
+                         "max_memory=" + str(self.max_memory),
+                         "max_cpu_time=" + str(self.max_cpu_time),
+                         "cgroup=" + self.cgroup])
 
 
 class AppExec(log.Logger):
@@ -27,6 +116,7 @@ class AppExec(log.Logger):
         self.cwd = "."
         self.proc = None
         self.child_env = []
+        self.profile = None
         self.return_code = -1
         self.alive = False
 
@@ -60,16 +150,26 @@ class AppExec(log.Logger):
         self.__send_output_event("STDOUT", msg)
 
     def __send_output_event(self, event_type, output_string):
-        timestamp = time.strftime("%x-%X")
+        timestamp = Timestamp.NowText()
         self.event_cback(event_type, [timestamp, "string", ])
 
     def __process_stderr(self, msg):
         self.event_cback("STDERR", [msg])
 
-    def run(self, cmdline):
+    def run(self, cmdline, profile=None):
+        # Returns False if the application could not be started, in
+        # which case no FINISHED event follows.
         assert(isinstance(cmdline, types.ListType))
         assert(self.proc is None)
 
+        preexec_fn = None
+        if profile is not None:
+            assert(isinstance(profile, ResourceProfile))
+            self.log_info("Resource profile: " + str(profile))
+            cmdline = profile.wrap_cmdline(cmdline)
+            preexec_fn = profile.apply
+        self.profile = profile
+
         self.log_info("Executing: " + " ".join(cmdline))
 
         try:
@@ -80,10 +180,12 @@ class AppExec(log.Logger):
                                          #stderr=None,
                                          cwd=self.cwd,
                                          #env=self.child_env)
-                                         env=None)
-        except OSError, ex:
-            print os.strerror(ex.errno)
-            return
+                                         env=None,
+                                         preexec_fn=preexec_fn)
+        except (OSError, IOError, ValueError), ex:
+            # Either the exec failed or the profile could not be applied
+            self.log_error("Cannot execute " + cmdline[0] + ": " + str(ex))
+            return False
 
         assert(self.proc is not None)
         self.pid = self.proc.pid
@@ -91,10 +193,36 @@ class AppExec(log.Logger):
 
         # Start our thread which monitors stdout/stderr of our app.
         self.thread.start()
+        return True
 
     def is_running(self):
         return self.alive
 
+    def set_cpu_affinity(self, cpus):
+        # Re-pin a running application, including all of its threads.
+        assert(isinstance(cpus, types.ListType))
+        if self.proc is None or self.alive is False:
+            return False
+
+        cpu_list = ",".join([str(cpu) for cpu in cpus])
+        try:
+            with open(os.devnull, "w") as devnull:
+                rc = subprocess.call(['taskset', '-a', '-p', '-c',
+                                      cpu_list, str(self.pid)],
+                                     stdout=devnull)
+        except OSError, ex:
+            self.log_error("Cannot set CPU affinity: "
+                           + os.strerror(ex.errno))
+            return False
+
+        if rc != 0:
+            self.log_error("taskset failed (" + str(rc) + ")")
+            return False
+
+        if self.profile is not None:
+            self.profile.cpus = cpus[:]
+        return True
+
     def kill(self):
         if self.proc is not None:
             self.proc.kill()
@@ -114,13 +242,13 @@ class JavaAppExec(AppExec):
         self.classpath = ":".join([jarfile] + self.system_jars)
 
     @override.overrides(AppExec)
-    def run(self, cmd_args):
+    def run(self, cmd_args, profile=None):
         assert(isinstance(cmd_args, types.ListType))
         cmdline = ['java', '-classpath', self.classpath] + cmd_args
-        AppExec.run(self, cmdline)
+        return AppExec.run(self, cmdline, profile)
 
 
-class AppEventProxy(object):
+class AppEventProxy(log.Logger):
 
     """
         In order to try to limit the ability of the java application
@@ -130,16 +258,71 @@ class AppEventProxy(object):
         We create a PULL socket server here and receive all events.
         Once received, we verify the sanity of the event message and
         re-send it out a real EventSource socket.
+
+        The Java EventSource sends unframed, space separated messages:
+
+        <event type> <event name> <timestamp> <user_name> <app name> [contents]
+
+        Events are drained from the PULL socket in batches and checked
+        against the user's SLA (see System.GetSLA()):
+            max_event_types - number of distinct event type/name pairs
+                              the application may publish.
+            max_tx_events_per_minute - enforced by the user's token
+                              bucket in the EventSocket (see
+                              rate_limit.py), shared by all the
+                              applications of the user.
+        Events failing either check, or which are malformed, are dropped
+        (or, with the coalesce overflow policy, held) and counted apart:
+        drop_malformed, drop_event_types (over max_event_types) and
+        drop_rate_limited (over the rate, or held).
+        Accepted events are republished through the shared EventSocket
+        for this user/app, which stamps the sequence numbers.
+
+        If ring_dir is given, the proxy also creates a shared memory ring
+        (see shm_ring.py) in that directory, normally the application's
+        working directory.  Numeric ticks written to the ring are
+        published as NUMERIC events, subject to the same checks.
     """
+    batch_size = 256
+    ring_capacity = 65536
+    # Longest wait of the ring thread before it checks for close()
+    ring_wait = 0.1
+
+    class Stats():
+        def __init__(self):
+            self.rx_events = 0
+            self.rx_batches = 0
+            self.tx_events = 0
+            self.drop_malformed = 0
+            self.drop_event_types = 0
+            self.drop_rate_limited = 0
+            self.rx_ring_events = 0
+
+    def __init__(self, user_name, application_name, ring_dir=None,
+                 overflow_policy=None):
+        log.Logger.__init__(self)
 
-    def __init__(self, user_name, application_name):
         self.user_name = user_name
         self.application_name = application_name
-        self.events = []
+        self.stats = AppEventProxy.Stats()
+        self.sla = system.System.GetSLA()
+        self.event_types = set()
+        self.last_rate_time = time.time()
+        self.last_rate_events = 0
+        # The quota state is shared by the interface and ring threads
+        self.lock = threading.Lock()
+
+        self.socket = event_source.EventSource.GetSocket(user_name,
+                                                         application_name)
+        assert(self.socket is not None)
+        if overflow_policy is not None:
+            self.socket.set_overflow_policy(overflow_policy)
+
         self.zsocket = zsocket.ZSocketServer(zmq.PULL,
                                              "ipc",
                                              ":".join([user_name,
-                                                      application_name]))
+                                                      application_name]),
+                                             "EVENT")
         """
         port_range = [6556,6557]
         self.zsocket = zsocket.ZSocketServer(zmq.PULL,
@@ -148,15 +331,129 @@ class AppEventProxy(object):
         """
         assert(self.zsocket is not None)
         self.zsocket.bind()
+        self.zsocket.set_framing(False)
 
         self.interface = interface.Interface(self.process_app_msgs)
         self.interface.add_socket(self.zsocket)
 
-    def process_app_msgs(self, event_msg):
-        self.log_info("RX: " + event_msg)
+        self.ring = None
+        self.alive = True
+        if ring_dir is not None:
+            ring_path = os.path.join(ring_dir,
+                                     shm_ring.ring_file_name(user_name,
+                                                             application_name))
+            self.ring = shm_ring.RingConsumer(ring_path, self.ring_capacity)
+            self.ring_thread = threading.Thread(target=self.__ring_thread_entry)
+            self.ring_thread.daemon = True
+            self.ring_thread.start()
+
+    def __ring_thread_entry(self):
+        while self.alive is True:
+            records = self.ring.wait(self.batch_size, self.ring_wait)
+            if len(records) == 0:
+                continue
+
+            self.lock.acquire()
+            try:
+                self.stats.rx_ring_events += len(records)
+                self.stats.rx_events += len(records)
+                for event_name, value, timestamp_ns in records:
+                    event = ["NUMERIC",
+                             event_name,
+                             str(timestamp_ns),
+                             self.user_name,
+                             self.application_name,
+                             repr(value)]
+                    self.__publish(event)
+            finally:
+                self.lock.release()
+
+    def process_app_msgs(self, msg):
+        # We have been handed the first message of a (possible) burst.
+        # Drain whatever else is already queued so the per-batch work
+        # (quota lock, socket wakeup) is paid once per batch.
+        msgs = [msg] + self.zsocket.recv_batch(self.batch_size - 1)
+
+        self.lock.acquire()
+        try:
+            self.stats.rx_batches += 1
+            self.stats.rx_events += len(msgs)
+            for msg in msgs:
+                event = self.__parse_event(msg['message'][0])
+                if event is None:
+                    self.stats.drop_malformed += 1
+                    continue
+                self.__publish(event)
+        finally:
+            self.lock.release()
+
+        # The messages have been consumed.  Nothing to pass up.
+        return None
+
+    def __publish(self, event):
+        if self.__check_quota(event) is False:
+            self.stats.drop_event_types += 1
+            return
+        if self.socket.send({'message':event}) is False:
+            self.stats.drop_rate_limited += 1
+            return
+        self.stats.tx_events += 1
+
+    def __parse_event(self, msg_str):
+        pieces = msg_str.split(" ", 5)
+        if len(pieces) < 5:
+            self.log_debug("Short event: " + msg_str)
+            return None
+
+        event_type, event_name, timestamp, user_name, app_name = pieces[:5]
+        if event_type == "" or event_name == "" or timestamp == "":
+            self.log_debug("Empty event header field: " + msg_str)
+            return None
+
+        # The application may only publish events as itself.
+        if user_name != self.user_name or \
+           app_name != self.application_name:
+            self.log_debug("Event for wrong user/app: " + msg_str)
+            return None
+
+        # The Java timestamp only has second resolution.  Re-stamp the
+        # event with the receive time, in the wire format (epoch ns).
+        pieces[2] = str(Timestamp.Now())
+        return pieces
+
+    def __check_quota(self, event):
+        event_key = (event[0], event[1])
+        if event_key not in self.event_types:
+            if len(self.event_types) >= self.sla['max_event_types']:
+                return False
+            self.event_types.add(event_key)
+        return True
+
+    def get_rates(self):
+        # Return the rx/tx/drop counters along with the events per
+        # second accepted since the last call.
+        now = time.time()
+        elapsed = now - self.last_rate_time
+        tx_rate = 0.0
+        if elapsed > 0:
+            tx_rate = (self.stats.tx_events - self.last_rate_events) / elapsed
+        self.last_rate_time = now
+        self.last_rate_events = self.stats.tx_events
+        return {'rx_events': self.stats.rx_events,
+                'rx_batches': self.stats.rx_batches,
+                'tx_events': self.stats.tx_events,
+                'drop_malformed': self.stats.drop_malformed,
+                'drop_event_types': self.stats.drop_event_types,
+                'drop_rate_limited': self.stats.drop_rate_limited,
+                'tx_events_per_sec': tx_rate}
 
     def close(self):
+        self.alive = False
         self.interface.close()
+        if self.ring is not None:
+            # The ring thread leaves wait() within ring_wait seconds.
+            self.ring_thread.join()
+            self.ring.remove()
 
 
 def test1():
@@ -190,6 +487,188 @@ def test1():
     time.sleep(3)
     print "test1() PASSED"
 
+
+def test2():
+
+    # Verify the resource profile is applied to the child process.
+    # The child reports its CPU set and address space limit on stderr.
+    class MyClass(log.Logger):
+        def __init__(self):
+            log.Logger.__init__(self)
+            self.output = []
+            self.finished = False
+
+        def app_event_cback(self, event_name, event_args=[]):
+            if event_name == "STDERR":
+                self.output.append(event_args[0].strip())
+            if event_name == "FINISHED":
+                self.finished = True
+
+    c = MyClass()
+    app = AppExec("sysadmin", "", "myapp2", c.app_event_cback)
+    profile = ResourceProfile(cpus=[0],
+                              nice=1,
+                              max_memory=512 * 1024 * 1024)
+    app.run(['sh', '-c',
+             'grep Cpus_allowed_list /proc/self/status 1>&2;'
+             ' ulimit -v 1>&2'],
+            profile)
+    time.sleep(2)
+
+    assert(c.finished is True)
+    assert("Cpus_allowed_list:\t0" in c.output)
+    assert(str(512 * 1024) in c.output)
+    print "test2() PASSED"
+
+
+def test3():
+
+    # Push events at the proxy the way the Java EventSource does and
+    # verify the good ones come out the EVENT socket, in order, with
+    # sequence numbers.
+    from apphost.base import event_collector
+
+    user_name = "sysadmin"
+    app_name = "proxytest"
+
+    class MyCollector():
+        def __init__(self):
+            self.events = []
+            self.collector = event_collector.EventCollector(
+                                    ["NUMERIC"],
+                                    self.event_cback,
+                                    user_name,
+                                    app_name)
+
+        def event_cback(self, event):
+            self.events.append(event)
+
+    mc = MyCollector()
+    proxy = AppEventProxy(user_name, app_name)
+    time.sleep(1)
+
+    push = zsocket.ZSocketClient(zmq.PUSH, "ipc",
+                                 ":".join([user_name, app_name]),
+                                 "EVENT")
+    push.connect()
+    push.set_framing(False)
+    for i in range(10):
+        push.send({'message':["NUMERIC", "tick", "01/01/13-10:00:00",
+                              user_name, app_name, str(i)]})
+    # Malformed, and someone else's events
+    push.send({'message':["NUMERIC", "tick"]})
+    push.send({'message':["NUMERIC", "tick", "01/01/13-10:00:00",
+                          "otheruser", app_name, "1"]})
+    time.sleep(2)
+
+    assert(proxy.stats.tx_events == 10)
+    assert(proxy.stats.drop_malformed == 2)
+    assert(len(mc.events) == 10)
+    for i, event in enumerate(mc.events):
+        assert(event['contents'] == [str(i)])
+        if i > 0:
+            assert(event['sequence'] == mc.events[i - 1]['sequence'] + 1)
+
+    push.close()
+    proxy.close()
+
+    # Over max_event_types, then over the rate, counted apart.  A user
+    # of its own, so the other tests keep their token bucket.
+    user_name = "quotatest"
+    proxy = AppEventProxy(user_name, app_name)
+    push = zsocket.ZSocketClient(zmq.PUSH, "ipc",
+                                 ":".join([user_name, app_name]),
+                                 "EVENT")
+    push.connect()
+    push.set_framing(False)
+    max_types = proxy.sla['max_event_types']
+    for i in range(max_types + 5):
+        push.send({'message':["COUNT", "n" + str(i), "01/01/13-10:00:00",
+                              user_name, app_name, "1"]})
+    time.sleep(1)
+    assert(proxy.stats.drop_event_types == 5)
+    assert(proxy.stats.drop_rate_limited == 0)
+    for i in range(proxy.sla['max_tx_events_per_minute']):
+        push.send({'message':["COUNT", "n0", "01/01/13-10:00:00",
+                              user_name, app_name, "1"]})
+    time.sleep(1)
+    assert(proxy.stats.drop_event_types == 5)
+    assert(proxy.stats.drop_rate_limited > 0)
+    assert(proxy.stats.drop_malformed == 0)
+
+    push.close()
+    proxy.close()
+    print "test3() PASSED"
+
+
+def test4():
+
+    # Numeric ticks through the shared memory ring
+    from apphost.base import event_collector
+
+    user_name = "sysadmin"
+    app_name = "ringtest"
+
+    class MyCollector():
+        def __init__(self):
+            self.events = []
+            self.collector = event_collector.EventCollector(
+                                    ["NUMERIC"],
+                                    self.event_cback,
+                                    user_name,
+                                    app_name)
+
+        def event_cback(self, event):
+            self.events.append(event)
+
+    mc = MyCollector()
+    proxy = AppEventProxy(user_name, app_name, ".")
+    time.sleep(1)
+
+    producer = shm_ring.RingProducer(
+                    shm_ring.ring_file_name(user_name, app_name))
+    for i in range(10):
+        assert(producer.send("tick", i * 0.5) is True)
+    time.sleep(2)
+
+    assert(proxy.stats.rx_ring_events == 10)
+    assert(len(mc.events) == 10)
+    for i, event in enumerate(mc.events):
+        assert(event['name'] == "tick")
+        assert(float(event['contents'][0]) == i * 0.5)
+
+    producer.close()
+    proxy.close()
+    # The ring thread has exited and the ring is gone
+    assert(proxy.ring_thread.is_alive() is False)
+    assert(os.path.exists(proxy.ring.path) is False)
+    print "test4() PASSED"
+
+
+def test5():
+
+    # A profile which fails in the child is reported by run(), rather
+    # than raised: here cgroup.procs cannot be written.
+    import tempfile
+    import shutil
+
+    def app_event_cback(event_name, event_args=[]):
+        pass
+
+    cgroup_root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(cgroup_root, "myapp5", "cgroup.procs"))
+    profile = ResourceProfile(cgroup="myapp5")
+    profile.cgroup_root = cgroup_root
+    app = AppExec("sysadmin", "", "myapp5", app_event_cback)
+    assert(app.run(['true'], profile) is False)
+    assert(app.is_running() is False)
+
+    shutil.rmtree(cgroup_root, True)
+    print "test5() PASSED"
+
 if __name__ == '__main__':
-    import time
     test1()
+    test2()
+    test3()
+    test4()
+    test5()
@@ -1,7 +1,44 @@
 """
     Implementation of the DiscoveryServer and DiscoveryClient
     classes.
+
+    The DiscoveryServers of a process are announced together by one
+    DiscoveryAnnouncer thread, on one UDP socket.  A beacon datagram
+    carries one line per service, packed up to udplib.MAX_PAYLOAD bytes:
+
+        BEACON <uuid> <user> <app> <service> <location>
+
+    Every service is announced each period.  A service is also announced
+    as soon as it is added, and a closed service sends a
+
+        BYE <uuid> <user> <app> <service> <location>
+
+    line so clients drop it without waiting for it to age out.
+
+    A client looking for a service need not wait for the next period: it
+    broadcasts a query, from its own ephemeral port,
+
+        QUERY <user> <app> <service>
+
+    where each field is a shell pattern.  The announcers with matching
+    services send their BEACON lines straight back to the querying
+    port, after a random delay of up to DiscoveryAnnouncer.reply_jitter
+    seconds so a query does not bring every reply in at once.  A
+    service whose user or app is "*" (e.g. the event broker) matches
+    any query.
+
+    A DiscoveryClient given a cache path saves the services it has
+    confirmed to that file every cache_period seconds and when closed,
+    and loads them back when it starts.  The loaded services are handed
+    to the service_add_cback straight away, so a restarted collector can
+    connect before any beacon arrives, but are marked unconfirmed
+    (service.confirmed is False) until a beacon or a query reply
+    confirms them.  An unconfirmed service ages out as usual.
 """
+import fnmatch
+import heapq
+import os
+import random
 import udplib
 import threading
 import time
@@ -10,9 +47,201 @@ import location
 from local_log import *
 
 
+def service_matches(fields, patterns):
+    # fields and patterns are (user, app, service) tuples
+    for field, pattern in zip(fields, patterns):
+        if field != "*" and not fnmatch.fnmatchcase(field, pattern):
+            return False
+    return True
+
+
+class DiscoveryAnnouncer(object):
+
+    """
+        Per process sender of the DiscoveryServer beacons.  Started by
+        the first DiscoveryServer.
+    """
+
+    announcer = None
+    lock = threading.Lock()
+    # Longest delay of a reply to a query, in seconds
+    reply_jitter = 0.1
+
+    class Stats():
+        def __init__(self):
+            self.datagrams = 0
+            self.beacons = 0
+            self.triggered = 0
+            self.queries = 0
+            self.replies = 0
+
+    def __init__(self):
+        self.udp = udplib.UDP()
+        self.stats = DiscoveryAnnouncer.Stats()
+        # id(server) -> server
+        self.servers = {}
+        # Waiting for a triggered beacon
+        self.added = []
+        self.byes = []
+        # (time due, address, beacon lines) of the replies to queries
+        self.replies = []
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.__thread_entry)
+        self.thread.daemon = True
+        self.thread.start()
+        self.query_thread = threading.Thread(target=self.__query_thread_entry)
+        self.query_thread.daemon = True
+        self.query_thread.start()
+
+    @staticmethod
+    def Register(server):
+        DiscoveryAnnouncer.lock.acquire()
+        try:
+            if DiscoveryAnnouncer.announcer is None:
+                DiscoveryAnnouncer.announcer = DiscoveryAnnouncer()
+            announcer = DiscoveryAnnouncer.announcer
+            announcer.servers[id(server)] = server
+            announcer.added.append(server)
+        finally:
+            DiscoveryAnnouncer.lock.release()
+        announcer.wakeup.set()
+
+    @staticmethod
+    def Unregister(server):
+        DiscoveryAnnouncer.lock.acquire()
+        try:
+            announcer = DiscoveryAnnouncer.announcer
+            if announcer is None or \
+               announcer.servers.pop(id(server), None) is None:
+                return
+            if server in announcer.added:
+                announcer.added.remove(server)
+            announcer.byes.append(server.beacon("BYE"))
+        finally:
+            DiscoveryAnnouncer.lock.release()
+        announcer.wakeup.set()
+
+    @staticmethod
+    def Pack(lines, max_size=None):
+        # Join the lines into as few datagrams of at most max_size bytes
+        # as possible, keeping their order.  A line too long for a
+        # datagram goes alone.
+        if max_size is None:
+            max_size = udplib.MAX_PAYLOAD
+        datagrams = []
+        current = ""
+        for line in lines:
+            if current == "":
+                current = line
+            elif len(current) + 1 + len(line) <= max_size:
+                current += "\n" + line
+            else:
+                datagrams.append(current)
+                current = line
+        if current != "":
+            datagrams.append(current)
+        return datagrams
+
+    def __send(self, lines):
+        for datagram in DiscoveryAnnouncer.Pack(lines):
+            self.udp.send(datagram)
+            self.stats.datagrams += 1
+        self.stats.beacons += len(lines)
+
+    def __thread_entry(self):
+        last_beacon = 0
+        next_beacon = 0
+        timeout = None
+        while True:
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+            now = time.time()
+            DiscoveryAnnouncer.lock.acquire()
+            try:
+                servers = self.servers.values()
+                added = self.added
+                byes = self.byes
+                self.added = []
+                self.byes = []
+                replies = [reply for reply in self.replies if reply[0] <= now]
+                self.replies = [reply for reply in self.replies
+                                if reply[0] > now]
+                next_reply = min([reply[0] for reply in self.replies] or
+                                 [None])
+            finally:
+                DiscoveryAnnouncer.lock.release()
+
+            try:
+                if len(byes) > 0:
+                    self.stats.triggered += 1
+                    self.__send(byes)
+                for due, address, lines in replies:
+                    for datagram in DiscoveryAnnouncer.Pack(lines):
+                        self.udp.sendto(datagram, address)
+                        self.stats.replies += 1
+                if len(servers) > 0:
+                    # A server added with a shorter period shortens
+                    # the current one.
+                    period = min([server.period for server in servers])
+                    next_beacon = last_beacon + period
+                    if now >= next_beacon:
+                        self.__send([server.beacon() for server in servers])
+                        last_beacon = now
+                        next_beacon = now + period
+                    elif len(added) > 0:
+                        self.stats.triggered += 1
+                        self.__send([server.beacon() for server in added])
+            except Exception as e:
+                # e.g. the network is down; try again next period.
+                Llog.LogError("Discovery beacon failed: " + str(e))
+
+            deadlines = [d for d in [next_reply] if d is not None]
+            if len(servers) > 0:
+                deadlines.append(next_beacon)
+            timeout = None
+            if len(deadlines) > 0:
+                timeout = max(0, min(deadlines) - time.time())
+
+    def __query_thread_entry(self):
+        # The announcer's socket also hears every beacon on the network;
+        # only the queries are of interest.
+        while True:
+            received = self.udp.recvfrom_timeout(1)
+            if received is None:
+                continue
+            datagram, address = received
+            if datagram.startswith("QUERY ") is True:
+                self.__rx_query(datagram, address)
+
+    def __rx_query(self, query, address):
+        pieces = query.split()
+        if len(pieces) != 4:
+            Llog.LogError("Invalid discovery query received: " + query)
+            return
+        patterns = tuple(pieces[1:4])
+
+        DiscoveryAnnouncer.lock.acquire()
+        try:
+            self.stats.queries += 1
+            lines = [server.beacon() for server in self.servers.values()
+                     if service_matches((server.user_name,
+                                         server.application_name,
+                                         server.service_name),
+                                        patterns)]
+            if len(lines) == 0:
+                return
+            due = time.time() + random.uniform(0, self.reply_jitter)
+            self.replies.append((due, address, lines))
+        finally:
+            DiscoveryAnnouncer.lock.release()
+        self.wakeup.set()
+
+
 class DiscoveryServer:
 
     """
+        Announces one service of the process, see DiscoveryAnnouncer.
     """
 
     period = 10
@@ -37,7 +266,6 @@ class DiscoveryServer:
         self.service_name = service_name
         self.service_location = service_location
         self.uuid = uuid.uuid4()
-        self.udp = udplib.UDP()
         self.period = DiscoveryServer.period
 
         # Verify the location makes sense, syntactically
@@ -45,9 +273,7 @@ class DiscoveryServer:
         assert(location_check is True)
 
         self.alive = True
-        self.thread = threading.Thread(target=self.__thread_entry)
-        self.thread.daemon = True
-        self.thread.start()
+        DiscoveryAnnouncer.Register(self)
 
     #def __del__(self):
         # self.close()
@@ -56,23 +282,15 @@ class DiscoveryServer:
         if self.alive is True:
             Llog.LogDebug(str(self) + " closing...")
             self.alive = False
-            # Give it some time to die.  The thread must have a chance
-            # to process the 'alive' value and exit
-            time.sleep(self.period)
+            DiscoveryAnnouncer.Unregister(self)
 
-    def __thread_entry(self):
-        while self.alive:
-            self.__send_beacon()
-            time.sleep(self.period)
-
-    def __send_beacon(self):
-        beacon = " ".join(["BEACON",
-                           str(self.uuid),
-                           self.user_name,
-                           self.application_name,
-                           self.service_name,
-                           self.service_location])
-        self.udp.send(beacon)
+    def beacon(self, header="BEACON"):
+        return " ".join([header,
+                         str(self.uuid),
+                         self.user_name,
+                         self.application_name,
+                         self.service_name,
+                         self.service_location])
 
     def __str__(self):
         return "-".join([str(self.uuid),
@@ -91,6 +309,8 @@ class DiscoveryService:
         self.location = location
         self.uuid = str(uuid)
         self.time = time.time()
+        # False for a service loaded from a cache, until it is heard of
+        self.confirmed = True
 
     def __str__(self):
         return "-".join([self.user_name,
@@ -107,16 +327,176 @@ class DiscoveryService:
             return True
         return False
 
+    def __ne__(self, service):
+        return not self.__eq__(service)
+
+    def key(self):
+        return (self.user_name,
+                self.application_name,
+                self.service_name,
+                self.location)
+
+
+class DiscoveryTable(object):
+
+    """
+        The services discovered by a DiscoveryClient, indexed by
+        (user, app, service, location), with the time each one expires
+        in a min-heap.
+
+        Refreshing a service only updates its time; its heap entry is
+        left alone.  When the entry reaches the top of the heap, a
+        service refreshed since is pushed back with its new expiry
+        time, so each service has one heap entry and a beacon costs a
+        dict lookup.  All methods may be called from any thread.
+    """
+
+    def __init__(self, ageout):
+        self.ageout = ageout
+        # key -> DiscoveryService
+        self.services = {}
+        # (expiry time, key, service)
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.services)
+
+    def update(self, new_service, now=None):
+        # Add or refresh a service.  Returns (added, removed): added is
+        # new_service if it was not known, and removed the service it
+        # replaces when the same service restarted with a new UUID.
+        if now is None:
+            now = time.time()
+        key = new_service.key()
+        self.lock.acquire()
+        try:
+            service = self.services.get(key)
+            if service is not None and service.uuid == new_service.uuid:
+                service.time = now
+                service.confirmed = new_service.confirmed or \
+                                    service.confirmed
+                return None, None
+            new_service.time = now
+            self.services[key] = new_service
+            heapq.heappush(self.heap, (now + self.ageout, key, new_service))
+            return new_service, service
+        finally:
+            self.lock.release()
+
+    def remove(self, service):
+        # Returns True if the service was known
+        self.lock.acquire()
+        try:
+            if self.services.get(service.key()) is not service:
+                return False
+            del self.services[service.key()]
+            return True
+        finally:
+            self.lock.release()
+
+    def expire(self, now=None):
+        # Remove and return the services not refreshed for ageout
+        # seconds.
+        if now is None:
+            now = time.time()
+        expired = []
+        self.lock.acquire()
+        try:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                expiry, key, service = heapq.heappop(self.heap)
+                if self.services.get(key) is not service:
+                    # Removed, or replaced by a restarted service
+                    continue
+                if service.time + self.ageout > now:
+                    heapq.heappush(self.heap,
+                                   (service.time + self.ageout, key, service))
+                    continue
+                del self.services[key]
+                expired.append(service)
+        finally:
+            self.lock.release()
+        return expired
+
+    def find(self, user_name, application_name, service_name, location):
+        self.lock.acquire()
+        try:
+            return self.services.get((user_name, application_name,
+                                      service_name, location))
+        finally:
+            self.lock.release()
+
+    def snapshot(self, user_name=None, application_name=None,
+                       service_name=None):
+        # A list of the services, optionally only those matching the
+        # given names.  The list is the caller's.
+        self.lock.acquire()
+        try:
+            services = self.services.values()
+        finally:
+            self.lock.release()
+        if user_name is not None:
+            services = [s for s in services if s.user_name == user_name]
+        if application_name is not None:
+            services = [s for s in services
+                        if s.application_name == application_name]
+        if service_name is not None:
+            services = [s for s in services if s.service_name == service_name]
+        return services
+
+
+class DiscoveryQuery(object):
+
+    """
+        An outstanding query of a DiscoveryClient.  services is the list
+        of matching services found so far; found is set once there is
+        at least one.
+    """
+
+    def __init__(self, patterns, cback, deadline):
+        self.patterns = patterns
+        self.cback = cback
+        self.deadline = deadline
+        self.services = []
+        self.found = threading.Event()
+
+    def matches(self, service):
+        return service_matches((service.user_name,
+                                service.application_name,
+                                service.service_name),
+                               self.patterns)
+
+    def add(self, service):
+        for known in self.services:
+            if known is service:
+                return
+        self.services.append(service)
+        self.found.set()
+        if self.cback is not None:
+            self.cback(service)
+
+
 class DiscoveryClient:
 
     """
     """
     ageout = 40
+    # Default time queries are kept open for replies, and interval of
+    # the repeated queries of lookup(), in seconds
+    query_timeout = 2.0
+    query_retry = 0.25
+    # Seconds between saves of the cache, and the age of the oldest
+    # cached service loaded
+    cache_period = 30
+    cache_max_age = 24 * 3600
 
     # ageout - optional argument to specify how long before an entry
     #          discovered will be removed from our list if another beacon
     #          for it is not received.
-    def __init__(self, service_add_cback, service_remove_cback):
+    # cache_path - optional file to keep the discovered services in
+    #          across restarts.
+    def __init__(self, service_add_cback, service_remove_cback,
+                       cache_path=None):
         assert(service_add_cback is not None)
         assert(service_remove_cback is not None)
 
@@ -125,51 +505,220 @@ class DiscoveryClient:
         self.alive = True
         self.service_add_cback = service_add_cback
         self.service_remove_cback = service_remove_cback
-        self.discovered_service_list = []
+        self.table = DiscoveryTable(self.ageout)
+        # Queries go out from, and the replies come back to, an
+        # ephemeral port of our own.
+        self.query_udp = udplib.UDP(port=0)
+        self.queries = []
+        self.queries_lock = threading.Lock()
+        self.cache_path = cache_path
+        self.cache_saved = time.time()
+        # Serializes the saves of the client thread and close(), which
+        # share the temporary file.
+        self.cache_lock = threading.Lock()
         self.thread = threading.Thread(target=self.__thread_entry)
         self.thread.daemon = True
         self.thread.start()
 
     def __thread_entry(self):
+        if self.cache_path is not None:
+            self.__load_cache()
         while self.alive:
-            self.__recv_beacons()
+            for udp, datagram in udplib.recv_any([self.udp, self.query_udp],
+                                                 1):
+                for beacon in datagram.split("\n"):
+                    self.__process_beacon(beacon)
             self.__process_discovery_list()
+            self.__expire_queries()
+            if self.cache_path is not None and \
+               time.time() - self.cache_saved >= self.cache_period:
+                self.save_cache()
+
+    def query(self, user_name="*", application_name="*", service_name="*",
+                    cback=None, timeout=None):
+        # Ask the announcers for the matching services, without waiting
+        # for them.  The names are shell patterns.  cback, if given, is
+        # called with each matching service: those already discovered
+        # first, then those found for timeout seconds.  New services are
+        # also given to the service_add_cback as usual.  Returns the
+        # DiscoveryQuery.
+        if timeout is None:
+            timeout = self.query_timeout
+        query = DiscoveryQuery((user_name, application_name, service_name),
+                               cback,
+                               time.time() + timeout)
+        self.queries_lock.acquire()
+        self.queries.append(query)
+        self.queries_lock.release()
+        for service in self.table.snapshot():
+            if query.matches(service):
+                query.add(service)
+        self.__send_query(query)
+        return query
+
+    def lookup(self, user_name="*", application_name="*", service_name="*",
+                     timeout=1.0):
+        # Returns the list of matching services, querying for them if
+        # none is known yet.  Waits at most timeout seconds for the
+        # first one, and returns an empty list if none is found.
+        query = self.query(user_name, application_name, service_name,
+                           timeout=timeout)
+        deadline = time.time() + timeout
+        while query.found.is_set() is False:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if query.found.wait(min(remaining, self.query_retry)) is False \
+               and time.time() < deadline:
+                # Lost, or nobody was there yet
+                self.__send_query(query)
+        self.cancel(query)
+        return query.services[:]
+
+    def cancel(self, query):
+        self.queries_lock.acquire()
+        try:
+            if query in self.queries:
+                self.queries.remove(query)
+        finally:
+            self.queries_lock.release()
+
+    def __send_query(self, query):
+        try:
+            self.query_udp.sendto(" ".join(("QUERY",) + query.patterns),
+                                  (self.query_udp.broadcast, udplib.PORT))
+        except Exception as e:
+            Llog.LogError("Discovery query failed: " + str(e))
+
+    def __answer_queries(self, service):
+        self.queries_lock.acquire()
+        queries = [query for query in self.queries if query.matches(service)]
+        self.queries_lock.release()
+        for query in queries:
+            query.add(service)
+
+    def __expire_queries(self):
+        if len(self.queries) == 0:
+            return
+        now = time.time()
+        self.queries_lock.acquire()
+        self.queries = [query for query in self.queries
+                        if query.deadline > now]
+        self.queries_lock.release()
 
     def __del__(self):
         self.close()
 
     def close(self):
+        if self.alive is True and self.cache_path is not None:
+            self.save_cache()
         self.alive = False
         # We need to wait for a few seconds to allow the main thread
         # enough time to re-read the alive flag and exit
         time.sleep(5)
 
-    def __process_discovery_list(self):
-        # check each entry in our discovered services list to
-        # see if any entries are too old to keep around
+    @property
+    def discovered_service_list(self):
+        # Snapshot of the discovered services
+        return self.table.snapshot()
+
+    def get_services(self, user_name=None, application_name=None,
+                           service_name=None):
+        # Snapshot of the discovered services, see DiscoveryTable
+        return self.table.snapshot(user_name, application_name, service_name)
+
+    def save_cache(self):
+        # Write the confirmed services to the cache file, one per line:
+        #   <uuid> <user> <app> <service> <location> <time last heard>
+        self.cache_lock.acquire()
+        try:
+            self.__save_cache()
+        finally:
+            self.cache_lock.release()
+
+    def __save_cache(self):
+        self.cache_saved = time.time()
+        lines = [" ".join([service.uuid,
+                           service.user_name,
+                           service.application_name,
+                           service.service_name,
+                           service.location,
+                           "%.3f" % service.time])
+                 for service in self.table.snapshot()
+                 if service.confirmed is True]
+        # Write a new file and rename it over the old one, so a reader,
+        # or a crash, never sees half a cache.
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            f = open(tmp_path, "w")
+            try:
+                f.write("".join([line + "\n" for line in sorted(lines)]))
+            finally:
+                f.close()
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            Llog.LogError("Cannot save the discovery cache "
+                          + self.cache_path + ": " + str(e))
+
+    def __load_cache(self):
+        try:
+            f = open(self.cache_path)
+            try:
+                lines = f.readlines()
+            finally:
+                f.close()
+        except IOError:
+            # No cache yet
+            return
+
         now = time.time()
-        service_list = self.discovered_service_list[:]
-        for service in service_list:
-            if service.time < now - self.ageout:
-                # The entry is too old.  Dump it
-                self.discovered_service_list.remove(service)
-                self.service_remove_cback(service)
+        loaded = 0
+        for line in lines:
+            pieces = line.split()
+            try:
+                if len(pieces) != 6:
+                    raise ValueError(line)
+                uuid.UUID(pieces[0])
+                saved = float(pieces[5])
+            except ValueError:
+                Llog.LogError("Invalid discovery cache entry: " + line)
+                continue
+            if now - saved > self.cache_max_age or \
+               location.check_location(pieces[4]) is False:
+                continue
+            service = DiscoveryService(pieces[1], pieces[2], pieces[3],
+                                       pieces[4], pieces[0])
+            service.confirmed = False
+            added, removed = self.table.update(service, now)
+            if added is not None:
+                loaded += 1
+                self.service_add_cback(added)
+        Llog.LogInfo("Loaded " + str(loaded) + " services from "
+                     + self.cache_path)
 
-    def __recv_beacons(self):
-        while True:
-            beacon = self.udp.recv_timeout(1)
-            if beacon is None:
-                break
-            self.__process_beacon(beacon)
+        if loaded > 0:
+            # Confirm them, or find their replacements, without waiting
+            # for the beacons.
+            self.query()
+
+    def __process_discovery_list(self):
+        # Only the services at the top of the expiry heap are looked
+        # at, so this is cheap enough to run after every beacon.
+        for service in self.table.expire():
+            self.service_remove_cback(service)
 
     def __process_beacon(self, beacon):
         pieces = beacon.split()
 
+        if len(pieces) > 0 and pieces[0] == "QUERY":
+            # For the announcers
+            return
+
         if len(pieces) != 6:
             Llog.LogError("Invalid beacon received: " + beacon)
             return
 
-        if pieces[0] != "BEACON":
+        if pieces[0] not in ["BEACON", "BYE"]:
             Llog.LogError("Invalid beacon header received: " + beacon)
             return
 
@@ -179,7 +728,7 @@ class DiscoveryClient:
         # We have a valid beacon frame.
         # Process the services to see if there are any
         # new services contained that we do not have in
-        # our discovered_services_list.
+        # our discovered services table.
         #
         service_uuid, \
         user_name, \
@@ -209,44 +758,40 @@ class DiscoveryClient:
                                        service_location,
                                        service_uuid)
 
-        # Check to see if we already have this entry in our internal
-        # list of services
-        service = self.find_discovered_service(new_service)
-
-        if service is None:
-            # Service does not already exist in our list, add it.
-            # Timestamp the discovered service so we can
-            # remove them if they expire.
-            self.discovered_service_list.append(new_service)
+        if pieces[0] == "BYE":
+            # The service closed
+            service = self.find_discovered_service(new_service)
+            if service is not None and service.uuid == new_service.uuid \
+               and self.table.remove(service) is True:
+                self.service_remove_cback(service)
+            return
 
+        added, removed = self.table.update(new_service)
+        if removed is not None:
+            # We have just found a service which has the same name and
+            # location, but different UUID.  This is probably because
+            # of a restarted service daemon.  Because it is a restarted
+            # service, we need to re-create the socket connection.
+            # We need to declare the current service as 'removed' and
+            # add in this new service.
+            Llog.LogInfo("UUID mismatch for service <" + str(new_service)
+                         + ">.  Announcing service removal.")
+            self.service_remove_cback(removed)
+        if added is not None:
             # Callout to notify the user of this new service
-            if self.service_add_cback is not None:
-                self.service_add_cback(new_service)
-        else:
-            # The service exists.  Update the timestamp
-            # in the service entry to keep it from
-            # expiring
-            service.time = time.time()
+            self.service_add_cback(added)
+        if len(self.queries) > 0:
+            service = self.find_discovered_service(new_service)
+            if service is not None:
+                self.__answer_queries(service)
 
     def find_discovered_service(self, service):
-        for discovered_service in self.discovered_service_list:
-            if discovered_service == service:
-                if discovered_service.uuid != service.uuid:
-                    # We have just found a service which has the same
-                    # name and location, but different UUID.  This is
-                    # probably because of a restarted service daemon.
-                    # Because it is a restarted service, we need to
-                    # re-create the socket connection.
-                    # We need to declare the current service as
-                    # 'removed' and add in this new service.
-                    Llog.LogInfo("UUID mismatch for service <" + str(service)
-                                 + ">.  Announcing service removal.")
-                    self.discovered_service_list.remove(discovered_service)
-                    self.service_remove_cback(discovered_service)
-                    return None
-                else:
-                    return discovered_service
-        return None
+        # The discovered service with the same names and location, or
+        # None.
+        return self.table.find(service.user_name,
+                               service.application_name,
+                               service.service_name,
+                               service.location)
 
 def test1():
 
@@ -290,5 +835,229 @@ def test1():
     assert(t.service_found is True)
     print "PASSED"
 
+
+def test2():
+
+    # The table, with explicit times
+    table = DiscoveryTable(40)
+    first = DiscoveryService("sysadm", "myapp", "EVENT",
+                             "tcp://127.0.0.1:4321", uuid.uuid4())
+    second = DiscoveryService("sysadm", "other", "EVENT",
+                              "tcp://127.0.0.1:4322", uuid.uuid4())
+    assert(table.update(first, 100) == (first, None))
+    assert(table.update(second, 110) == (second, None))
+    refresh = DiscoveryService("sysadm", "myapp", "EVENT",
+                               "tcp://127.0.0.1:4321", first.uuid)
+    assert(table.update(refresh, 130) == (None, None))
+    assert(table.find("sysadm", "myapp", "EVENT",
+                      "tcp://127.0.0.1:4321") is first)
+    assert(len(table.snapshot(application_name="other")) == 1)
+
+    # first was refreshed, so only second expires at 150
+    assert(table.expire(145) == [])
+    assert(table.expire(150) == [second])
+    assert(table.expire(169) == [])
+    assert(table.expire(170) == [first])
+    assert(len(table) == 0)
+
+    # A restarted service replaces the old one
+    table.update(first, 200)
+    restarted = DiscoveryService("sysadm", "myapp", "EVENT",
+                                 "tcp://127.0.0.1:4321", uuid.uuid4())
+    assert(table.update(restarted, 210) == (restarted, first))
+    assert(table.expire(245) == [])
+    assert(table.expire(250) == [restarted])
+    assert(table.remove(restarted) is False)
+    print "test2() PASSED"
+
+
+def test3():
+
+    lines = ["BEACON " + "x" * 90 for i in range(40)]
+    datagrams = DiscoveryAnnouncer.Pack(lines, 1000)
+    assert(len(datagrams) == 4)
+    assert(max([len(d) for d in datagrams]) <= 1000)
+    assert("\n".join(datagrams).split("\n") == lines)
+    assert(DiscoveryAnnouncer.Pack(["y" * 2000], 1000) == ["y" * 2000])
+    assert(DiscoveryAnnouncer.Pack([]) == [])
+    print "test3() PASSED"
+
+
+def test4():
+
+    # Several services of one process share the beacons, are announced
+    # when added and dropped when closed, without waiting for the next
+    # periodic beacon.
+    added = []
+    removed = []
+
+    def service_add(service):
+        if service.application_name == "multiapp":
+            added.append(service)
+
+    def service_remove(service):
+        if service.application_name == "multiapp":
+            removed.append(service)
+
+    dc = DiscoveryClient(service_add, service_remove)
+    time.sleep(0.5)
+    DiscoveryServer.period = 10
+    servers = [DiscoveryServer("sysadm", "multiapp", "SERVICE%d" % i,
+                               "tcp://127.0.0.1:%d" % (5000 + i))
+               for i in range(20)]
+    time.sleep(1)
+    assert(len(added) == 20)
+    stats = DiscoveryAnnouncer.announcer.stats
+    assert(stats.datagrams < 20)
+
+    servers[0].close()
+    time.sleep(1)
+    assert(len(removed) == 1)
+    assert(removed[0].service_name == "SERVICE0")
+    assert(len(dc.get_services(application_name="multiapp")) == 19)
+    for server in servers[1:]:
+        server.close()
+    time.sleep(1)
+    assert(len(removed) == 20)
+    print "test4() PASSED"
+
+
+def test5():
+
+    # A client started after the beacons finds the services by query,
+    # without waiting for the next period.
+    DiscoveryServer.period = 10
+    server = DiscoveryServer("sysadm", "queryapp", "EVENT",
+                             "tcp://127.0.0.1:6001")
+    broker = DiscoveryServer("*", "*", "EVENT_BROKER",
+                             "tcp://127.0.0.1:6002")
+    time.sleep(0.5)
+
+    added = []
+    dc = DiscoveryClient(added.append, lambda service: None)
+    start = time.time()
+    services = dc.lookup("sysadm", "queryapp", "EVENT", timeout=3)
+    assert(time.time() - start < 1)
+    assert(len(services) == 1)
+    assert(services[0].location == "tcp://127.0.0.1:6001")
+    assert(services[0] in added)
+
+    # Asynchronous, including the broker serving every user
+    found = []
+    query = dc.query("sysadm", "*", "EVENT*", found.append)
+    assert(query.found.wait(1) is True)
+    time.sleep(0.5)
+    assert(sorted([s.service_name for s in found
+                   if s.application_name in ["queryapp", "*"]]) == \
+           ["EVENT", "EVENT_BROKER"])
+    dc.cancel(query)
+
+    start = time.time()
+    assert(dc.lookup("nobody", "*", "EVENT", timeout=0.5) == [])
+    assert(time.time() - start >= 0.5)
+    assert(DiscoveryAnnouncer.announcer.stats.replies >= 2)
+    server.close()
+    broker.close()
+    print "test5() PASSED"
+
+
+def test6():
+
+    # Services cached by one client are loaded, unconfirmed, by the next
+    path = "test6.cache"
+    if os.path.exists(path):
+        os.unlink(path)
+    DiscoveryServer.period = 1
+    server = DiscoveryServer("sysadm", "cacheapp", "EVENT",
+                             "tcp://127.0.0.1:6101")
+    first = DiscoveryClient(lambda service: None, lambda service: None,
+                            cache_path=path)
+    assert(len(first.lookup("sysadm", "cacheapp", "EVENT", 2)) == 1)
+    first.save_cache()
+    lines = [line.split() for line in open(path)]
+    assert(["sysadm", "cacheapp", "EVENT", "tcp://127.0.0.1:6101"] in
+           [line[1:5] for line in lines])
+
+    # A service gone since, one too old to load, and a bad line
+    f = open(path, "a")
+    f.write(" ".join([str(uuid.uuid4()), "sysadm", "goneapp", "EVENT",
+                      "tcp://127.0.0.1:6102", "%.3f" % time.time()]) + "\n")
+    f.write(" ".join([str(uuid.uuid4()), "sysadm", "oldapp", "EVENT",
+                      "tcp://127.0.0.1:6103", "1000.0"]) + "\n")
+    f.write("junk\n")
+    f.close()
+
+    added = []
+    removed = []
+    DiscoveryClient.ageout = 3
+    second = DiscoveryClient(added.append, removed.append, cache_path=path)
+    DiscoveryClient.ageout = 40
+    time.sleep(0.2)
+    apps = dict([(s.application_name, s) for s in added])
+    assert("cacheapp" in apps and "goneapp" in apps)
+    assert("oldapp" not in apps)
+    assert(apps["goneapp"].confirmed is False)
+    # The query sent after loading confirms the live one
+    time.sleep(1)
+    assert(apps["cacheapp"].confirmed is True)
+    assert(apps["goneapp"].confirmed is False)
+    time.sleep(4)
+    assert([s.application_name for s in removed] == ["goneapp"])
+    second.save_cache()
+    apps = [line.split()[2] for line in open(path)]
+    assert("cacheapp" in apps and "goneapp" not in apps)
+
+    # Concurrent saves, as from close() and the client thread, do not
+    # trip over each other's temporary file.
+    errors = []
+    log_error = Llog.__dict__['LogError']
+    Llog.LogError = errors.append
+    try:
+        threads = [threading.Thread(target=lambda: [second.save_cache()
+                                                    for i in range(50)])
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        Llog.LogError = log_error
+    assert(errors == [])
+    assert(os.path.exists(path + ".tmp") is False)
+    server.close()
+    os.unlink(path)
+    print "test6() PASSED"
+
+
+def bench1():
+
+    # Beacons per second with thousands of known services
+    nr_services = 5000
+    table = DiscoveryTable(40)
+    services = [DiscoveryService("user%d" % (i % 100), "app%d" % i, "EVENT",
+                                 "tcp://127.0.0.1:%d" % (10000 + i),
+                                 uuid.uuid4())
+                for i in range(nr_services)]
+    for service in services:
+        table.update(service, 0)
+    refreshes = [DiscoveryService(s.user_name, s.application_name,
+                                  s.service_name, s.location, s.uuid)
+                 for s in services]
+    nr_beacons = 100000
+    start = time.time()
+    for i in xrange(nr_beacons):
+        table.update(refreshes[i % nr_services], i * 0.0001)
+        table.expire(i * 0.0001)
+    elapsed = time.time() - start
+    print "bench1() " + str(int(nr_beacons / elapsed)) + " beacons/s, " \
+          + str(nr_services) + " services"
+
+
 if __name__ == '__main__':
     test1()
+    test2()
+    test3()
+    test4()
+    test5()
+    test6()
+    bench1()
@@ -0,0 +1,302 @@
+"""
+    Event
+
+    The object EventCollector hands to its event_cback.
+
+    Collectors handle a lot of events, and most callbacks only look at a
+    few fields of each.  Rather than a dict per event, an Event has a
+    fixed set of slots and keeps a reference to the received message;
+    the contents list, the display timestamp and the vital statistic
+    fields are only built when first asked for.  All the events of a
+    batch share the one message.
+
+    Events still behave like the dicts collectors used to receive:
+
+        event['type'], event['contents'], event.get('timestamp_ns'),
+        'replayed' in event, event['replayed'] = True
+
+    NUMERIC events carrying typed binary payloads (see numeric.py) have
+    them decoded into numbers and array.array buffers along with the
+    contents.  as_numpy() gives an array payload as a NumPy array.
+
+    Keys other than the fields below are kept in a small side dict,
+    created on first use.  Dict-style access costs a method call; code
+    handling every event should use the attributes (event.type,
+    event.contents, ...) instead.
+"""
+import numeric
+from timestamp import Timestamp
+
+
+class Event(object):
+
+    __slots__ = ['type',
+                 'name',
+                 'timestamp_ns',
+                 'user_name',
+                 'application_name',
+                 'sequence',
+                 'epoch',
+                 '_msg',
+                 '_start',
+                 '_end',
+                 '_contents',
+                 '_timestamp',
+                 '_vital',
+                 '_extra']
+
+    FIELDS = frozenset(['type', 'name', 'timestamp_ns', 'user_name',
+                        'application_name', 'sequence', 'epoch',
+                        'contents', 'timestamp'])
+    VITAL_FIELDS = frozenset(['vital_type', 'description', 'values',
+                              'value', 'delta', 'updates', 'threshold',
+                              'state', 'count', 'sum', 'buckets',
+                              'instance', 'stats'])
+
+    def __init__(self, event_type, name, timestamp_ns, user_name,
+                 application_name, sequence, msg, start, end=None,
+                 timestamp=None, epoch=""):
+        # The contents are msg[start:end].  timestamp is the display
+        # text, only given for sources sending text timestamps, in which
+        # case timestamp_ns is None.  epoch identifies the instance of
+        # the source the sequence numbers belong to.
+        self.type = event_type
+        self.name = name
+        self.timestamp_ns = timestamp_ns
+        self.user_name = user_name
+        self.application_name = application_name
+        self.sequence = sequence
+        self.epoch = epoch
+        self._msg = msg
+        self._start = start
+        self._end = end
+        self._contents = None
+        self._timestamp = timestamp
+        self._vital = None
+        self._extra = None
+
+    @property
+    def contents(self):
+        if self._contents is None:
+            if self._end is None:
+                self._contents = self._msg[self._start:]
+            else:
+                self._contents = self._msg[self._start:self._end]
+            if self.type == "NUMERIC":
+                self._contents = numeric.decode_contents(self._contents)
+            # The message is no longer needed by this event.
+            self._msg = None
+        return self._contents
+
+    def as_numpy(self, index=0):
+        # The array payload at contents[index] as a NumPy array, without
+        # copying the samples.
+        assert(numeric.numpy is not None)
+        values = self.contents[index]
+        if isinstance(values, numeric.array.array):
+            return numeric.numpy.frombuffer(values, dtype=values.typecode)
+        return numeric.numpy.array(values)
+
+    @contents.setter
+    def contents(self, contents):
+        self._contents = contents
+        self._msg = None
+        self._vital = None
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self.timestamp_ns is not None:
+            self._timestamp = Timestamp.Format(self.timestamp_ns)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+
+    def __decode_vital(self):
+        # See vitals.VStatEvent for the layout of the contents.
+        if self._vital is not None:
+            return
+        self._vital = {}
+        contents = self.contents
+        if self.type != "VITAL" or len(contents) < 2:
+            return
+        self._vital['vital_type'] = contents[0]
+        self._vital['description'] = contents[1]
+        self._vital['values'] = contents[2:]
+        # Statistics kept per instance are named <name>/<label>
+        name, sep, label = self.name.partition("/")
+        if sep != "":
+            self._vital['instance'] = label
+        # vitals imports the collector, which imports this module.
+        import vitals
+        fields = vitals.VStatEventDecoder.DecodeValues(contents[0],
+                                                       contents[2:])
+        if fields is not None:
+            self._vital.update(fields)
+
+    def __getitem__(self, key):
+        if key in Event.FIELDS:
+            return getattr(self, key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        if key in Event.VITAL_FIELDS:
+            self.__decode_vital()
+            if key in self._vital:
+                return self._vital[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in Event.FIELDS:
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = list(Event.FIELDS)
+        if self.type == "VITAL":
+            self.__decode_vital()
+            keys += self._vital.keys()
+        if self._extra is not None:
+            keys += self._extra.keys()
+        return keys
+
+    def to_dict(self):
+        return dict([(key, self[key]) for key in self.keys()])
+
+    def __str__(self):
+        return str(self.to_dict())
+
+
+def test1():
+
+    msg = ["NUMERIC", "tick", "BATCH", "sysadmin", "eventtest", "7",
+           "2", "1000000000", "2", "a", "b", "2000000000", "1", "c"]
+    first = Event("NUMERIC", "tick", 1000000000, "sysadmin", "eventtest",
+                  7, msg, 9, 11)
+    second = Event("NUMERIC", "tick", 2000000000, "sysadmin", "eventtest",
+                   7, msg, 13)
+    assert(first['contents'] == ["a", "b"])
+    assert(second['contents'] == ["c"])
+    assert(first['timestamp'] == Timestamp.Format(1000000000))
+    assert(first.get('sequence') == 7)
+    assert(first.get('nosuchkey', 5) == 5)
+    assert('replayed' not in first)
+    first['replayed'] = True
+    assert('replayed' in first and first['replayed'] is True)
+    assert('value' not in first)
+    try:
+        first['vital_type']
+        assert(False)
+    except KeyError:
+        pass
+
+    # Legacy text timestamp
+    legacy = Event("TEST", "x", None, "u", "a", 1, ["y"], 0,
+                   timestamp="01/01/13-10:00:00")
+    assert(legacy['timestamp'] == "01/01/13-10:00:00")
+    assert(legacy['timestamp_ns'] is None)
+
+    vital = Event("VITAL", "mystat", 1, "u", "a", 1,
+                  ["ERROR", "Some junk statistic", "12", "3"], 0)
+    assert(vital['vital_type'] == "ERROR")
+    assert(vital['values'] == ["12", "3"])
+    assert(vital['value'] == 12 and vital['delta'] == 3)
+    assert(vital['updates'] == 1)
+    assert('instance' not in vital)
+    labelled = Event("VITAL", "mystat/session-3", 1, "u", "a", 1,
+                     ["ERROR", "Some junk statistic", "1", "1", "1"], 0)
+    assert(labelled['instance'] == "session-3")
+    assert('value' in vital)
+    vital['contents'] = ["ERROR", "x", "1", "1"]
+    assert(vital['value'] == 1)
+    vital['contents'] = ["CRITICAL", "x", "5", "2", "2"]
+    assert(vital['updates'] == 2)
+    d = vital.to_dict()
+    assert(d['delta'] == 2 and d['name'] == "mystat")
+
+    # Typed binary payloads
+    ticks = Event("NUMERIC", "ticks", 1, "u", "a", 1,
+                  [numeric.encode(1.5), numeric.encode([1, 2, 3]), "7"], 0)
+    assert(ticks['contents'][0] == 1.5)
+    assert(list(ticks['contents'][1]) == [1, 2, 3])
+    assert(ticks['contents'][2] == "7")
+    if numeric.numpy is not None:
+        assert(list(ticks.as_numpy(1)) == [1, 2, 3])
+    print "test1() PASSED"
+
+
+def bench1():
+
+    # The old dict per event against Event objects: build the event
+    # and read the fields a typical callback reads.
+    import sys
+    import time
+
+    nr_events = 200000
+    msg = ["NUMERIC", "tick", "1357034400123456789", "sysadmin",
+           "benchapp", "42", "12.5"]
+
+    def old_parse(msg_list):
+        timestamp_ns = int(msg_list[2])
+        return {'type': msg_list[0],
+                'name': msg_list[1],
+                'timestamp': Timestamp.Format(timestamp_ns),
+                'timestamp_ns': timestamp_ns,
+                'user_name': msg_list[3],
+                'application_name': msg_list[4],
+                'sequence': int(msg_list[5]),
+                'contents': msg_list[6:]}
+
+    def new_parse(msg_list):
+        return Event(msg_list[0], msg_list[1], int(msg_list[2]),
+                     msg_list[3], msg_list[4], int(msg_list[5]),
+                     msg_list, 6)
+
+    def dict_style(event):
+        if event['type'] == "NUMERIC":
+            event['contents'][0]
+
+    def attributes(event):
+        if event.type == "NUMERIC":
+            event.contents[0]
+
+    results = []
+    for label, parse, read in [("dict", old_parse, dict_style),
+                               ("Event, event['key']", new_parse, dict_style),
+                               ("Event, event.key", new_parse, attributes)]:
+        start = time.time()
+        events = []
+        for i in xrange(nr_events):
+            event = parse(msg)
+            read(event)
+            events.append(event)
+        elapsed = time.time() - start
+
+        # The object and its contents list, the same way for both
+        event = events[0]
+        size = sys.getsizeof(event) + sys.getsizeof(event['contents'])
+        results.append((label, nr_events / elapsed, size))
+
+    for label, rate, size in results:
+        print "bench1() " + label + ": " + str(int(rate)) \
+              + " events/s, " + str(size) + " bytes/event"
+
+if __name__ == '__main__':
+    test1()
+    bench1()
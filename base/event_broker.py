@@ -0,0 +1,258 @@
+"""
+    EventBroker
+
+    Without a broker, every EventCollector opens a SUB connection to every
+    matching EventSource, so N sources and M collectors cost N x M
+    connections.  The broker subscribes to every EVENT source once, with a
+    single XSUB socket, and fans the events out to the collectors on an
+    XPUB socket, so the cost becomes N + M.
+
+    The broker advertises itself as the EVENT_BROKER service, with "*" as
+    its user and application name.  Collectors created with use_broker
+    connect to it instead of the individual sources, once discovered.
+
+    The topics are the event types, so the broker cannot filter by user:
+    every collector of the broker receives every user's events and drops
+    the ones it did not ask for.  Only trusted, system wide collectors
+    should use it.
+
+    Events are forwarded as-is, without being de-framed.  Subscriptions
+    from the collectors are forwarded upstream, so the sources still know
+    whether anyone is listening.
+"""
+import threading
+import time
+import zmq
+import zsocket
+import zhelpers
+import location
+import discovery
+import log
+
+
+class EventBroker(log.Logger):
+
+    port_range = [7000, 8000]
+    # Maximum messages forwarded per wake-up before checking the
+    # other sockets.
+    batch_size = 1024
+
+    class Stats():
+        def __init__(self):
+            self.rx_msgs = 0
+            self.rx_bytes = 0
+            self.tx_msgs = 0
+            self.subscriptions = 0
+            self.unsubscriptions = 0
+            self.sources = 0
+            # Messages found waiting per wake-up: the last one and
+            # the largest seen.
+            self.queue_depth = 0
+            self.max_queue_depth = 0
+
+    def __init__(self):
+        log.Logger.__init__(self)
+
+        self.stats = EventBroker.Stats()
+        self.last_rate_time = time.time()
+        self.last_rate_msgs = 0
+        self.last_rate_bytes = 0
+
+        self.upstream = zsocket.ZSocketMultiClient(zmq.XSUB, "tcp", "EVENT")
+        self.upstream.open()
+        self.downstream = zsocket.ZSocketServer(zmq.XPUB,
+                                                "tcp",
+                                                "*",
+                                                "EVENT",
+                                                self.port_range)
+        self.downstream.bind()
+
+        # Discovery callbacks run in the discovery thread.  Connects and
+        # disconnects are passed to the forwarding thread over the pipe,
+        # which is the only thread to touch the sockets.
+        self.pipe = zsocket.zpipe()
+        self.alive = True
+        self.thread = threading.Thread(target=self.__thread_entry)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.ip_addr = zhelpers.get_local_ipaddr()
+        self.location = location.create_location("tcp",
+                                                 self.ip_addr,
+                                                 self.downstream.port)
+        self.discovery = discovery.DiscoveryServer("*",
+                                                   "*",
+                                                   "EVENT_BROKER",
+                                                   self.location)
+        self.dc = discovery.DiscoveryClient(self.service_add,
+                                            self.service_remove)
+
+    def service_add(self, service):
+        if service.service_name != "EVENT":
+            return
+        self.log_info("Adding EVENT source: " + str(service))
+        self.pipe[0].send({'message':["CONNECT", service.location]})
+
+    def service_remove(self, service):
+        if service.service_name != "EVENT":
+            return
+        self.log_info("Removing EVENT source: " + str(service))
+        self.pipe[0].send({'message':["DISCONNECT", service.location]})
+
+    def __thread_entry(self):
+        poller = zmq.Poller()
+        poller.register(self.pipe[1].socket, zmq.POLLIN)
+        poller.register(self.upstream.socket, zmq.POLLIN)
+        poller.register(self.downstream.socket, zmq.POLLIN)
+
+        while self.alive is True:
+            items = dict(poller.poll(1000))
+            if self.pipe[1].socket in items:
+                self.__process_command()
+            if self.upstream.socket in items:
+                self.__forward_events()
+            if self.downstream.socket in items:
+                self.__forward_subscriptions()
+
+        self.upstream.close()
+        self.downstream.close()
+        self.pipe[0].close()
+        self.pipe[1].close()
+
+    def __process_command(self):
+        msg = self.pipe[1].recv()
+        if msg is None:
+            return
+
+        command = msg['message'][0]
+        if command == "CONNECT":
+            if msg['message'][1] in self.upstream.locations:
+                return
+            self.upstream.connect(msg['message'][1])
+            self.stats.sources = len(self.upstream.locations)
+        elif command == "DISCONNECT":
+            self.upstream.disconnect(msg['message'][1])
+            self.stats.sources = len(self.upstream.locations)
+        elif command == "KILL":
+            self.alive = False
+
+    def __forward_events(self):
+        nr_msgs = 0
+        while nr_msgs < self.batch_size:
+            try:
+                msg_str = self.upstream.recv_raw(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.downstream.send_raw(msg_str)
+            nr_msgs += 1
+            self.stats.rx_bytes += len(msg_str)
+
+        self.stats.rx_msgs += nr_msgs
+        self.stats.tx_msgs += nr_msgs
+        self.stats.queue_depth = nr_msgs
+        if nr_msgs > self.stats.max_queue_depth:
+            self.stats.max_queue_depth = nr_msgs
+
+    def __forward_subscriptions(self):
+        while True:
+            try:
+                msg_str = self.downstream.recv_raw(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if len(msg_str) > 0 and msg_str[0] == "\x01":
+                self.stats.subscriptions += 1
+            else:
+                self.stats.unsubscriptions += 1
+            self.upstream.send_raw(msg_str)
+
+    def get_rates(self):
+        # Return the counters along with the message and byte rates
+        # since the last call.
+        now = time.time()
+        elapsed = now - self.last_rate_time
+        msg_rate = 0.0
+        byte_rate = 0.0
+        if elapsed > 0:
+            msg_rate = (self.stats.rx_msgs - self.last_rate_msgs) / elapsed
+            byte_rate = (self.stats.rx_bytes - self.last_rate_bytes) / elapsed
+        self.last_rate_time = now
+        self.last_rate_msgs = self.stats.rx_msgs
+        self.last_rate_bytes = self.stats.rx_bytes
+        return {'rx_msgs': self.stats.rx_msgs,
+                'rx_bytes': self.stats.rx_bytes,
+                'tx_msgs': self.stats.tx_msgs,
+                'subscriptions': self.stats.subscriptions,
+                'unsubscriptions': self.stats.unsubscriptions,
+                'sources': self.stats.sources,
+                'queue_depth': self.stats.queue_depth,
+                'max_queue_depth': self.stats.max_queue_depth,
+                'msgs_per_sec': msg_rate,
+                'bytes_per_sec': byte_rate}
+
+    def close(self):
+        self.pipe[0].send({'message':["KILL"]})
+        self.dc.close()
+        self.discovery.close()
+
+
+def test1():
+
+    # Events reach a collector which asks for the broker through it, and
+    # the collector drops its direct connection to the source.  Other
+    # collectors keep to the sources.
+    import event_source
+    import event_collector
+    user_name = "sysadmin"
+    app_name = "brokertest"
+    discovery.DiscoveryServer.period = 1
+    event_source.EventSocket.startup_period = 1
+
+    broker = EventBroker()
+    source = event_source.EventSource("load", "VALUE", user_name, app_name)
+    other = event_source.EventSource("load", "VALUE", user_name, "other")
+
+    use_broker = True
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = event_collector.EventCollector(
+                                            ["*"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name,
+                                            use_broker=use_broker)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    use_broker = False
+    direct = MyTestClass()
+    time.sleep(4)
+    assert(mtc.collector.broker_socket is not None)
+    assert(direct.collector.broker_socket is None)
+    assert(len(mtc.collector.sources) == 1)
+    assert(broker.stats.sources >= 2)
+    assert(broker.stats.subscriptions > 0)
+
+    for i in range(10):
+        source.send([str(i)])
+        other.send([str(i)])
+    time.sleep(1)
+
+    # The other application's events go through the broker, but are
+    # filtered out by the collector.
+    assert([event['contents'][0] for event in mtc.events] ==
+                [str(i) for i in range(10)])
+    assert([event['contents'][0] for event in direct.events] ==
+                [str(i) for i in range(10)])
+    rates = broker.get_rates()
+    assert(rates['rx_msgs'] >= 20)
+    assert(rates['tx_msgs'] == rates['rx_msgs'])
+    assert(rates['max_queue_depth'] > 0)
+    print "test1() PASSED"
+
+
+if __name__ == '__main__':
+    test1()
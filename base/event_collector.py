@@ -1,5 +1,44 @@
 """
     EventCollector
+
+    Discovers EVENT sources and subscribes to the ones matching the
+    user/application filters.
+
+    With replay enabled, the collector also asks each matching source for
+    the recent events in its replay buffer (see event_source.py), so events
+    sent before the source was discovered are not missed.  Replayed events
+    are marked with event['replayed'] = True.  Events seen both live and
+    in the replay are only delivered once, using the sequence numbers.
+    The REPLAY and REPLAY_END event types are reserved.
+
+    Events are delivered as Event objects (see event.py), which also
+    support dict-style access.
+
+    The collector tracks the sequence numbers of each event type of each
+    source, identified by (user, app, epoch, type), and counts the events
+    lost in the gaps (see get_loss_stats()).  Sources number each event
+    type apart, so the types a collector does not subscribe to do not
+    show up as gaps.  With replay_gaps enabled, the collector asks the
+    source to replay each missing range of the type from its replay
+    buffer.  Events recovered this way arrive out of order, marked as
+    replayed.
+
+    With use_broker, a collector which discovers an EVENT_BROKER (see
+    event_broker.py) subscribes to the broker instead of to each source.
+    The broker carries the events of every user and application, so the
+    user/application filters are applied to the events themselves, after
+    they have crossed the wire.  This is opt-in: a collector of one user
+    would otherwise receive every other user's events.  If the broker goes
+    away, the collector falls back to the sources directly.
+
+    The event_cback is called on the Interface thread, which also drains
+    the sockets.  For slow callbacks, give the collector workers: events
+    are then handed to an EventDispatcher (see event_dispatch.py) and the
+    callbacks run on its worker threads, in order per (user, app, name).
+    When the workers fall behind and their queues fill, events are
+    dropped and counted in the dispatcher stats; with dispatch_block=True
+    the Interface thread waits for the workers instead, which pushes the
+    backlog onto the sockets.
 """
 import zsocket
 import zhelpers
@@ -8,17 +47,128 @@ import zmq
 import time
 import location
 import discovery
+import event_source
 import types
 import system
+import event_dispatch
+from timestamp import Timestamp
+from event import Event
 from local_log import *
 
 
+class SequenceTracker(object):
+
+    """
+        Sequence numbers seen of one event type from one source
+        (user, app, epoch, type).
+    """
+    # Number of missing ranges remembered for recovery
+    max_gaps = 100
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.first = None
+        self.last = None
+        self.last_replay = 0
+        self.received = 0
+        self.lost = 0
+        self.recovered = 0
+        self.duplicates = 0
+        self.missing = []
+
+    def live(self, sequence):
+        # Returns (accepted, gap), where gap is the (first, last) range
+        # found missing by this event, or None.
+        if self.first is None:
+            if sequence <= self.last_replay:
+                # We already have this one from the replay
+                self.duplicates += 1
+                return (False, None)
+            self.first = sequence
+            self.last = sequence
+            if self.last_replay > 0 and sequence > self.last_replay + 1:
+                return self.__gap(self.last_replay + 1, sequence - 1)
+            self.received += 1
+            return (True, None)
+
+        if sequence == self.last + 1:
+            self.last = sequence
+            self.received += 1
+            return (True, None)
+        if sequence > self.last + 1:
+            gap_first = self.last + 1
+            self.last = sequence
+            return self.__gap(gap_first, sequence - 1)
+        if self.__fill(sequence) is True:
+            # Late, rather than lost
+            self.lost -= 1
+            self.received += 1
+            return (True, None)
+        self.duplicates += 1
+        return (False, None)
+
+    def __gap(self, first, last):
+        self.lost += last - first + 1
+        self.received += 1
+        self.missing.append([first, last])
+        if len(self.missing) > self.max_gaps:
+            self.missing.pop(0)
+        return (True, (first, last))
+
+    def __fill(self, sequence):
+        for gap in self.missing:
+            if sequence >= gap[0] and sequence <= gap[1]:
+                if gap[0] == gap[1]:
+                    self.missing.remove(gap)
+                elif sequence == gap[0]:
+                    gap[0] += 1
+                elif sequence == gap[1]:
+                    gap[1] -= 1
+                else:
+                    index = self.missing.index(gap)
+                    self.missing.insert(index + 1, [sequence + 1, gap[1]])
+                    gap[1] = sequence - 1
+                return True
+        return False
+
+    def replayed(self, sequence):
+        # Returns True if the replayed event is new to us.
+        if self.first is None or sequence < self.first:
+            # Sent before we started listening
+            if sequence <= self.last_replay:
+                self.duplicates += 1
+                return False
+            self.last_replay = sequence
+            return True
+        if self.__fill(sequence) is True:
+            self.lost -= 1
+            self.recovered += 1
+            return True
+        self.duplicates += 1
+        return False
+
+    def loss_rate(self):
+        total = self.received + self.lost
+        if total == 0:
+            return 0.0
+        return float(self.lost) / total
+
+
 class EventCollector():
 
     def __init__(self, event_types,
                        event_cback,
                        user_name="",
-                       application_name=""):
+                       application_name="",
+                       replay=False,
+                       use_broker=False,
+                       workers=0,
+                       queue_size=10000,
+                       dispatch_block=False,
+                       replay_gaps=False,
+                       discovery_cache=None):
+        # discovery_cache is a file to keep the discovered sources in
+        # across restarts, see discovery.DiscoveryClient.
         assert(event_cback is not None)
         assert(isinstance(event_cback, types.FunctionType) or
                isinstance(event_cback, types.MethodType))
@@ -28,68 +178,253 @@ class EventCollector():
         self.user_name = user_name
         self.application_name = application_name
         self.event_cback = event_cback
+        self.dispatcher = None
+        if workers > 0:
+            self.dispatcher = event_dispatch.EventDispatcher(event_cback,
+                                                             workers,
+                                                             queue_size,
+                                                             dispatch_block)
+            self.event_cback = self.dispatcher.dispatch
+        self.replay = replay
+        self.replay_sockets = {}
+        self.use_broker = use_broker
+        self.broker_socket = None
+        # Matching EVENT sources, by location.  Only subscribed to
+        # directly while there is no broker.
+        self.sources = {}
+        self.replay_gaps = replay_gaps
+        # (user_name, application_name) -> EVENT_REPLAY service
+        self.replay_services = {}
+        # (user_name, application_name, epoch, event type) ->
+        # SequenceTracker
+        self.trackers = {}
+        self.last_loss_time = time.time()
+        self.last_loss_count = 0
 
         self.interface = interface.Interface(self.msg_cback)
         self.dc = discovery.DiscoveryClient(self.service_add,
-                                            self.service_remove)
+                                            self.service_remove,
+                                            discovery_cache)
+        # Ask for the sources rather than waiting for their beacons.
+        self.dc.query(user_name or "*", application_name or "*", "EVENT*")
 
     @staticmethod
     def event_msg_parse(msg):
+        # Returns the list of events carried by the message, or None
+        # if the message is malformed.  Batched messages are unpacked
+        # into one event per batch entry.
         msg_list = msg['message']
-        if len(msg_list) < 5:
+        if len(msg_list) < 6:
             Llog.LogError(
-                "Invalid/short message received! (" + len(msg_list) +")")
+                "Invalid/short message received! ("
+                + str(len(msg_list)) + ")")
+            return None
+
+        try:
+            sequence, epoch = EventCollector.sequence_parse(msg_list[5])
+        except ValueError:
+            Llog.LogError("Invalid sequence number: " + msg_list[5])
             return None
 
-        event = {'type': msg_list[0],
-                 'name': msg_list[1],
-                 'timestamp': msg_list[2],
-                 'user_name': msg_list[3],
-                 'application_name': msg_list[4],
-                 'contents': msg_list[5:]}
-        return event
+        if msg_list[2] == event_source.BATCH_MARKER:
+            return EventCollector.batch_msg_parse(msg_list, sequence, epoch)
+
+        timestamp, timestamp_ns = \
+            EventCollector.timestamp_parse(msg_list[2])
+        return [Event(msg_list[0],
+                      msg_list[1],
+                      timestamp_ns,
+                      msg_list[3],
+                      msg_list[4],
+                      sequence,
+                      msg_list,
+                      6,
+                      timestamp=timestamp,
+                      epoch=epoch)]
+
+    @staticmethod
+    def sequence_parse(field):
+        # "<sequence>:<epoch>".  Older sources send no epoch.
+        sequence, sep, epoch = field.partition(":")
+        return (int(sequence), epoch)
+
+    @staticmethod
+    def timestamp_parse(timestamp):
+        # Returns the display text and the epoch ns of a wire timestamp.
+        # The text is left for the Event to format, if anyone asks.
+        # Sources which still send text timestamps get None for the ns.
+        try:
+            timestamp_ns = int(timestamp)
+        except ValueError:
+            return (timestamp, None)
+        return (None, timestamp_ns)
+
+    @staticmethod
+    def batch_msg_parse(msg_list, sequence, epoch=""):
+        try:
+            nr_events = int(msg_list[6])
+            events = []
+            i = 7
+            while len(events) < nr_events:
+                nr_contents = int(msg_list[i + 1])
+                if i + 2 + nr_contents > len(msg_list):
+                    raise ValueError("truncated batch")
+                timestamp, timestamp_ns = \
+                    EventCollector.timestamp_parse(msg_list[i])
+                events.append(Event(msg_list[0],
+                                    msg_list[1],
+                                    timestamp_ns,
+                                    msg_list[3],
+                                    msg_list[4],
+                                    sequence,
+                                    msg_list,
+                                    i + 2,
+                                    i + 2 + nr_contents,
+                                    timestamp,
+                                    epoch))
+                i += 2 + nr_contents
+        except (ValueError, IndexError):
+            Llog.LogError("Invalid batch message received!")
+            return None
+        return events
 
     def msg_cback(self, msg):
-        event = EventCollector.event_msg_parse(msg)
-        if event is None:
+        msg_list = msg['message']
+        replayed = False
+        if len(msg_list) > 0:
+            if msg_list[0] == "REPLAY_END":
+                self.__replay_end(msg_list)
+                return
+            if msg_list[0] == "REPLAY":
+                replayed = True
+                msg = {'message':msg_list[1:]}
+
+        events = EventCollector.event_msg_parse(msg)
+        if events is None:
             Llog.LogError("Could not parse event message!: " + str(msg))
             return
-        if event['type'] not in self.event_types:
+        if len(events) == 0:
+            return
+        if self.__event_match(events[0]) is False:
+            # Another user's events, received through the broker
+            return
+        if "*" not in self.event_types and \
+           events[0].type not in self.event_types:
+            # Matched one of our subscriptions as a prefix only
             return
-        self.event_cback(event)
 
-    def service_add(self, service):
-        # We have received a service location broadcast
-        # message.  We now have to decide whether it is
-        # an EVENT service, and if we would like to subscribe
-        # to it, given our username and app_name settings.
-        # If we have an empty username and/or appname, we
-        # will subscribe to every EVENT service.
-        if service.service_name != "EVENT":
+        # All the events of a message share the type and sequence number
+        key = (events[0].user_name, events[0].application_name,
+               events[0].epoch, events[0].type)
+        tracker = self.trackers.get(key)
+        if tracker is None:
+            tracker = SequenceTracker(key[2])
+            self.trackers[key] = tracker
+        if replayed is True:
+            if tracker.replayed(events[0].sequence) is False:
+                return
+        else:
+            accepted, gap = tracker.live(events[0].sequence)
+            if accepted is False:
+                return
+            if gap is not None:
+                self.__gap(key, gap)
+
+        for event in events:
+            if replayed is True:
+                event['replayed'] = True
+            self.event_cback(event)
+
+    def __gap(self, key, gap):
+        Llog.LogDebug("Lost events " + str(gap[0]) + "-" + str(gap[1])
+                      + " from " + ":".join(key))
+        if self.replay_gaps is False:
+            return
+        service = self.replay_services.get(key[:2])
+        if service is None:
             return
+        self.__request_replay(service,
+                              ["REPLAY_RANGE", str(gap[0]), str(gap[1])],
+                              [key[3]])
+
+    def get_loss_stats(self):
+        # Per source received/lost counts, along with the totals and the
+        # events lost per second since the last call.
+        sources = {}
+        received = 0
+        lost = 0
+        for key, tracker in self.trackers.items():
+            sources[key] = {'received': tracker.received,
+                            'lost': tracker.lost,
+                            'recovered': tracker.recovered,
+                            'duplicates': tracker.duplicates,
+                            'loss_rate': tracker.loss_rate(),
+                            'missing': [tuple(gap)
+                                        for gap in tracker.missing]}
+            received += tracker.received
+            lost += tracker.lost
+
+        now = time.time()
+        elapsed = now - self.last_loss_time
+        lost_per_sec = 0.0
+        if elapsed > 0:
+            lost_per_sec = (lost - self.last_loss_count) / elapsed
+        self.last_loss_time = now
+        self.last_loss_count = lost
+
+        loss_rate = 0.0
+        if received + lost > 0:
+            loss_rate = float(lost) / (received + lost)
+        return {'received': received,
+                'lost': lost,
+                'loss_rate': loss_rate,
+                'lost_per_sec': lost_per_sec,
+                'sources': sources}
 
+    def __replay_end(self, msg_list):
+        # The replay is complete.  We have no further use for the
+        # replay socket.
+        if len(msg_list) != 4:
+            Llog.LogError("Invalid REPLAY_END: " + str(msg_list))
+            return
+        key = (msg_list[2], msg_list[3])
+        Llog.LogDebug("Replayed " + msg_list[1] + " events from "
+                      + ":".join(key))
+        zsock = self.replay_sockets.pop(key, None)
+        if zsock is not None:
+            self.interface.remove_socket(zsock)
+
+    def __service_match(self, service):
+        return self.__name_match(service.user_name,
+                                 service.application_name)
+
+    def __event_match(self, event):
+        return self.__name_match(event.user_name,
+                                 event.application_name)
+
+    def __name_match(self, user_name, application_name):
+        # If we have an empty username and/or appname, we
+        # match every service.
         if self.user_name != "":
             # We have been configured with a non-empty username.
             # Only subscribe to the service if it matches.
-            if service.user_name != self.user_name:
-                return
+            if user_name != self.user_name:
+                return False
 
         if self.application_name != "":
             # We have been configured with a non-empty appname.
             # Only subscribe to the service if it matches.
-            if service.application_name != self.application_name:
-                return
+            if application_name != self.application_name:
+                return False
+        return True
 
-        # We have found a matching service.  We must now get
-        # the location of this service and open up a SUB socket
-        # to it.  Once open, we must subscribe to the events
-        # of interest.
-        Llog.LogInfo("Subscribing to EVENT source: " + str(service))
-
-        addr_info = location.parse_location(service.location)
+    def __subscribe(self, service_location):
+        # Open up a SUB socket to an EVENT source or broker and
+        # subscribe to the events of interest.
+        addr_info = location.parse_location(service_location)
         if addr_info is None:
-            Llog.LogError("Invalid location: " + service.location)
-            return
+            Llog.LogError("Invalid location: " + service_location)
+            return None
 
         zsock = zsocket.ZSocketClient(zmq.SUB,
                                       "tcp",
@@ -105,15 +440,130 @@ class EventCollector():
                 zsock.subscribe("")
             else:
                 zsock.subscribe(str(event_type))
+        return zsock
+
+    def __unsubscribe(self, service_location):
+        zsock = self.interface.find_socket_by_location(service_location)
+        if zsock is None:
+            Llog.LogError("Cannot find zsocket: " + service_location)
+            return
+        self.interface.remove_socket(zsock)
+
+    def __broker_add(self, service):
+        if self.use_broker is False or self.broker_socket is not None:
+            return
+
+        Llog.LogInfo("Subscribing to EVENT broker: " + str(service))
+        self.broker_socket = self.__subscribe(service.location)
+        if self.broker_socket is None:
+            return
+        # Everything now comes through the broker.
+        for service_location in self.sources.keys():
+            self.__unsubscribe(service_location)
+
+    def __broker_remove(self, service):
+        if self.broker_socket is None or \
+           self.broker_socket.location != service.location:
+            return
+
+        Llog.LogInfo("Lost EVENT broker: " + str(service))
+        self.interface.remove_socket(self.broker_socket)
+        self.broker_socket = None
+        for service_location in self.sources.keys():
+            self.__subscribe(service_location)
+
+    def __request_replay(self, service, request=["REPLAY"],
+                         event_types=None):
+        # Only one replay request per source at a time.  Gaps found while
+        # one is running stay missing.  event_types defaults to the types
+        # we subscribe to.
+        key = (service.user_name, service.application_name)
+        if key in self.replay_sockets:
+            return
+
+        addr_info = location.parse_location(service.location)
+        if addr_info is None:
+            Llog.LogError("Invalid location: " + service.location)
+            return
+
+        Llog.LogInfo("Requesting replay from: " + str(service))
+        zsock = zsocket.ZSocketClient(zmq.DEALER,
+                                      "tcp",
+                                      addr_info['address'],
+                                      "EVENT_REPLAY",
+                                      addr_info['port'])
+        zsock.connect()
+        # Send the request before handing the socket to the interface
+        # thread.  From then on, only the interface thread uses it.
+        if event_types is None:
+            event_types = self.event_types
+        zsock.send({'message':request
+                              + [str(event_type)
+                                 for event_type in event_types]})
+        self.replay_sockets[key] = zsock
+        self.interface.add_socket(zsock)
+
+    def service_add(self, service):
+        # We have received a service location broadcast
+        # message.  We now have to decide whether it is
+        # an EVENT service, and if we would like to subscribe
+        # to it, given our username and app_name settings.
+        if service.service_name == "EVENT_REPLAY":
+            if self.__service_match(service) is False:
+                return
+            self.replay_services[(service.user_name,
+                                  service.application_name)] = service
+            if self.replay is True:
+                self.__request_replay(service)
+            return
+
+        if service.service_name == "EVENT_BROKER":
+            self.__broker_add(service)
+            return
+
+        if service.service_name != "EVENT":
+            return
+
+        if self.__service_match(service) is False:
+            return
+
+        self.sources[service.location] = service
+        if self.broker_socket is not None:
+            # The broker already carries this source's events.
+            return
+
+        # We have found a matching service.  We must now get
+        # the location of this service and open up a SUB socket
+        # to it.  Once open, we must subscribe to the events
+        # of interest.
+        Llog.LogInfo("Subscribing to EVENT source: " + str(service))
+        self.__subscribe(service.location)
 
     def service_remove(self, service):
-        zsocket = self.interface.find_socket_by_location(service.location)
-        if zsocket is None:
-            Llog.LogError("Cannot find zsocket: " + service.location)
+        key = (service.user_name, service.application_name)
+        if service.service_name == "EVENT_REPLAY":
+            self.replay_services.pop(key, None)
+            zsock = self.replay_sockets.pop(key, None)
+            if zsock is not None:
+                self.interface.remove_socket(zsock)
             return
 
-        self.interface.remove_socket(zsocket)
-        zsocket.close()
+        if service.service_name == "EVENT_BROKER":
+            self.__broker_remove(service)
+            return
+
+        if service.service_name != "EVENT" or \
+           service.location not in self.sources:
+            return
+
+        # A new instance of the source has a new epoch
+        for tracker_key in self.trackers.keys():
+            if tracker_key[:3] == key + (str(service.uuid),):
+                del self.trackers[tracker_key]
+
+        del self.sources[service.location]
+        if self.broker_socket is None:
+            self.__unsubscribe(service.location)
 
 
 def test1():
@@ -121,24 +571,25 @@ def test1():
     user_name = "ddoucette"
     app_name = "mytestapp2"
     module_name = "event"
-    source = EventSource("VALUE", "utilization", user_name, app_name)
+    source = event_source.EventSource("utilization", "VALUE", user_name,
+                                      app_name)
 
     class MyTestClass():
         def __init__(self, user_name, app_name):
             self.got_message = False
             self.user_name = user_name
             self.app_name = app_name
-            collector = EventCollector("VALUE",
-                                       self.event_rcv_cback,
-                                       user_name,
-                                       app_name)
+            self.collector = EventCollector(["VALUE"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name)
 
         def event_rcv_cback(self, event):
             assert(event['type'] == "VALUE")
             Llog.LogDebug("Got event: "
                           + event['type']
                           + " "
-                          + event['contents'])
+                          + " ".join(event['contents']))
             self.got_message = True
 
     mtc = MyTestClass(user_name, app_name)
@@ -148,14 +599,300 @@ def test1():
     time.sleep(15)
 
     # Now send an event and wait a second to let the collector receive it
-    source.send(12)
+    source.send(["12"])
     time.sleep(1)
 
     assert(mtc.got_message is True)
-    print "PASSED"
+    print "test1() PASSED"
 
 
-if __name__ == '__main__':
+def test2():
+
+    # Batched events are unpacked by the collector, in order.
+    user_name = "sysadmin"
+    app_name = "batchtest"
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = EventCollector(["NUMERIC"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    source = event_source.EventSource("tick", "NUMERIC", user_name, app_name)
+    source.enable_batching(max_events=5, max_delay=0.5)
+    time.sleep(1)
+
+    for i in range(12):
+        source.send([str(i), "x" * i])
+    time.sleep(0.1)
+    # Two full batches have been sent.  The last 2 events wait for
+    # the flush timer.
+    assert(len(mtc.events) == 10)
+    assert(mtc.events[0]['sequence'] == mtc.events[4]['sequence'])
+    assert(mtc.events[5]['sequence'] == mtc.events[4]['sequence'] + 1)
+    time.sleep(1)
+
+    assert(len(mtc.events) == 12)
+    for i, event in enumerate(mtc.events):
+        assert(event['name'] == "tick")
+        assert(event['contents'] == [str(i), "x" * i])
+        if i > 0:
+            assert(event['timestamp_ns'] >= mtc.events[i - 1]['timestamp_ns'])
+    print "test2() PASSED"
+
+
+def test3():
+
+    # A late collector gets the events sent before it subscribed from
+    # the replay buffer, then the live events, without duplicates.
+    user_name = "sysadmin"
+    app_name = "replaytest"
+    discovery.DiscoveryServer.period = 1
+    event_source.EventSocket.startup_period = 1
+
+    source = event_source.EventSource("run", "STATE", user_name, app_name)
+    for i in range(5):
+        source.send([str(i)])
+    # Let the startup period expire.  Nobody has heard these events.
+    time.sleep(2)
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = EventCollector(["STATE"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name,
+                                            replay=True)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    time.sleep(3)
+    assert(len(mtc.events) == 5)
+    assert(mtc.events[0]['replayed'] is True)
+    assert(len(mtc.collector.replay_sockets) == 0)
+
+    for i in range(5, 8):
+        source.send([str(i)])
+    time.sleep(1)
+
+    assert([event['contents'][0] for event in mtc.events] ==
+                [str(i) for i in range(8)])
+    assert('replayed' not in mtc.events[-1])
+    print "test3() PASSED"
 
-    from event_source import *
+
+def test4():
+
+    # Slow callbacks on the worker pool do not hold up the collector.
+    user_name = "sysadmin"
+    app_name = "workertest"
+    discovery.DiscoveryServer.period = 1
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = EventCollector(["NUMERIC"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name,
+                                            workers=2)
+
+        def event_rcv_cback(self, event):
+            time.sleep(0.05)
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    source = event_source.EventSource("tick", "NUMERIC", user_name, app_name)
+    time.sleep(3)
+
+    for i in range(20):
+        source.send([str(i)])
+    time.sleep(0.2)
+    # All received, most still queued
+    stats = mtc.collector.dispatcher.get_stats()
+    assert(stats['queued'] == 20)
+    assert(stats['queue_depth_now'] > 10)
+    time.sleep(1.5)
+
+    assert([event['contents'][0] for event in mtc.events] ==
+                [str(i) for i in range(20)])
+    stats = mtc.collector.dispatcher.get_stats()
+    assert(stats['callback_latency']['p50'] >= 32768)
+    print "test4() PASSED"
+
+
+def test5():
+
+    # Typed binary NUMERIC payloads, plain and batched, come out as
+    # numbers and arrays.
+    import array
+    user_name = "sysadmin"
+    app_name = "numerictest"
+    discovery.DiscoveryServer.period = 1
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = EventCollector(["NUMERIC"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    source = event_source.EventSource("tick", "NUMERIC", user_name, app_name)
+    batched = event_source.EventSource("samples", "NUMERIC",
+                                       user_name, app_name)
+    batched.enable_batching(max_events=2)
+    time.sleep(3)
+
+    source.send_numeric(12.5, 7)
+    samples = [i * 0.25 for i in range(1000)]
+    batched.send_numeric(samples)
+    batched.send_numeric(range(5))
+    time.sleep(1)
+
+    assert(len(mtc.events) == 3)
+    assert(mtc.events[0]['contents'] == [12.5, 7])
+    assert(isinstance(mtc.events[1]['contents'][0], array.array))
+    assert(list(mtc.events[1]['contents'][0]) == samples)
+    assert(list(mtc.events[2]['contents'][0]) == range(5))
+    print "test5() PASSED"
+
+
+def test6():
+
+    tracker = SequenceTracker("epoch")
+    assert(tracker.live(1) == (True, None))
+    assert(tracker.live(2) == (True, None))
+    assert(tracker.live(6) == (True, (3, 5)))
+    assert(tracker.live(6) == (False, None))
+    assert(tracker.lost == 3 and tracker.missing == [[3, 5]])
+    # Late, rather than lost
+    assert(tracker.live(4) == (True, None))
+    assert(tracker.missing == [[3, 3], [5, 5]])
+    assert(tracker.replayed(3) is True)
+    assert(tracker.replayed(3) is False)
+    assert(tracker.lost == 1 and tracker.recovered == 1)
+    assert(tracker.received == 4 and tracker.duplicates == 2)
+    assert(abs(tracker.loss_rate() - 0.2) < 1e-9)
+
+    # Events lost on the wire are counted, and recovered from the
+    # source's replay buffer.
+    user_name = "sysadmin"
+    app_name = "gaptest"
+    discovery.DiscoveryServer.period = 1
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = EventCollector(["TEST"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name,
+                                            replay=False,
+                                            replay_gaps=True)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    source = event_source.EventSource("gap", "TEST", user_name, app_name)
+    time.sleep(3)
+
+    source.send(["1"])
+    time.sleep(0.5)
+    # Drop the next events on the floor, as if lost on the wire
+    socket = source.socket
+    socket.lock.acquire()
+    subscriptions = socket.subscriptions
+    socket.subscriptions = 0
+    socket.lock.release()
+    source.send(["2"])
+    source.send(["3"])
+    socket.lock.acquire()
+    socket.subscriptions = subscriptions
+    socket.lock.release()
+    source.send(["4"])
+    time.sleep(1)
+
+    assert([event['contents'][0] for event in mtc.events] == \
+           ["1", "4", "2", "3"])
+    assert(mtc.events[2]['replayed'] is True)
+    assert(mtc.events[0]['epoch'] == socket.epoch)
+    stats = mtc.collector.get_loss_stats()
+    source_stats = stats['sources'][(user_name, app_name, socket.epoch,
+                                     "TEST")]
+    assert(source_stats['recovered'] == 2)
+    assert(source_stats['lost'] == 0 and source_stats['missing'] == [])
+    assert(stats['received'] == 2 and stats['loss_rate'] == 0.0)
+
+    # A collector of one of two types sees no loss from the other type,
+    # and only has its own type replayed.
+    app_name = "typegaptest"
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = EventCollector(["ONE"],
+                                            self.event_rcv_cback,
+                                            user_name,
+                                            app_name,
+                                            replay_gaps=True)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    one = event_source.EventSource("one", "ONE", user_name, app_name)
+    two = event_source.EventSource("two", "TWO", user_name, app_name)
+    time.sleep(3)
+
+    for i in range(5):
+        one.send([str(i)])
+        two.send([str(i)])
+    time.sleep(0.5)
+    stats = mtc.collector.get_loss_stats()
+    assert(stats['received'] == 5 and stats['lost'] == 0)
+    assert(stats['sources'].keys() == [(user_name, app_name,
+                                        one.socket.epoch, "ONE")])
+
+    socket = one.socket
+    socket.lock.acquire()
+    subscriptions = socket.subscriptions
+    socket.subscriptions = 0
+    socket.lock.release()
+    one.send(["5"])
+    two.send(["5"])
+    socket.lock.acquire()
+    socket.subscriptions = subscriptions
+    socket.lock.release()
+    one.send(["6"])
+    time.sleep(1)
+
+    assert([event['type'] for event in mtc.events] == ["ONE"] * 7)
+    assert([event['contents'][0] for event in mtc.events[5:]] ==
+           ["6", "5"])
+    stats = mtc.collector.get_loss_stats()
+    assert(stats['lost'] == 0)
+    print "test6() PASSED"
+
+
+if __name__ == '__main__':
     test1()
+    test2()
+    test3()
+    test4()
+    test5()
+    test6()
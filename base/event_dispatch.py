@@ -0,0 +1,258 @@
+"""
+    EventDispatcher
+
+    Runs event callbacks on a pool of worker threads, so a slow callback
+    (e.g. one writing to a database) does not hold up the Interface
+    thread draining the sockets.
+
+    Each event is queued to one worker, chosen by hashing the event's
+    (user, app, name) key, so the events of a key are delivered in order
+    while different keys are processed in parallel.  The worker queues are
+    bounded.  When a queue is full, the event is dropped and counted, by
+    default.  With block=True the Interface thread waits for room
+    instead; no event is dropped here, but the sockets stop being
+    drained, and events back up to the ZMQ high water mark, where they
+    are dropped unseen.
+
+    The queue depth seen by each event, and the time each callback takes,
+    are kept in Histograms.
+"""
+import threading
+import Queue
+import time
+import types
+import stats
+from local_log import *
+
+
+class Histogram(object):
+
+    """
+        Power of two buckets.  Bucket i counts the values v with
+        2^(i-1) <= v < 2^i, bucket 0 counts the values below 1.
+    """
+
+    nr_buckets = 32
+
+    def __init__(self, unit=""):
+        self.unit = unit
+        self.buckets = [0] * self.nr_buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        bucket = 0
+        if value >= 1:
+            bucket = min(int(value).bit_length(), self.nr_buckets - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p'th percentile
+        if self.count == 0:
+            return 0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                return 1 << bucket
+        return 1 << (self.nr_buckets - 1)
+
+    def snapshot(self):
+        return {'unit': self.unit,
+                'count': self.count,
+                'mean': self.total / max(self.count, 1),
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': dict([(1 << bucket, count)
+                                 for bucket, count in enumerate(self.buckets)
+                                 if count > 0])}
+
+
+class EventDispatcher(object):
+
+    class Stats():
+        def __init__(self):
+            self.queued = 0
+            self.dispatched = 0
+            self.dropped = 0
+            self.errors = 0
+            self.queue_depth = Histogram("events")
+            self.callback_latency = Histogram("us")
+
+    def __init__(self, event_cback, nr_workers=4, queue_size=10000,
+                 block=False):
+        assert(isinstance(event_cback, types.FunctionType) or
+               isinstance(event_cback, types.MethodType))
+        assert(nr_workers > 0)
+        assert(queue_size >= nr_workers)
+
+        self.event_cback = event_cback
+        self.block = block
+        self.stats = EventDispatcher.Stats()
+        # The histograms are updated from all the threads
+        self.lock = threading.Lock()
+        self.alive = True
+
+        self.queues = []
+        self.workers = []
+        for i in range(nr_workers):
+            q = Queue.Queue(queue_size // nr_workers)
+            worker = threading.Thread(target=self.__worker_entry, args=(q,))
+            worker.daemon = True
+            self.queues.append(q)
+            self.workers.append(worker)
+            worker.start()
+        stats.StatsRegistry.Register("dispatcher", self)
+
+    @staticmethod
+    def event_key(event):
+        return (event['user_name'], event['application_name'], event['name'])
+
+    def dispatch(self, event):
+        # Pass this method to the EventCollector as its event_cback.
+        q = self.queues[hash(EventDispatcher.event_key(event))
+                        % len(self.queues)]
+        depth = q.qsize()
+        try:
+            q.put(event, self.block)
+        except Queue.Full:
+            self.lock.acquire()
+            self.stats.dropped += 1
+            self.lock.release()
+            return
+
+        self.lock.acquire()
+        self.stats.queued += 1
+        self.stats.queue_depth.add(depth)
+        self.lock.release()
+
+    def __worker_entry(self, q):
+        while True:
+            event = q.get()
+            if event is None:
+                # close()
+                return
+
+            start = time.time()
+            try:
+                self.event_cback(event)
+            except Exception as e:
+                Llog.LogError("Event callback failed: " + str(e))
+                self.lock.acquire()
+                self.stats.errors += 1
+                self.lock.release()
+            elapsed_us = (time.time() - start) * 1000000
+
+            self.lock.acquire()
+            self.stats.dispatched += 1
+            self.stats.callback_latency.add(elapsed_us)
+            self.lock.release()
+
+    def queue_depth(self):
+        return sum([q.qsize() for q in self.queues])
+
+    def stats_extra(self):
+        return {'queue_depth': self.queue_depth()}
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {'queued': self.stats.queued,
+                    'dispatched': self.stats.dispatched,
+                    'dropped': self.stats.dropped,
+                    'errors': self.stats.errors,
+                    'queue_depth_now': self.queue_depth(),
+                    'queue_depth': self.stats.queue_depth.snapshot(),
+                    'callback_latency':
+                        self.stats.callback_latency.snapshot()}
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # Let the workers finish what is queued, then stop them.
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def test1():
+
+    h = Histogram()
+    for value in [0, 0.5, 1, 3, 3, 100, 1000]:
+        h.add(value)
+    assert(h.buckets[0] == 2)
+    assert(h.buckets[1] == 1)
+    assert(h.buckets[2] == 2)
+    assert(h.percentile(50) == 4)
+    assert(h.percentile(100) == 1024)
+    assert(h.snapshot()['max'] == 1000)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # Slow callbacks run in parallel across keys, in order per key.
+    received = {}
+    lock = threading.Lock()
+
+    def event_cback(event):
+        time.sleep(0.01)
+        lock.acquire()
+        received.setdefault(event['name'], []).append(event['sequence'])
+        lock.release()
+
+    dispatcher = EventDispatcher(event_cback, nr_workers=4)
+    start = time.time()
+    for i in range(20):
+        for name in ["a", "b", "c", "d", "e", "f", "g", "h"]:
+            dispatcher.dispatch({'user_name': "sysadmin",
+                                 'application_name': "dispatchtest",
+                                 'name': name,
+                                 'sequence': i})
+    # Dispatching does not wait for the callbacks
+    assert(time.time() - start < 0.5)
+    dispatcher.close()
+
+    for name, sequences in received.iteritems():
+        assert(sequences == range(20))
+    stats = dispatcher.get_stats()
+    assert(stats['dispatched'] == 160)
+    assert(stats['callback_latency']['p50'] >= 8192)
+    assert(stats['queue_depth']['max'] > 0)
+    print "test2() PASSED"
+
+
+def test3():
+
+    # Full queue, without blocking
+    gate = threading.Event()
+
+    def event_cback(event):
+        gate.wait()
+
+    dispatcher = EventDispatcher(event_cback, nr_workers=1, queue_size=2,
+                                 block=False)
+    for i in range(5):
+        dispatcher.dispatch({'user_name': "u",
+                             'application_name': "a",
+                             'name': "n"})
+    # One is being processed, 2 are queued
+    assert(dispatcher.stats.dropped >= 2)
+    gate.set()
+    dispatcher.close()
+    assert(dispatcher.stats.dispatched + dispatcher.stats.dropped == 5)
+    print "test3() PASSED"
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
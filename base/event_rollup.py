@@ -0,0 +1,486 @@
+"""
+    Windowed rollups of NUMERIC and VITAL events.
+
+    Most consumers of NUMERIC and VITAL events only want per-second or
+    per-minute aggregates.  The RollupAggregator sits between an
+    EventCollector (or VitalEventCollector) and the consumer, and turns
+    the raw events into one ROLLUP event per (user, app, name) per window:
+
+        count, min, max, mean and the configured percentiles
+
+    Windows are either tumbling (slide == window) or sliding (the window
+    is a multiple of the slide, and a rollup of the last window is emitted
+    every slide).  Internally, each key keeps one pane per slide interval;
+    a sliding window is the merge of its panes.
+
+    Percentiles come from a QuantileSketch: a log-bucketed histogram with
+    a bounded number of buckets, so memory per pane is constant however
+    many events arrive, and panes can be merged.
+
+    Events are placed in panes by their own timestamp.  A pane is closed
+    once the wall clock passes its end plus the allowed lateness; events
+    arriving for a closed pane are counted as late and dropped.  Each key
+    keeps the watermark of its next window after its panes are gone, so a
+    late event cannot open an emitted window again.  The watermarks of
+    idle keys expire once they are watermark_windows windows old; from
+    then on, events that old are late for every key.
+
+    Rollup events use the EventCollector event format, with the type
+    "ROLLUP", the timestamp of the end of the window and the contents:
+
+        <window s> <count> <min> <max> <mean> <percentile>...
+
+    The raw events can still be passed through to a second callback.
+"""
+import math
+import threading
+import time
+import types
+import event_collector
+from timestamp import Timestamp
+from local_log import *
+
+
+class QuantileSketch(object):
+
+    """
+        Log-bucketed histogram.  Values are accurate to within
+        relative_accuracy, until more than max_buckets buckets are in
+        use; the lowest buckets are then merged together, which only
+        costs accuracy at the low end.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=512):
+        assert(relative_accuracy > 0 and relative_accuracy < 1)
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def __key(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def __value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        if value > 0:
+            key = self.__key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < 0:
+            key = self.__key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+        if len(self.positive) + len(self.negative) > self.max_buckets:
+            self.__collapse()
+
+    def merge(self, sketch):
+        assert(sketch.gamma == self.gamma)
+        for key, count in sketch.positive.iteritems():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in sketch.negative.iteritems():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zeros += sketch.zeros
+        self.count += sketch.count
+        while len(self.positive) + len(self.negative) > self.max_buckets:
+            self.__collapse()
+
+    def __collapse(self):
+        # Fold the two lowest buckets into one
+        if len(self.positive) > 1:
+            buckets = self.positive
+            low, high = sorted(buckets.keys())[:2]
+        else:
+            # Lowest values are the largest negative ones
+            buckets = self.negative
+            high, low = sorted(buckets.keys())[-2:]
+        buckets[high] += buckets.pop(low)
+
+    def quantile(self, q):
+        # Returns the approximate value at quantile q (0 to 1), or None
+        # if the sketch is empty.
+        assert(q >= 0 and q <= 1)
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative.keys(), reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.__value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive.keys()):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.__value(key)
+        return self.__value(max(self.positive.keys()))
+
+
+class Rollup(object):
+
+    """
+        Aggregate of the values of one pane or window.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.sketch.add(value)
+
+    def merge(self, rollup):
+        if rollup.count == 0:
+            return
+        self.count += rollup.count
+        self.total += rollup.total
+        if self.min is None or rollup.min < self.min:
+            self.min = rollup.min
+        if self.max is None or rollup.max > self.max:
+            self.max = rollup.max
+        self.sketch.merge(rollup.sketch)
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+
+class RollupAggregator(object):
+
+    # Windows an idle key's watermark is kept for
+    watermark_windows = 10
+
+    class Stats():
+        def __init__(self):
+            self.rx_events = 0
+            self.bad_values = 0
+            self.late_events = 0
+            self.rollups = 0
+            self.keys = 0
+
+    def __init__(self, window, rollup_cback, slide=None,
+                       percentiles=[50, 90, 99],
+                       raw_cback=None,
+                       lateness=1.0,
+                       relative_accuracy=0.01):
+        # window, slide and lateness are in seconds.  Without a slide,
+        # the windows are tumbling.
+        assert(isinstance(rollup_cback, types.FunctionType) or
+               isinstance(rollup_cback, types.MethodType))
+        if slide is None:
+            slide = window
+        assert(slide > 0)
+        assert(window >= slide)
+        nr_panes = int(round(float(window) / slide))
+        assert(abs(nr_panes * slide - window) < 1e-9)
+
+        self.window = window
+        self.slide = slide
+        self.nr_panes = nr_panes
+        self.slide_ns = int(slide * 1000000000)
+        self.lateness_ns = int(lateness * 1000000000)
+        self.percentiles = percentiles
+        self.relative_accuracy = relative_accuracy
+        self.rollup_cback = rollup_cback
+        self.raw_cback = raw_cback
+        self.stats = RollupAggregator.Stats()
+
+        # (user, app, name) -> {pane index: Rollup}
+        self.panes = {}
+        # (user, app, name) -> index of the last pane of the next
+        # window to emit.  Outlives the key's panes, as its watermark.
+        self.next_pane = {}
+        # Panes before this one are closed for every key, including
+        # the keys whose watermarks have expired.
+        self.horizon = None
+        self.lock = threading.Lock()
+
+        self.alive = True
+        self.thread = threading.Thread(target=self.__thread_entry)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def event_value(event):
+        # NUMERIC events carry the value first.  VITAL events carry the
+        # vital type and description first.
+        if 'value' in event:
+            return float(event['value'])
+        if event['type'] == "VITAL":
+            return float(event['contents'][2])
+        return float(event['contents'][0])
+
+    def event_cback(self, event):
+        # Pass this method to the EventCollector as its event_cback.
+        if self.raw_cback is not None:
+            self.raw_cback(event)
+
+        self.stats.rx_events += 1
+        try:
+            value = RollupAggregator.event_value(event)
+        except (ValueError, IndexError, TypeError):
+            self.stats.bad_values += 1
+            return
+
+        timestamp_ns = event.get('timestamp_ns')
+        if timestamp_ns is None:
+            timestamp_ns = Timestamp.Now()
+        pane = timestamp_ns // self.slide_ns
+        key = (event['user_name'], event['application_name'], event['name'])
+
+        self.lock.acquire()
+        try:
+            if key not in self.next_pane:
+                if self.horizon is not None and pane < self.horizon:
+                    self.stats.late_events += 1
+                    return
+                self.next_pane[key] = pane
+            elif pane < self.next_pane[key]:
+                self.stats.late_events += 1
+                return
+            panes = self.panes.setdefault(key, {})
+            rollup = panes.get(pane)
+            if rollup is None:
+                rollup = Rollup(self.relative_accuracy)
+                panes[pane] = rollup
+            rollup.add(value)
+        finally:
+            self.lock.release()
+
+    def __thread_entry(self):
+        while self.alive is True:
+            time.sleep(min(self.slide / 4.0, 1.0))
+            self.flush()
+
+    def flush(self, now_ns=None):
+        # Emit the windows whose panes are all closed.
+        if now_ns is None:
+            now_ns = Timestamp.Now()
+        closed_pane = (now_ns - self.lateness_ns) // self.slide_ns
+
+        rollups = []
+        self.lock.acquire()
+        try:
+            for key in self.panes.keys():
+                panes = self.panes[key]
+                # Skip the empty windows of an idle key
+                self.next_pane[key] = max(self.next_pane[key],
+                                          min(panes.keys()))
+                while self.next_pane[key] < closed_pane and len(panes) > 0:
+                    last = self.next_pane[key]
+                    first = last - self.nr_panes + 1
+                    window = Rollup(self.relative_accuracy)
+                    for pane in panes.keys():
+                        if pane >= first and pane <= last:
+                            window.merge(panes[pane])
+                        if pane <= first:
+                            # Not part of any later window
+                            del panes[pane]
+                    if window.count > 0:
+                        rollups.append(self.__rollup_event(key, last,
+                                                           window))
+                    self.next_pane[key] += 1
+                if len(panes) == 0:
+                    # The watermark stays
+                    del self.panes[key]
+
+            self.horizon = closed_pane \
+                           - self.watermark_windows * self.nr_panes
+            for key in self.next_pane.keys():
+                if key not in self.panes and \
+                   self.next_pane[key] < self.horizon:
+                    del self.next_pane[key]
+            self.stats.keys = len(self.panes)
+            self.stats.rollups += len(rollups)
+        finally:
+            self.lock.release()
+
+        for rollup in rollups:
+            self.rollup_cback(rollup)
+
+    def __rollup_event(self, key, last_pane, window):
+        timestamp_ns = (last_pane + 1) * self.slide_ns
+        percentiles = [window.sketch.quantile(p / 100.0)
+                       for p in self.percentiles]
+        contents = [str(self.window),
+                    str(window.count),
+                    repr(window.min),
+                    repr(window.max),
+                    repr(window.mean())] \
+                   + [repr(value) for value in percentiles]
+        return {'type': "ROLLUP",
+                'name': key[2],
+                'timestamp': Timestamp.Format(timestamp_ns),
+                'timestamp_ns': timestamp_ns,
+                'user_name': key[0],
+                'application_name': key[1],
+                'contents': contents,
+                'window': self.window,
+                'count': window.count,
+                'min': window.min,
+                'max': window.max,
+                'mean': window.mean(),
+                'percentiles': dict(zip(self.percentiles, percentiles))}
+
+    def close(self):
+        self.alive = False
+
+
+class RollupCollector(object):
+
+    """
+        EventCollector delivering rollups of the collected events.
+    """
+
+    def __init__(self, event_types, rollup_cback, window, slide=None,
+                       percentiles=[50, 90, 99],
+                       raw_cback=None,
+                       user_name="",
+                       application_name=""):
+        self.aggregator = RollupAggregator(window,
+                                           rollup_cback,
+                                           slide,
+                                           percentiles,
+                                           raw_cback)
+        self.collector = event_collector.EventCollector(
+                                            event_types,
+                                            self.aggregator.event_cback,
+                                            user_name,
+                                            application_name)
+
+
+def test1():
+
+    # Sketch accuracy and merging
+    import random
+    random.seed(1)
+    values = [random.expovariate(0.01) for i in range(20000)]
+    sketch = QuantileSketch(0.01)
+    half = QuantileSketch(0.01)
+    for i, value in enumerate(values):
+        if i % 2 == 0:
+            sketch.add(value)
+        else:
+            half.add(value)
+    sketch.merge(half)
+    assert(sketch.count == len(values))
+    values.sort()
+    for q in [0.5, 0.9, 0.99]:
+        exact = values[int(q * (len(values) - 1))]
+        assert(abs(sketch.quantile(q) - exact) / exact < 0.03)
+
+    # Bounded memory
+    small = QuantileSketch(0.01, 64)
+    for value in values:
+        small.add(value)
+    assert(len(small.positive) <= 64)
+    assert(abs(small.quantile(0.99) - values[int(0.99 * len(values))])
+           / values[int(0.99 * len(values))] < 0.03)
+
+    mixed = QuantileSketch()
+    for value in [-10, -1, 0, 1, 10]:
+        mixed.add(value)
+    assert(abs(mixed.quantile(0) + 10) < 0.2)
+    assert(mixed.quantile(0.5) == 0.0)
+    assert(abs(mixed.quantile(1) - 10) < 0.2)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # Tumbling and sliding windows, driven by flush() with explicit
+    # times so the test does not depend on the clock.
+    def event(name, value, sec):
+        return {'type': "NUMERIC",
+                'name': name,
+                'timestamp_ns': int(sec * 1000000000),
+                'user_name': "sysadmin",
+                'application_name': "rolluptest",
+                'contents': [str(value)]}
+
+    rollups = []
+    raw = []
+
+    def rollup_cback(rollup):
+        rollups.append(rollup)
+
+    tumbling = RollupAggregator(1, rollup_cback, raw_cback=raw.append,
+                                lateness=0)
+    tumbling.close()
+    for i in range(10):
+        tumbling.event_cback(event("a", i, 100 + i * 0.1))
+        tumbling.event_cback(event("b", i * 10, 100 + i * 0.1))
+    tumbling.event_cback(event("a", 100, 101.5))
+    tumbling.event_cback(event("a", "junk", 101.5))
+    assert(len(raw) == 22)
+    assert(tumbling.stats.bad_values == 1)
+
+    tumbling.flush(101 * 1000000000)
+    assert(len(rollups) == 2)
+    rollup_a = [r for r in rollups if r['name'] == "a"][0]
+    assert(rollup_a['count'] == 10)
+    assert(rollup_a['min'] == 0 and rollup_a['max'] == 9)
+    assert(rollup_a['mean'] == 4.5)
+    assert(rollup_a['timestamp_ns'] == 101 * 1000000000)
+    assert(rollup_a['contents'][:3] == ["1", "10", "0.0"])
+
+    # Late event for the emitted window
+    tumbling.event_cback(event("a", 1, 100.5))
+    assert(tumbling.stats.late_events == 1)
+
+    tumbling.flush(103 * 1000000000)
+    assert(len(rollups) == 3)
+    assert(rollups[2]['count'] == 1 and rollups[2]['max'] == 100)
+    assert(tumbling.stats.keys == 0)
+
+    # Late events for windows of keys with no panes left are dropped
+    # too, rather than emitted a second time.
+    tumbling.event_cback(event("b", 5, 100.2))
+    tumbling.event_cback(event("a", 5, 101.2))
+    assert(tumbling.stats.late_events == 3)
+    tumbling.event_cback(event("a", 7, 110.2))
+    tumbling.flush(112 * 1000000000)
+    assert(len(rollups) == 4 and rollups[3]['count'] == 1)
+
+    # Idle watermarks expire, and the horizon takes over
+    tumbling.flush(200 * 1000000000)
+    assert(tumbling.next_pane == {})
+    tumbling.event_cback(event("b", 5, 100.2))
+    assert(tumbling.stats.late_events == 4)
+    tumbling.flush(201 * 1000000000)
+    assert(len(rollups) == 4)
+
+    # 3 second window, sliding every second
+    del rollups[:]
+    sliding = RollupAggregator(3, rollup_cback, slide=1, lateness=0)
+    sliding.close()
+    for sec in range(5):
+        sliding.event_cback(event("c", sec, 200 + sec))
+    sliding.flush(210 * 1000000000)
+    assert([r['count'] for r in rollups] == [1, 2, 3, 3, 3, 2, 1])
+    assert([r['max'] for r in rollups] == [0, 1, 2, 3, 4, 4, 4])
+    assert(sliding.stats.keys == 0)
+    print "test2() PASSED"
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
@@ -10,7 +10,11 @@
     Events are distributed via a PUB server.  The format of each event
     packet is as follows:
 
-    <event type> <timestamp> <user_name> <application name> [contents]
+    <event type> <event name> <timestamp> <user_name> <application name>
+        <sequence> [contents]
+
+    The timestamp is the integer number of nanoseconds since the epoch
+    (see timestamp.py).
 
     By placing the event type first in the packet, it allows the event
     collector to filter event messages using event type and the built-in
@@ -21,39 +25,211 @@
     events for this user_name/application_name, they should not have
     connected to this server.
 
+    The sequence field is stamped by the EventSocket as
+
+        <sequence>:<epoch>
+
+    Each event type has its own sequence, which increases by one for
+    every event message of that type sent on the socket.  A collector
+    subscribed to only some of the types still sees each of its sequences
+    without gaps.  The epoch is the UUID the socket advertises its EVENT
+    service with, so a restarted source, which starts its sequence numbers
+    over, is told apart from the old one.  Collectors use the pair to
+    detect lost events (see event_collector.py).
+
+    An EventSource may opt in to batching (see enable_batching()).  A batch
+    carries many events of the same type/name in one PUB message.  The
+    timestamp field of the header is replaced with the BATCH marker and
+    each event carries its own timestamp:
+
+    <event type> <event name> BATCH <user_name> <application name>
+        <sequence> <count> [<timestamp> <nr contents> [contents]] ...
+
+    Each EventSocket keeps the most recent events of each event type in a
+    replay buffer.  A collector which joins late can ask for them on the
+    replay ROUTER socket, advertised as the EVENT_REPLAY service:
+
+        collector --->  REPLAY [event type] ...      ---> source
+        collector <---  REPLAY <event message> ...   <--- source
+        collector <---  REPLAY_END <count> <user_name> <application name>
+
+    An event type of "*" requests every type.  The replayed events are
+    sent only to the requesting collector, at most max_replay_events of
+    them per request; the oldest beyond that are left out.  A collector
+    which has found a gap in the sequence numbers of an event type can
+    ask for just the missing range of that type:
+
+        collector --->  REPLAY_RANGE <first> <last> <event type>
+
 """
 import zsocket
 import zhelpers
 import interface
 import zmq
 import time
+import threading
 import location
 import discovery
 import types
 import system
+import collections
+import rate_limit
+import numeric
+from timestamp import Timestamp
 from local_log import *
 
+# Replaces the timestamp in the header of batched event messages
+BATCH_MARKER = "BATCH"
+
+
+class ReplayBuffer(object):
+
+    """
+        Keeps the last max_events event messages of each event type,
+        with the total size of all kept messages capped at max_bytes.
+        When over the cap, the oldest event across all types goes.
+    """
+    # Approximate per-field overhead of a kept message, in bytes
+    field_overhead = 40
+
+    def __init__(self, max_events=100, max_bytes=1024 * 1024):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.events = {}
+        self.nr_bytes = 0
+        # Order the events were added in, across the types.  The
+        # sequence numbers are per type.
+        self.order = 0
+        self.lock = threading.Lock()
+
+    def __msg_size(self, msg_list):
+        size = len(msg_list) * self.field_overhead
+        for item in msg_list:
+            size += len(str(item))
+        return size
+
+    def add(self, sequence, msg_list):
+        event_type = msg_list[0]
+        size = self.__msg_size(msg_list)
+
+        self.lock.acquire()
+        try:
+            if event_type not in self.events:
+                self.events[event_type] = collections.deque()
+            events = self.events[event_type]
+            self.order += 1
+            events.append((self.order, sequence, size, msg_list))
+            self.nr_bytes += size
+
+            if len(events) > self.max_events:
+                order, seq, size, msg = events.popleft()
+                self.nr_bytes -= size
+
+            while self.nr_bytes > self.max_bytes:
+                self.__evict_oldest()
+        finally:
+            self.lock.release()
+
+    def __evict_oldest(self):
+        oldest = None
+        for events in self.events.values():
+            if len(events) == 0:
+                continue
+            if oldest is None or events[0][0] < oldest[0][0]:
+                oldest = events
+        order, seq, size, msg = oldest.popleft()
+        self.nr_bytes -= size
+
+    def get(self, event_types, first=None, last=None):
+        # Returns the kept messages of the given types, oldest first,
+        # optionally only those with first <= sequence <= last.
+        self.lock.acquire()
+        try:
+            if "*" in event_types:
+                event_types = self.events.keys()
+            kept = []
+            for event_type in event_types:
+                if event_type in self.events:
+                    kept += [event for event in self.events[event_type]
+                             if (first is None or event[1] >= first) and
+                                (last is None or event[1] <= last)]
+        finally:
+            self.lock.release()
+
+        kept.sort()
+        return [msg for order, seq, size, msg in kept]
+
 
 class EventSocket(object):
     """
-        Create the SUB server and interface to process and
+        Create the XPUB server and interface to process and
         send all EVENT messages.
+
+        The XPUB socket tells us about the subscriptions of the
+        collectors connected to us.  Until the first subscription
+        arrives, events are held in a startup buffer so the events
+        sent while starting up are not lost to nobody listening.
+        The buffer is released when the first collector subscribes,
+        or when the startup period expires, whichever comes first.
+        Once started, events are only sent while there are
+        subscribers attached.
+
+        Every event sent is also kept in the replay buffer, whether
+        or not anyone is subscribed.
+
+        Events are rate limited to the user's SLA (see rate_limit.py).
+        Events over the limit are dropped, sampled or coalesced,
+        depending on the overflow policy.  The host's own VITAL and
+        ALERT events, sent with system=True, have a budget of their
+        own, and are dropped over it.  While events are overflowing, an
+        "event_overload" ERROR vital is sent, bypassing the limit, every
+        overload_period seconds.  Its value is the number of events
+        which have overflowed so far.
     """
     port_range = [7000, 8000]
-    init_sleep_period = 5
+    startup_period = 15
+    startup_buffer_size = 1000
+    overload_period = 10
+    # Most events sent in reply to one replay request
+    max_replay_events = 1000
+
+    class Stats():
+        def __init__(self):
+            self.tx_events = 0
+            self.tx_no_subscribers = 0
+            self.startup_buffered = 0
+            self.startup_dropped = 0
+            self.replay_requests = 0
+            self.replay_events = 0
 
     def __init__(self, user_name, application_name):
 
         self.user_name = user_name
         self.application_name = application_name
+        # event type -> last sequence number sent
+        self.sequences = {}
+        self.lock = threading.Lock()
+        self.batches = []
+        self.flush_thread = None
+        self.stats = EventSocket.Stats()
+        self.started = False
+        self.startup_buffer = []
+        self.subscriptions = 0
+        self.replay_buffer = ReplayBuffer()
+        self.limiter = rate_limit.RateLimiter(user_name)
+        self.system_limiter = rate_limit.RateLimiter(user_name, system=True)
+        self.rate_timer = False
+        self.overload_time = 0
+        self.overload_reported = 0
 
-        self.zsocket = zsocket.ZSocketServer(zmq.PUB,
+        self.zsocket = zsocket.ZSocketServer(zmq.XPUB,
                                              "tcp",
                                              "*",
                                              "EVENT",
                                              self.port_range)
         self.zsocket.bind()
-        self.interface = interface.Interface()
+        self.interface = interface.Interface(self.__rx_subscription,
+                                             timer_cback=self.__timer_cback)
         self.interface.add_socket(self.zsocket)
         self.ip_addr = zhelpers.get_local_ipaddr()
 
@@ -69,17 +245,311 @@ class EventSocket(object):
                                                 "EVENT",
                                                 service_location)
         assert(self.discovery is not None)
+        self.epoch = str(self.discovery.uuid)
+
+        # Side socket to serve replay requests from late subscribers.
+        self.replay_zsocket = zsocket.ZSocketServer(zmq.ROUTER,
+                                                    "tcp",
+                                                    "*",
+                                                    "EVENT_REPLAY",
+                                                    self.port_range)
+        self.replay_zsocket.bind()
+        self.replay_interface = interface.Interface(self.__rx_replay_request)
+        self.replay_interface.add_socket(self.replay_zsocket)
+        replay_location = location.create_location("tcp",
+                                                   self.ip_addr,
+                                                   self.replay_zsocket.port)
+        self.replay_discovery = discovery.DiscoveryServer(
+                                                user_name,
+                                                application_name,
+                                                "EVENT_REPLAY",
+                                                replay_location)
+
+        # Remote services need our discovery beacon before they can
+        # subscribe.  Rather than blocking here, hold the start-up
+        # events until someone subscribes or the startup period ends.
+        self.interface.add_timer("startup", self.startup_period)
+
+    def has_subscribers(self):
+        return self.subscriptions > 0
+
+    def set_overflow_policy(self, policy):
+        # "drop", "sample" or "coalesce".  See rate_limit.py
+        assert(policy in rate_limit.POLICIES)
+        self.lock.acquire()
+        try:
+            self.limiter.policy = policy
+        finally:
+            self.lock.release()
+
+    def limiter_for(self, event_type, system=False):
+        if system is True and event_type in rate_limit.SYSTEM_TYPES:
+            return self.system_limiter
+        return self.limiter
+
+    def send(self, msg, system=False):
+        # Returns False if the message was dropped or held by the rate
+        # limiter.  system is for the host's own vitals and alerts; the
+        # events relayed for applications are always charged to the SLA.
+        msg_list = msg['message']
+        nr_events = 1
+        if msg_list[2] == BATCH_MARKER:
+            nr_events = int(msg_list[5])
+
+        self.lock.acquire()
+        try:
+            for pending in self.limiter.take_pending():
+                self.__send(pending)
+            limiter = self.limiter_for(msg_list[0], system)
+            if limiter.check((msg_list[0], msg_list[1]),
+                             msg,
+                             nr_events) is False:
+                if limiter is self.limiter:
+                    self.__overload()
+                return False
+            self.__send(msg)
+            return True
+        finally:
+            self.lock.release()
+
+    def __send(self, msg):
+        # Stamp the event type's sequence number into the header.
+        # Called with the lock held, which keeps the sequence numbers in
+        # order on the wire when several threads send on the same socket.
+        event_type = msg['message'][0]
+        sequence = self.sequences.get(event_type, 0) + 1
+        self.sequences[event_type] = sequence
+        msg['message'].insert(5, "%d:%s" % (sequence, self.epoch))
+        self.replay_buffer.add(sequence, msg['message'])
+        if self.started is False:
+            self.__buffer(msg)
+        elif self.subscriptions > 0:
+            self.interface.push_in_msg(msg)
+            self.stats.tx_events += 1
+        else:
+            # Nobody is listening.  Don't bother the socket.
+            self.stats.tx_no_subscribers += 1
+
+    def __overload(self):
+        # Called with the lock held
+        if self.rate_timer is False:
+            self.__arm_rate_timer()
+
+        now = time.time()
+        if now - self.overload_time < self.overload_period:
+            return
+        self.overload_time = now
+        value = self.limiter.stats.overflows
+        delta = value - self.overload_reported
+        self.overload_reported = value
+        Llog.LogInfo("Event overload for " + self.user_name + ": "
+                     + str(delta) + " events over the SLA rate")
+        # VStatErrorEvent format, see vitals.py
+        self.__send({'message':["VITAL",
+                                "event_overload",
+                                str(Timestamp.Now()),
+                                self.user_name,
+                                self.application_name,
+                                "ERROR",
+                                "Events over the SLA rate",
+                                str(value),
+                                str(delta)]})
+
+    def __buffer(self, msg):
+        if len(self.startup_buffer) >= self.startup_buffer_size:
+            self.startup_buffer.pop(0)
+            self.stats.startup_dropped += 1
+        self.startup_buffer.append(msg)
+        self.stats.startup_buffered += 1
+
+    def __start(self):
+        # Release the startup buffer, in order.  Called with the
+        # lock held, from the interface thread.
+        if self.started is True:
+            return
+        self.started = True
+        for msg in self.startup_buffer:
+            self.interface.push_in_msg(msg)
+            self.stats.tx_events += 1
+        self.startup_buffer = []
+
+    def __rx_subscription(self, msg):
+        # Subscription messages from the XPUB socket.  These are
+        # consumed here, there is nobody above us to pass them to.
+        action, topic = msg['message']
+        self.lock.acquire()
+        try:
+            if action == "SUBSCRIBE":
+                self.subscriptions += 1
+                if self.started is False:
+                    Llog.LogDebug("First subscriber, releasing "
+                                  + str(len(self.startup_buffer))
+                                  + " start-up events")
+                    self.interface.remove_timer("startup")
+                    self.__start()
+            elif self.subscriptions > 0:
+                self.subscriptions -= 1
+        finally:
+            self.lock.release()
+        return None
+
+    def __rx_replay_request(self, msg):
+        # Runs in the replay interface thread, which owns the ROUTER
+        # socket, so the replies are sent on it directly.  Pushing them
+        # back into the interface would block this thread, the only one
+        # draining the pipe, once the pipe is full.  ROUTER drops rather
+        # than blocks when the requester is not keeping up.
+        msg_list = msg['message']
+        first = None
+        last = None
+        try:
+            if msg_list[0] == "REPLAY":
+                event_types = msg_list[1:]
+            elif msg_list[0] == "REPLAY_RANGE":
+                first = int(msg_list[1])
+                last = int(msg_list[2])
+                event_types = msg_list[3:]
+            else:
+                raise ValueError(msg_list[0])
+        except (IndexError, ValueError):
+            Llog.LogError("Invalid replay request: " + str(msg_list))
+            return None
+
+        self.stats.replay_requests += 1
+        if len(event_types) == 0:
+            event_types = ["*"]
+
+        kept = self.replay_buffer.get(event_types, first, last)
+        kept = kept[-self.max_replay_events:]
+        for msg_list in kept:
+            self.replay_zsocket.send({'message':["REPLAY"] + msg_list,
+                                      'address':msg['address']})
+        self.replay_zsocket.send({'message':["REPLAY_END",
+                                             str(len(kept)),
+                                             self.user_name,
+                                             self.application_name],
+                                  'address':msg['address']})
+        self.stats.replay_events += len(kept)
+        return None
 
-        # After creating the socket and the discovery server, we need
-        # to pause here for a minute to allow remote services to get
-        # our initial discovery beacon and subscribe.  If we dont wait here
-        # our software may immediately send some start-up events which
-        # will most definitely be lost because no one has had a chance
-        # to subscribe
-        time.sleep(self.init_sleep_period)
+    def __timer_cback(self, timer_name):
+        self.lock.acquire()
+        try:
+            if timer_name == "ratelimit":
+                # Send the coalesced events which now fit.
+                self.rate_timer = False
+                for pending in self.limiter.take_pending():
+                    self.__send(pending)
+                self.__arm_rate_timer()
+            else:
+                self.__start()
+        finally:
+            self.lock.release()
 
-    def send(self, msg):
-        self.interface.push_in_msg(msg)
+    def __arm_rate_timer(self):
+        # Wake up when the next coalesced event can be sent.
+        wait_time = self.limiter.pending_wait_time()
+        if wait_time is not None:
+            self.rate_timer = True
+            self.interface.add_timer("ratelimit", max(wait_time, 0.001))
+
+    def add_batch(self, batch):
+        # Batches are flushed on their max_delay by a single flush
+        # thread per socket.
+        self.lock.acquire()
+        try:
+            self.batches.append(batch)
+            if self.flush_thread is None:
+                self.flush_thread = threading.Thread(
+                                    target=self.__flush_thread_entry)
+                self.flush_thread.daemon = True
+                self.flush_thread.start()
+        finally:
+            self.lock.release()
+
+    def __flush_thread_entry(self):
+        while True:
+            batches = self.batches[:]
+            period = min([batch.max_delay for batch in batches]) / 2
+            time.sleep(period)
+            now = time.time()
+            for batch in batches:
+                batch.flush_expired(now)
+
+
+class EventBatch(object):
+
+    """
+        Pending batch of events for a single EventSource.  The batch is
+        flushed when it holds max_events events, max_bytes bytes of
+        contents, or its oldest event is max_delay seconds old.
+        max_events is capped at the rate limit's burst.
+    """
+
+    def __init__(self, source, max_events, max_bytes, max_delay):
+        assert(max_events > 0)
+        assert(max_bytes > 0)
+        assert(max_delay > 0)
+
+        self.source = source
+        limiter = source.socket.limiter_for(source.event_type,
+                                            source.system)
+        self.max_events = min(max_events, limiter.max_batch())
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.__reset()
+
+    def __reset(self):
+        self.events = []
+        self.nr_events = 0
+        self.nr_bytes = 0
+        self.first_time = 0
+
+    def add(self, timestamp, contents):
+        self.lock.acquire()
+        try:
+            if self.nr_events == 0:
+                self.first_time = time.time()
+            self.events += [timestamp, str(len(contents))] + contents
+            self.nr_events += 1
+            self.nr_bytes += len(timestamp)
+            for item in contents:
+                self.nr_bytes += len(str(item))
+
+            if self.nr_events >= self.max_events or \
+               self.nr_bytes >= self.max_bytes:
+                self.__flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.__flush()
+        finally:
+            self.lock.release()
+
+    def flush_expired(self, now):
+        self.lock.acquire()
+        try:
+            if self.nr_events > 0 and \
+               now - self.first_time >= self.max_delay:
+                self.__flush()
+        finally:
+            self.lock.release()
+
+    def __flush(self):
+        if self.nr_events == 0:
+            return
+        msg = {'message':[self.source.event_type,
+                          self.source.event_name,
+                          BATCH_MARKER,
+                          self.source.user_name,
+                          self.source.application_name,
+                          str(self.nr_events)] + self.events}
+        self.__reset()
+        self.source.socket.send(msg, self.source.system)
 
 
 class EventSource(object):
@@ -93,7 +563,10 @@ class EventSource(object):
     """
     sockets = []
 
-    def __init__(self, event_name, event_type, user_name, application_name):
+    def __init__(self, event_name, event_type, user_name, application_name,
+                 system=False):
+        # system marks the host's own VITAL/ALERT sources, charged to the
+        # system budget rather than the SLA (see EventSocket.send()).
         assert(isinstance(event_name, types.StringType))
         assert(isinstance(event_type, types.StringType))
 
@@ -101,19 +574,40 @@ class EventSource(object):
         self.event_name = event_name
         self.user_name = user_name
         self.application_name = application_name
+        self.system = system
 
         self.socket = EventSource.GetSocket(user_name, application_name)
         assert(self.socket is not None)
+        self.batch = None
+
+    def enable_batching(self, max_events=100, max_bytes=8192, max_delay=0.1):
+        assert(self.batch is None)
+        self.batch = EventBatch(self, max_events, max_bytes, max_delay)
+        self.socket.add_batch(self.batch)
+
+    def flush(self):
+        if self.batch is not None:
+            self.batch.flush()
 
     def send(self, contents):
         assert(isinstance(contents, types.ListType))
-        timestamp = time.strftime("%x-%X")
+        timestamp = str(Timestamp.Now())
+        if self.batch is not None:
+            self.batch.add(timestamp, contents)
+            return
+
         msg = {'message':[self.event_type,
                           self.event_name,
                           timestamp,
                           self.user_name,
                           self.application_name] + contents}
-        self.socket.send(msg)
+        return self.socket.send(msg, self.system)
+
+    def send_numeric(self, *values):
+        # Send numbers as typed binary payloads (see numeric.py), one
+        # contents item per argument.  An argument is a number, or a
+        # sequence/array of samples.
+        return self.send([numeric.encode(value) for value in values])
 
     @staticmethod
     def GetSocket(user_name, application_name):
@@ -134,3 +628,149 @@ class EventSource(object):
         EventSource.sockets.append(socket)
         return socket
 
+
+
+def test1():
+
+    # Events sent before anyone subscribes are held, then delivered
+    # to the first subscriber.
+    import event_collector
+
+    user_name = "sysadmin"
+    app_name = "startuptest"
+    discovery.DiscoveryServer.period = 2
+
+    start = time.time()
+    source = EventSource("startup", "TEST", user_name, app_name)
+    # No more blocking start-up sleep
+    assert(time.time() - start < 1)
+
+    for i in range(5):
+        source.send([str(i)])
+    assert(source.socket.started is False)
+    assert(source.socket.has_subscribers() is False)
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = event_collector.EventCollector(
+                                        ["TEST"],
+                                        self.event_rcv_cback,
+                                        user_name,
+                                        app_name)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    time.sleep(4)
+
+    assert(source.socket.started is True)
+    assert(source.socket.has_subscribers() is True)
+    assert([event['contents'][0] for event in mtc.events] ==
+                [str(i) for i in range(5)])
+    print "test1() PASSED"
+
+
+def test2():
+
+    # Over the SLA rate, coalesced events are held and the latest value
+    # of each is sent once the bucket refills.  The overload is reported
+    # as a vital.
+    import event_collector
+
+    user_name = "ratetest"
+    app_name = "ratetest"
+    discovery.DiscoveryServer.period = 1
+    rate_limit.RateLimiter.buckets[user_name] = rate_limit.TokenBucket(4, 3)
+
+    class MyTestClass():
+        def __init__(self):
+            self.events = []
+            self.collector = event_collector.EventCollector(
+                                        ["*"],
+                                        self.event_rcv_cback,
+                                        user_name,
+                                        app_name)
+
+        def event_rcv_cback(self, event):
+            self.events.append(event)
+
+    mtc = MyTestClass()
+    source = EventSource("load", "VALUE", user_name, app_name)
+    source.socket.set_overflow_policy("coalesce")
+    time.sleep(3)
+    assert(source.socket.has_subscribers() is True)
+
+    results = [source.send([str(i)]) for i in range(10)]
+    assert(results == [True] * 3 + [False] * 7)
+    time.sleep(1)
+
+    values = [event['contents'][0] for event in mtc.events
+                if event['type'] == "VALUE"]
+    assert(values == ["0", "1", "2", "9"])
+    vitals = [event for event in mtc.events if event['type'] == "VITAL"]
+    assert(len(vitals) == 1)
+    assert(vitals[0]['name'] == "event_overload")
+    assert(vitals[0]['contents'] == ["ERROR", "Events over the SLA rate",
+                                     "1", "1"])
+    assert(source.socket.limiter.stats.coalesced == 6)
+
+    # Batches are no larger than the burst, and vitals have a budget
+    # of their own.
+    batched = EventSource("batched", "VALUE", user_name, app_name)
+    batched.enable_batching(max_events=150)
+    assert(batched.batch.max_events == 3)
+    vital = ["VITAL", "x", "1", user_name, app_name, "GAUGE", "x", "1", "1"]
+    # Unless sent by the host, a VITAL is charged to the SLA
+    source.socket.set_overflow_policy("drop")
+    source.socket.limiter.bucket.rate = 1e-9
+    source.socket.limiter.bucket.tokens = 0
+    assert(source.socket.send({'message':vital[:]}, system=True) is True)
+    assert(source.socket.send({'message':vital[:]}) is False)
+    print "test2() PASSED"
+
+
+def test3():
+
+    # A replay larger than the cap is cut to the latest events, sent
+    # straight out the ROUTER socket, and the socket keeps serving.
+    user_name = "replaytest"
+    app_name = "bigreplay"
+    rate_limit.RateLimiter.buckets[user_name] = \
+                                    rate_limit.TokenBucket(10000, 10000)
+    EventSocket.max_replay_events = 500
+
+    source = EventSource("tick", "VALUE", user_name, app_name)
+    source.socket.replay_buffer = ReplayBuffer(max_events=2000)
+    for i in range(1500):
+        assert(source.send([str(i)]) is True)
+
+    requester = zsocket.ZSocketClient(zmq.DEALER,
+                                      "tcp",
+                                      "127.0.0.1",
+                                      "EVENT_REPLAY",
+                                      source.socket.replay_zsocket.port)
+    requester.connect()
+    for request in range(2):
+        requester.send({'message':["REPLAY", "VALUE"]})
+        replayed = []
+        while True:
+            assert(requester.socket.poll(5000) != 0)
+            msg_list = requester.recv()['message']
+            if msg_list[0] == "REPLAY_END":
+                break
+            replayed.append(msg_list[7])
+        assert(msg_list[1] == "500")
+        assert(replayed == [str(i) for i in range(1000, 1500)])
+    assert(source.socket.stats.replay_requests == 2)
+
+    requester.close()
+    EventSocket.max_replay_events = 1000
+    print "test3() PASSED"
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
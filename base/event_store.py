@@ -0,0 +1,814 @@
+"""
+    EventStore
+
+    Durable, append-only storage for the events received by an
+    EventCollector.
+
+    Events are appended to segment files in a store directory.  A segment
+    is closed, and a new one started, once it reaches segment_size bytes or
+    segment_age seconds.  Each segment has an index file next to it:
+
+        <store dir>/00000000000000000001.seg
+        <store dir>/00000000000000000001.idx
+
+    The index is sparse.  It has one line per block of up to block_size
+    records, giving the block's file offset, size, record count, lowest and
+    highest timestamp, and the user names, application names and event
+    types found in the block.  Queries only read the blocks which can hold
+    a matching event, so neither whole segments nor whole indexes of
+    records are loaded into memory.  The index lines are JSON.
+
+    The block sets are a block-skip filter, not a secondary index: they
+    only pay off for filters whose events cluster in blocks, such as time
+    ranges or rare event types.  Once many users' events are interleaved
+    in every block, a per-user query still reads almost every block.
+
+    Each record in a segment is:
+
+        <record length> <timestamp ns> <field count> (<length> <field>)*
+            uint32          int64         uint32      uint32
+
+    with the fields type, name, user name, application name, sequence
+    and then the event contents.  All integers are little-endian.
+
+    Events arrive in the order the collector receives them, which is only
+    roughly time order across sources, so blocks are selected by their
+    timestamp range and every event is checked against the query.
+"""
+import os
+import struct
+import threading
+import time
+import types
+import json
+import numeric
+from timestamp import Timestamp
+from local_log import *
+
+RECORD_HEADER_FORMAT = "<IqI"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+FIELD_HEADER_FORMAT = "<I"
+FIELD_HEADER_SIZE = struct.calcsize(FIELD_HEADER_FORMAT)
+NR_FIXED_FIELDS = 5
+
+
+def encode_item(item):
+    # Numbers and numeric arrays are packed, anything else is sent as
+    # its string.
+    if isinstance(item, types.StringType):
+        return item
+    if numeric.is_numeric(item):
+        return numeric.encode(item)
+    if isinstance(item, types.UnicodeType):
+        return item.encode("utf-8")
+    return str(item)
+
+
+def encode_event(event):
+    timestamp_ns = event.get('timestamp_ns')
+    if timestamp_ns is None:
+        timestamp_ns = Timestamp.Now()
+    fields = [event['type'],
+              event['name'],
+              event['user_name'],
+              event['application_name'],
+              str(event.get('sequence', 0))] \
+             + [encode_item(item) for item in event['contents']]
+    body = "".join([struct.pack(FIELD_HEADER_FORMAT, len(field)) + field
+                    for field in fields])
+    return struct.pack(RECORD_HEADER_FORMAT,
+                       RECORD_HEADER_SIZE + len(body),
+                       timestamp_ns,
+                       len(fields)) + body
+
+
+def decode_event(record):
+    # Returns the event dict, in the EventCollector format, or None if
+    # the record is corrupt.
+    try:
+        length, timestamp_ns, nr_fields = \
+            struct.unpack_from(RECORD_HEADER_FORMAT, record, 0)
+        if length != len(record) or nr_fields < NR_FIXED_FIELDS:
+            return None
+        fields = []
+        offset = RECORD_HEADER_SIZE
+        for i in range(nr_fields):
+            field_len = struct.unpack_from(FIELD_HEADER_FORMAT,
+                                           record, offset)[0]
+            offset += FIELD_HEADER_SIZE
+            if offset + field_len > length:
+                return None
+            fields.append(record[offset:offset + field_len])
+            offset += field_len
+        sequence = int(fields[4])
+    except (struct.error, ValueError):
+        return None
+
+    contents = fields[NR_FIXED_FIELDS:]
+    if fields[0] == "NUMERIC":
+        contents = numeric.decode_contents(contents)
+    return {'type': fields[0],
+            'name': fields[1],
+            'timestamp': Timestamp.Format(timestamp_ns),
+            'timestamp_ns': timestamp_ns,
+            'user_name': fields[2],
+            'application_name': fields[3],
+            'sequence': sequence,
+            'contents': contents}
+
+
+class Block():
+
+    """
+        Sparse index entry: a run of consecutive records in a segment.
+    """
+
+    def __init__(self, offset, size=0, count=0, min_ts=None, max_ts=None,
+                 users=[], apps=[], types=[]):
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.min_ts = min_ts
+        self.max_ts = max_ts
+        self.users = set(users)
+        self.apps = set(apps)
+        self.types = set(types)
+
+    def add(self, event, timestamp_ns, size):
+        self.count += 1
+        self.size += size
+        if self.min_ts is None or timestamp_ns < self.min_ts:
+            self.min_ts = timestamp_ns
+        if self.max_ts is None or timestamp_ns > self.max_ts:
+            self.max_ts = timestamp_ns
+        self.users.add(event['user_name'])
+        self.apps.add(event['application_name'])
+        self.types.add(event['type'])
+
+    def merge(self, block):
+        # Summary of several blocks, used for the whole segment.
+        if block.count == 0:
+            return
+        self.count += block.count
+        if self.min_ts is None or block.min_ts < self.min_ts:
+            self.min_ts = block.min_ts
+        if self.max_ts is None or block.max_ts > self.max_ts:
+            self.max_ts = block.max_ts
+        self.users |= block.users
+        self.apps |= block.apps
+        self.types |= block.types
+
+    def match(self, start_ns, end_ns, user_name, application_name,
+              event_type):
+        if self.count == 0:
+            return False
+        if start_ns is not None and self.max_ts < start_ns:
+            return False
+        if end_ns is not None and self.min_ts >= end_ns:
+            return False
+        if user_name is not None and user_name not in self.users:
+            return False
+        if application_name is not None and \
+           application_name not in self.apps:
+            return False
+        if event_type is not None and event_type not in self.types:
+            return False
+        return True
+
+    def to_line(self):
+        return json.dumps([self.offset, self.size, self.count,
+                           self.min_ts, self.max_ts,
+                           sorted(self.users),
+                           sorted(self.apps),
+                           sorted(self.types)]) + "\n"
+
+    @staticmethod
+    def FromLine(line):
+        offset, size, count, min_ts, max_ts, users, apps, types = \
+            json.loads(line)
+        return Block(offset, size, count, min_ts, max_ts,
+                     [str(user) for user in users],
+                     [str(app) for app in apps],
+                     [str(t) for t in types])
+
+
+class Segment():
+
+    """
+        One segment file and its sparse index.
+    """
+
+    def __init__(self, store_dir, number):
+        self.number = number
+        self.path = os.path.join(store_dir, "%020d.seg" % number)
+        self.index_path = os.path.join(store_dir, "%020d.idx" % number)
+        self.blocks = []
+        self.summary = Block(0)
+        self.size = 0
+        self.created = time.time()
+        self.f = None
+        self.index_f = None
+        self.block = None
+        # Queries reading the segment.  Compaction leaves it alone
+        # until they are done.
+        self.readers = 0
+
+    def open(self, block_size):
+        # Open for appending.  Recovers the records written after the
+        # last index line, e.g. after a crash.
+        self.block_size = block_size
+        self.load_index()
+        self.f = open(self.path, "ab")
+        self.index_f = open(self.index_path, "a")
+        self.f.seek(0, os.SEEK_END)
+        self.size = self.f.tell()
+
+        offset = 0
+        if len(self.blocks) > 0:
+            offset = self.blocks[-1].offset + self.blocks[-1].size
+        self.block = Block(offset)
+        good_size = offset
+        for record_offset, record in self.read_records(offset, self.size):
+            event = decode_event(record)
+            if event is None:
+                break
+            self.block.add(event, event['timestamp_ns'], len(record))
+            good_size = record_offset + len(record)
+            if self.block.count >= self.block_size:
+                self.__close_block()
+        if good_size != self.size:
+            # Torn write at the end of the segment.
+            Llog.LogError("Truncating " + self.path + " to "
+                          + str(good_size) + " bytes")
+            self.f.truncate(good_size)
+            self.f.seek(good_size)
+            self.size = good_size
+
+    def load_index(self):
+        self.blocks = []
+        self.summary = Block(0)
+        if not os.path.exists(self.index_path):
+            return
+        f = open(self.index_path, "r")
+        for line in f:
+            try:
+                block = Block.FromLine(line)
+            except ValueError:
+                # A partially written last line.
+                break
+            self.blocks.append(block)
+            self.summary.merge(block)
+        f.close()
+
+    def size_on_disk(self):
+        if self.f is not None:
+            return self.size
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, event, record):
+        self.f.write(record)
+        self.block.add(event, struct.unpack_from("<q", record, 4)[0],
+                       len(record))
+        self.size += len(record)
+        if self.block.count >= self.block_size:
+            self.__close_block()
+
+    def __close_block(self):
+        self.f.flush()
+        self.index_f.write(self.block.to_line())
+        self.index_f.flush()
+        self.blocks.append(self.block)
+        self.summary.merge(self.block)
+        self.block = Block(self.block.offset + self.block.size)
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        # Close the last, partial block and sync the segment to disk.
+        if self.f is None:
+            return
+        if self.block.count > 0:
+            self.__close_block()
+        os.fsync(self.f.fileno())
+        os.fsync(self.index_f.fileno())
+        self.f.close()
+        self.index_f.close()
+        self.f = None
+        self.index_f = None
+        self.block = None
+
+    def all_blocks(self):
+        if self.block is not None and self.block.count > 0:
+            return self.blocks + [self.block]
+        return self.blocks[:]
+
+    def read_records(self, offset, end, count=None, f=None):
+        # Generator of (offset, record) pairs, read from a separate
+        # file handle so the writer is not disturbed.
+        if f is None:
+            f = open(self.path, "rb")
+            own_f = True
+        else:
+            own_f = False
+        try:
+            f.seek(offset)
+            nr_records = 0
+            while offset < end and (count is None or nr_records < count):
+                header = f.read(RECORD_HEADER_SIZE)
+                if len(header) < RECORD_HEADER_SIZE:
+                    return
+                length = struct.unpack_from("<I", header, 0)[0]
+                if length < RECORD_HEADER_SIZE:
+                    return
+                body = f.read(length - RECORD_HEADER_SIZE)
+                if len(body) < length - RECORD_HEADER_SIZE:
+                    return
+                yield (offset, header + body)
+                offset += length
+                nr_records += 1
+        finally:
+            if own_f is True:
+                f.close()
+
+    def remove(self):
+        self.close()
+        for path in [self.path, self.index_path]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class EventStore():
+
+    # Maximum segment size, in bytes, and age, in seconds, before the
+    # segment is closed and a new one started.
+    segment_size = 64 * 1024 * 1024
+    segment_age = 3600
+    # Records per sparse index entry
+    block_size = 256
+
+    class Stats():
+        def __init__(self):
+            self.appended = 0
+            self.bytes = 0
+            self.rotations = 0
+            self.queries = 0
+            self.blocks_read = 0
+            self.blocks_skipped = 0
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.segment_size = EventStore.segment_size
+        self.segment_age = EventStore.segment_age
+        self.block_size = EventStore.block_size
+        self.stats = EventStore.Stats()
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        self.segments = []
+        numbers = sorted([int(f_name[:-4])
+                          for f_name in os.listdir(store_dir)
+                          if f_name.endswith(".seg")
+                          and f_name[:-4].isdigit()])
+        for number in numbers:
+            segment = Segment(store_dir, number)
+            segment.load_index()
+            self.segments.append(segment)
+
+        if len(self.segments) > 0:
+            # Carry on appending to the last segment
+            self.active = self.segments[-1]
+            self.active.open(self.block_size)
+        else:
+            self.active = None
+            self.__rotate()
+
+    def __rotate(self):
+        number = 1
+        if self.active is not None:
+            self.active.close()
+            number = self.active.number + 1
+            self.stats.rotations += 1
+        self.active = Segment(self.store_dir, number)
+        self.active.open(self.block_size)
+        if self.active not in self.segments:
+            self.segments.append(self.active)
+
+    def append(self, event):
+        record = encode_event(event)
+        self.lock.acquire()
+        try:
+            if self.active.size > 0 and \
+               (self.active.size + len(record) > self.segment_size or
+                time.time() - self.active.created > self.segment_age):
+                self.__rotate()
+            self.active.append(event, record)
+            self.stats.appended += 1
+            self.stats.bytes += len(record)
+        finally:
+            self.lock.release()
+
+    def rotate(self):
+        self.lock.acquire()
+        try:
+            if self.active.size > 0:
+                self.__rotate()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.active.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.active.close()
+        finally:
+            self.lock.release()
+
+    def query(self, start_ns=None, end_ns=None, user_name=None,
+              application_name=None, event_type=None):
+        # Generator of the stored events with start_ns <= timestamp
+        # < end_ns, matching the filters given, in the order they were
+        # stored.  Events appended after the query started may or may
+        # not be returned.
+        self.lock.acquire()
+        try:
+            self.active.flush()
+            plan = []
+            for segment in self.segments:
+                summary = Block(0)
+                blocks = segment.all_blocks()
+                for block in blocks:
+                    summary.merge(block)
+                if summary.match(start_ns, end_ns, user_name,
+                                 application_name, event_type) is False:
+                    self.stats.blocks_skipped += len(blocks)
+                    continue
+                # Pin the segment, so compaction does not replace the
+                # file before we get to it.  It is opened when read.
+                segment.readers += 1
+                plan.append((segment, blocks))
+            self.stats.queries += 1
+        finally:
+            self.lock.release()
+
+        # A query abandoned part way closes its file and unpins the
+        # segments left, once the generator is closed or collected.
+        try:
+            while len(plan) > 0:
+                segment, blocks = plan[0]
+                f = open(segment.path, "rb")
+                try:
+                    for event in self.__query_segment(segment, blocks, f,
+                                                      start_ns, end_ns,
+                                                      user_name,
+                                                      application_name,
+                                                      event_type):
+                        yield event
+                finally:
+                    f.close()
+                self.__unpin([plan.pop(0)[0]])
+        finally:
+            self.__unpin([segment for segment, blocks in plan])
+
+    def __query_segment(self, segment, blocks, f, start_ns, end_ns,
+                        user_name, application_name, event_type):
+        for block in blocks:
+            if block.match(start_ns, end_ns, user_name,
+                           application_name, event_type) is False:
+                self.stats.blocks_skipped += 1
+                continue
+            self.stats.blocks_read += 1
+            for offset, record in segment.read_records(
+                                        block.offset,
+                                        block.offset + block.size,
+                                        block.count,
+                                        f):
+                event = decode_event(record)
+                if event is None:
+                    Llog.LogError("Corrupt record in " + segment.path
+                                  + " at offset " + str(offset))
+                    break
+                if start_ns is not None and \
+                   event['timestamp_ns'] < start_ns:
+                    continue
+                if end_ns is not None and event['timestamp_ns'] >= end_ns:
+                    continue
+                if user_name is not None and \
+                   event['user_name'] != user_name:
+                    continue
+                if application_name is not None and \
+                   event['application_name'] != application_name:
+                    continue
+                if event_type is not None and event['type'] != event_type:
+                    continue
+                yield event
+
+    def __unpin(self, segments):
+        self.lock.acquire()
+        try:
+            for segment in segments:
+                segment.readers -= 1
+        finally:
+            self.lock.release()
+
+    def compact(self, min_timestamp_ns=None):
+        # Drop the events older than min_timestamp_ns, and merge runs of
+        # small closed segments into one.  The active segment, and the
+        # segments open queries are reading, are not touched.  Returns
+        # the number of segments removed.
+        self.lock.acquire()
+        try:
+            closed = [segment for segment in self.segments
+                      if segment is not self.active]
+        finally:
+            self.lock.release()
+
+        removed = 0
+        run = []
+        for segment in closed:
+            if min_timestamp_ns is not None and \
+               segment.summary.count > 0 and \
+               segment.summary.max_ts < min_timestamp_ns:
+                # Entirely expired
+                removed += self.__remove_segments([segment])
+                continue
+
+            expired = min_timestamp_ns is not None and \
+                      segment.summary.count > 0 and \
+                      segment.summary.min_ts < min_timestamp_ns
+            small = segment.size_on_disk() < self.segment_size / 4
+            if len(run) > 0 and \
+               (small is False or
+                sum([seg.size_on_disk() for seg in run])
+                    + segment.size_on_disk() > self.segment_size):
+                removed += self.__compact_run(run, min_timestamp_ns)
+                run = []
+            if small is True or expired is True:
+                run.append(segment)
+        removed += self.__compact_run(run, min_timestamp_ns)
+        return removed
+
+    def __compact_run(self, run, min_timestamp_ns):
+        if len(run) == 0:
+            return 0
+        if len(run) == 1 and \
+           (min_timestamp_ns is None or
+            run[0].summary.count == 0 or
+            run[0].summary.min_ts >= min_timestamp_ns):
+            # Nothing to merge with and nothing expired
+            return 0
+        if self.__merge(run, min_timestamp_ns) is False:
+            return 0
+        return len(run) - 1
+
+    def __merge(self, segments, min_timestamp_ns):
+        # Rewrite the segments into a temporary segment, then replace the
+        # first of them with it.  The segment number is kept so the
+        # segments stay in order.  Returns False, leaving the segments
+        # as they were, if a query started reading them meanwhile.
+        tmp_dir = os.path.join(self.store_dir, "compact.tmp")
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        merged = Segment(tmp_dir, segments[0].number)
+        merged.remove()
+        merged.open(self.block_size)
+        for segment in segments:
+            for offset, record in segment.read_records(
+                                        0, segment.size_on_disk()):
+                event = decode_event(record)
+                if event is None:
+                    break
+                if min_timestamp_ns is not None and \
+                   event['timestamp_ns'] < min_timestamp_ns:
+                    continue
+                merged.append(event, record)
+        merged.close()
+
+        self.lock.acquire()
+        try:
+            pinned = [segment for segment in segments
+                      if segment.readers > 0]
+            if len(pinned) == 0:
+                target = segments[0]
+                os.rename(merged.path, target.path)
+                os.rename(merged.index_path, target.index_path)
+                target.load_index()
+                for segment in segments[1:]:
+                    segment.remove()
+                    self.segments.remove(segment)
+        finally:
+            self.lock.release()
+        if len(pinned) > 0:
+            merged.remove()
+        os.rmdir(tmp_dir)
+        return len(pinned) == 0
+
+    def __remove_segments(self, segments):
+        # Returns the number of segments removed
+        removed = 0
+        self.lock.acquire()
+        try:
+            for segment in segments:
+                if segment.readers > 0:
+                    continue
+                segment.remove()
+                self.segments.remove(segment)
+                removed += 1
+        finally:
+            self.lock.release()
+        return removed
+
+
+def make_event(i, timestamp_ns, user_name="sysadmin", app_name="store",
+               event_type="VALUE"):
+    return {'type': event_type,
+            'name': "tick",
+            'timestamp_ns': timestamp_ns,
+            'user_name': user_name,
+            'application_name': app_name,
+            'sequence': i,
+            'contents': [str(i), "x" * (i % 7)]}
+
+
+def test1():
+
+    # Append across several segments, then query by time range and
+    # by user/application/type.
+    import shutil
+    store_dir = "test1-store"
+    shutil.rmtree(store_dir, True)
+    store = EventStore(store_dir)
+    store.segment_size = 16 * 1024
+    store.block_size = 16
+
+    base_ns = 1000000000000
+    for i in range(1000):
+        user_name = ["alice", "bob"][i % 2]
+        event_type = "VALUE"
+        if i % 100 == 0:
+            event_type = "STATE"
+        store.append(make_event(i, base_ns + i * 1000, user_name,
+                                "store", event_type))
+    assert(len(store.segments) > 2)
+
+    store.append({'type': "NUMERIC",
+                  'name': "samples",
+                  'timestamp_ns': base_ns + 1000 * 1000,
+                  'user_name': "alice",
+                  'application_name': "store",
+                  'contents': [1.5, numeric.decode(numeric.encode([1, 2]))]})
+    events = list(store.query(event_type="NUMERIC"))
+    assert(events[0]['contents'][0] == 1.5)
+    assert(list(events[0]['contents'][1]) == [1, 2])
+
+    # Text and other objects are stored as strings
+    record = encode_event({'type': "TEXT", 'name': "labels",
+                           'user_name': "alice",
+                           'application_name': "store",
+                           'contents': [u"caf\xe9", None, {'a': 1},
+                                        [1, "x"]]})
+    assert(decode_event(record)['contents'] == ["caf\xc3\xa9", "None",
+                                                "{'a': 1}", "[1, 'x']"])
+
+    events = list(store.query(end_ns=base_ns + 1000 * 1000))
+    assert(len(events) == 1000)
+    assert(events[10]['contents'] == ["10", "xxx"])
+    assert(events[10]['user_name'] == "alice")
+    assert(events[10]['timestamp_ns'] == base_ns + 10000)
+
+    store.stats.blocks_read = 0
+    events = list(store.query(base_ns + 500 * 1000, base_ns + 520 * 1000))
+    assert([event['sequence'] for event in events] == range(500, 520))
+    # Only the blocks holding the range were read
+    assert(store.stats.blocks_read <= 3)
+
+    events = list(store.query(user_name="bob"))
+    assert(len(events) == 500)
+    events = list(store.query(event_type="STATE"))
+    assert([event['sequence'] for event in events] == range(0, 1000, 100))
+    assert(list(store.query(application_name="nosuchapp")) == [])
+
+    # Reopen and carry on where we left off
+    store.close()
+    store = EventStore(store_dir)
+    store.append(make_event(1000, base_ns + 1000 * 1000))
+    assert(len(list(store.query())) == 1002)
+    store.close()
+    shutil.rmtree(store_dir, True)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # Records written after the last index line are recovered, and a
+    # torn record at the end of the segment is dropped.
+    import shutil
+    store_dir = "test2-store"
+    shutil.rmtree(store_dir, True)
+    store = EventStore(store_dir)
+    store.block_size = 4
+    store.active.block_size = 4
+    for i in range(10):
+        store.append(make_event(i, 1000 + i))
+    store.flush()
+    # Simulate a crash part way through a write
+    f = open(store.active.path, "ab")
+    f.write(encode_event(make_event(10, 1010))[:7])
+    f.close()
+
+    store = EventStore(store_dir)
+    assert([event['sequence'] for event in store.query()] == range(10))
+    store.append(make_event(10, 1010))
+    assert([event['sequence'] for event in store.query()] == range(11))
+    store.close()
+    shutil.rmtree(store_dir, True)
+    print "test2() PASSED"
+
+
+def test3():
+
+    # Compaction drops expired events and merges small segments.
+    import shutil
+    store_dir = "test3-store"
+    shutil.rmtree(store_dir, True)
+    store = EventStore(store_dir)
+    store.segment_size = 64 * 1024
+    for i in range(100):
+        store.append(make_event(i, 1000 + i))
+        if i % 10 == 9:
+            store.rotate()
+    assert(len(store.segments) == 11)
+
+    removed = store.compact(1025)
+    # 2 segments expired, the other 8 closed ones are merged.
+    assert(removed == 9)
+    assert(len(store.segments) == 2)
+    events = list(store.query())
+    assert([event['sequence'] for event in events] == range(25, 100))
+
+    # A query left part way keeps its segments from being compacted,
+    # until it is closed, which unpins them and closes the file.
+    for i in range(100, 110):
+        store.append(make_event(i, 1000 + i))
+    store.rotate()
+    query = store.query()
+    assert(query.next()['sequence'] == 25)
+    assert(store.segments[0].readers == 1)
+    assert(store.compact(1050) == 0)
+    query.close()
+    assert(sum([segment.readers for segment in store.segments]) == 0)
+    assert(store.compact(1050) == 1)
+    assert([event['sequence'] for event in store.query()] ==
+                range(50, 110))
+
+    store.close()
+    store = EventStore(store_dir)
+    assert(len(list(store.query())) == 60)
+    store.close()
+    shutil.rmtree(store_dir, True)
+    print "test3() PASSED"
+
+
+def bench1():
+    import shutil
+    store_dir = "bench1-store"
+    shutil.rmtree(store_dir, True)
+    store = EventStore(store_dir)
+    nr_events = 100000
+    start = time.time()
+    for i in xrange(nr_events):
+        store.append(make_event(i, 1000 + i))
+    store.flush()
+    append_elapsed = time.time() - start
+
+    start = time.time()
+    events = list(store.query(1000 + nr_events / 2,
+                              1000 + nr_events / 2 + 1000))
+    query_elapsed = time.time() - start
+    assert(len(events) == 1000)
+    store.close()
+    shutil.rmtree(store_dir, True)
+    print "bench1() " + str(int(nr_events / append_elapsed)) \
+          + " appends/s, 1000 event range query in " \
+          + "%.4f" % query_elapsed + "s"
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
+    bench1()
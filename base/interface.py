@@ -8,13 +8,19 @@ import threading
 import time
 import zmq
 import types
-from apphost.base import zhelpers, zsocket, log
+from apphost.base import zhelpers, zsocket, log, stats
 
 
 class Interface(log.Logger):
 
     """
     """
+    class Stats():
+        def __init__(self):
+            # Messages pushed into the interface thread, and processed
+            self.in_msgs = 0
+            self.in_msgs_processed = 0
+
     def __init__(self, rx_cback=None, action_cback=None, timer_cback=None):
 
         log.Logger.__init__(self)
@@ -32,9 +38,11 @@ class Interface(log.Logger):
         self.sys_timer = None
         self.timers = []
 
+        self.stats = Interface.Stats()
         self.thread = threading.Thread(target=self.__thread_entry)
         self.thread.daemon = True
         self.thread.start()
+        stats.StatsRegistry.Register("interface", self)
 
     def __del__(self):
         # Ensure the caller closed this interface
@@ -42,6 +50,18 @@ class Interface(log.Logger):
             self.log_error("Interface not closed properly!")
             assert(False)
 
+    def stats_label(self):
+        # Named after the first socket added, e.g. the server socket of
+        # a protocol.  The slice keeps this safe against remove_socket()
+        # in the interface thread.
+        for zskt in self.sockets[:1]:
+            return zskt.stats_label()
+        return self.thread.name
+
+    def stats_extra(self):
+        return {'queue_depth': self.stats.in_msgs
+                               - self.stats.in_msgs_processed}
+
     def add_timer(self, name, duration):
         # Ensure this timer name is unique in our list, then
         # add it.
@@ -193,6 +213,7 @@ class Interface(log.Logger):
         msg = self.in_pipe[1].recv()
         if msg is None:
             return
+        self.stats.in_msgs_processed += 1
 
         # In the interface layer, there are only a few valid
         # message types:
@@ -250,6 +271,7 @@ class Interface(log.Logger):
     def __push_in_msg_raw(self, msg):
         assert(isinstance(msg, types.DictType) is True)
         assert('message' in msg)
+        self.stats.in_msgs += 1
         self.in_pipe[0].send(msg)
 
 
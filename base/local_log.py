@@ -1,7 +1,7 @@
 """
 """
-import time
 import inspect
+from timestamp import Timestamp
 
 
 class Llog():
@@ -31,7 +31,7 @@ class Llog():
         if levels[level] > levels[self.level]:
             return
 
-        logmsg = time.strftime("%x-%X") + " <" + level + ">"
+        logmsg = Timestamp.NowText() + " <" + level + ">"
         if self.verbose is True:
             logmsg = logmsg + "(" + filename + ":" + line + ")"
         logmsg = logmsg + " " + msg
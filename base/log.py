@@ -1,7 +1,7 @@
 """
 """
-import time
 import inspect
+from timestamp import Timestamp
 
 
 class Logger(object):
@@ -26,7 +26,7 @@ class Logger(object):
         assert(False)
 
     def __print_msg(self, level, msg, filename, line):
-        logmsg = time.strftime("%x-%X") + " <" + level + ">"
+        logmsg = Timestamp.NowText() + " <" + level + ">"
         logmsg += " " + self.__class__.__name__
         if self.verbose is True:
             logmsg = logmsg + "(" + filename + ":" + line + ")"
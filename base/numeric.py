@@ -0,0 +1,238 @@
+"""
+    Typed binary payloads for NUMERIC events.
+
+    Rather than sending numbers as text, to be parsed back by every
+    consumer, a NUMERIC event may carry its values as one binary contents
+    item:
+
+        <0xff> <tag> <little-endian data>
+
+    where the tag is:
+
+        i - one int64
+        f - one float64
+        I - array of int64
+        F - array of float64
+
+    The 0xff marker byte never starts a text value (it is not valid
+    ASCII or UTF-8), so binary and text contents can be told apart.  The
+    ZSocket framing carries the item lengths, so binary items need no
+    escaping.
+
+    Integers too large for int64 are sent as text instead.
+
+    Collectors get scalars back as numbers, and arrays as array.array
+    buffers, or NumPy arrays when NumPy is installed and asked for.
+"""
+import array
+import struct
+import sys
+import types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MARKER = "\xff"
+
+INT64 = "i"
+FLOAT64 = "f"
+INT64_ARRAY = "I"
+FLOAT64_ARRAY = "F"
+
+# array.array typecodes holding int64/float64 on this platform
+if array.array('l').itemsize == 8:
+    INT64_TYPECODE = 'l'
+else:
+    INT64_TYPECODE = None
+FLOAT64_TYPECODE = 'd'
+
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def is_encoded(item):
+    return isinstance(item, types.StringType) and item[:1] == MARKER
+
+
+def is_numeric(value):
+    # True for what encode() takes: numbers, numeric array.arrays and
+    # NumPy arrays, and lists or tuples of numbers.
+    if isinstance(value, (types.IntType, types.LongType, types.FloatType)):
+        return True
+    if isinstance(value, array.array):
+        return value.typecode in "bBhHiIlLfd"
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.dtype.kind in "iubf"
+    if isinstance(value, (types.ListType, types.TupleType)):
+        for item in value:
+            if not isinstance(item, (types.IntType, types.LongType,
+                                     types.FloatType)):
+                return False
+        return True
+    return False
+
+
+def encode(value):
+    # Encode an int, float, sequence of numbers, array.array or NumPy
+    # array.  Sequences are float64 unless every value is an int.
+    # Integers beyond int64 cannot be packed, and are sent as text.
+    try:
+        return pack(value)
+    except struct.error:
+        if isinstance(value, (types.IntType, types.LongType)):
+            return str(value)
+        return " ".join([str(item) for item in value])
+
+
+def pack(value):
+    # encode(), without the text fallback: raises struct.error for
+    # integers beyond int64.
+    if isinstance(value, types.BooleanType):
+        value = int(value)
+    if isinstance(value, (types.IntType, types.LongType)):
+        return MARKER + INT64 + struct.pack("<q", value)
+    if isinstance(value, types.FloatType):
+        return MARKER + FLOAT64 + struct.pack("<d", value)
+
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if value.dtype.kind in "iub":
+            return MARKER + INT64_ARRAY + value.astype("<i8").tostring()
+        return MARKER + FLOAT64_ARRAY + value.astype("<f8").tostring()
+
+    if isinstance(value, array.array):
+        if value.typecode in "bBhHiIlL":
+            tag = INT64_ARRAY
+            fmt = "q"
+        else:
+            tag = FLOAT64_ARRAY
+            fmt = "d"
+    else:
+        tag = INT64_ARRAY
+        fmt = "q"
+        for item in value:
+            if not isinstance(item, (types.IntType, types.LongType)):
+                tag = FLOAT64_ARRAY
+                fmt = "d"
+                break
+    return MARKER + tag + struct.pack("<%d%s" % (len(value), fmt), *value)
+
+
+def decode(item, as_numpy=False):
+    # Returns the number or array carried by an encoded item.  Raises
+    # ValueError if the item is not a valid encoding.
+    if not is_encoded(item) or len(item) < 2:
+        raise ValueError("not an encoded numeric payload")
+    tag = item[1]
+    data = item[2:]
+
+    if tag == INT64 or tag == FLOAT64:
+        if len(data) != 8:
+            raise ValueError("bad scalar length")
+        if tag == INT64:
+            return struct.unpack("<q", data)[0]
+        return struct.unpack("<d", data)[0]
+
+    if tag not in [INT64_ARRAY, FLOAT64_ARRAY] or len(data) % 8 != 0:
+        raise ValueError("bad numeric payload")
+
+    if as_numpy is True:
+        assert(numpy is not None)
+        if tag == INT64_ARRAY:
+            return numpy.frombuffer(data, dtype="<i8")
+        return numpy.frombuffer(data, dtype="<f8")
+
+    if tag == INT64_ARRAY:
+        if INT64_TYPECODE is None:
+            return list(struct.unpack("<%dq" % (len(data) // 8), data))
+        values = array.array(INT64_TYPECODE)
+    else:
+        values = array.array(FLOAT64_TYPECODE)
+    values.fromstring(data)
+    if LITTLE_ENDIAN is False:
+        values.byteswap()
+    return values
+
+
+def decode_contents(contents):
+    # Decode the encoded items of a contents list, leaving any text
+    # items as they are.
+    decoded = []
+    for item in contents:
+        if is_encoded(item):
+            try:
+                item = decode(item)
+            except ValueError:
+                pass
+        decoded.append(item)
+    return decoded
+
+
+def test1():
+    assert(decode(encode(42)) == 42)
+    assert(decode(encode(-2 ** 62)) == -2 ** 62)
+    assert(decode(encode(1.2345)) == 1.2345)
+    assert(decode(encode(True)) == 1)
+
+    ints = decode(encode([1, 2, 3]))
+    assert(list(ints) == [1, 2, 3])
+    floats = decode(encode([1, 2.5, 3]))
+    assert(isinstance(floats, array.array))
+    assert(list(floats) == [1.0, 2.5, 3.0])
+    assert(list(decode(encode(array.array('d', [0.5, 1.5])))) == [0.5, 1.5])
+    assert(list(decode(encode(array.array('i', [7, 8])))) == [7, 8])
+    assert(list(decode(encode([]))) == [])
+    # Too big for int64
+    assert(encode(2 ** 63) == "9223372036854775808")
+    assert(encode([1, -2 ** 64]) == "1 -18446744073709551616")
+    assert(decode_contents([encode(2 ** 70)]) == [str(2 ** 70)])
+
+    assert(is_numeric(3) and is_numeric([1, 2.5]) and is_numeric(()))
+    assert(is_numeric(array.array('d', [0.5])))
+    assert(not is_numeric("3") and not is_numeric(u"3"))
+    assert(not is_numeric([1, "2"]) and not is_numeric({'a': 1}))
+    assert(not is_numeric(None) and not is_numeric(array.array('c', "x")))
+
+    # 10000 samples in 80KB, rather than text
+    samples = [i * 0.001 for i in range(10000)]
+    assert(len(encode(samples)) == 2 + 80000)
+
+    assert(decode_contents(["12.5", encode(3), "x"]) == ["12.5", 3, "x"])
+    assert(is_encoded("12.5") is False)
+    for bad in ["", "\xff", "\xffi123", "\xffz12345678", "\xffF1234567"]:
+        try:
+            decode(bad)
+            assert(False)
+        except ValueError:
+            pass
+
+    if numpy is not None:
+        values = decode(encode(numpy.arange(5, dtype=float)), as_numpy=True)
+        assert(list(values) == [0.0, 1.0, 2.0, 3.0, 4.0])
+        values = decode(encode(numpy.arange(3)), as_numpy=True)
+        assert(values.dtype.kind == "i")
+    print "test1() PASSED"
+
+
+def bench1():
+    import time
+    samples = [i * 0.001 for i in range(1000)]
+    nr_loops = 200
+
+    start = time.time()
+    for i in xrange(nr_loops):
+        [float(item) for item in [repr(sample) for sample in samples]]
+    text_elapsed = time.time() - start
+
+    start = time.time()
+    for i in xrange(nr_loops):
+        decode(encode(samples))
+    binary_elapsed = time.time() - start
+    print "bench1() 1000 samples text: " + "%.2f" % \
+          (text_elapsed / nr_loops * 1000) + "ms, binary: " + "%.2f" % \
+          (binary_elapsed / nr_loops * 1000) + "ms"
+
+
+if __name__ == '__main__':
+    test1()
+    bench1()
@@ -9,6 +9,7 @@ import zmq
 import types
 import zsocket
 import log 
+import stats
 from override import *
 
 
@@ -18,6 +19,8 @@ class Protocol(log.Logger):
     """
     class Stats():
         def __init__(self):
+            self.rx_msgs = 0
+            self.tx_msgs = 0
             self.rx_err_bad_header = 0
             self.rx_err_invalid = 0
 
@@ -31,6 +34,7 @@ class Protocol(log.Logger):
         self.log_level = "D"
 
         self.stats = Protocol.Stats()
+        stats.StatsRegistry.Register("protocol", self)
         self.location = location
         self.messages = messages
         self.states = states
@@ -74,6 +78,9 @@ class Protocol(log.Logger):
                      + str(len(messages)) + " messages, "
                      + str(len(states)) + " states.")
 
+    def stats_label(self):
+        return self.name
+
     def __timer_cback(self, timer_name):
         # Check to see if this is our keepalive
         if timer_name == "keep-alive":
@@ -317,6 +324,7 @@ class Protocol(log.Logger):
         msg = self.__rx_filter(msg)
         if msg is None:
             return
+        self.stats.rx_msgs += 1
 
         # For protocol servers, we need to keep track of the address
         # which has just sent us a message.  For multi-servers, this will
@@ -407,6 +415,7 @@ class Protocol(log.Logger):
         if self.address != "":
             msg['address'] = self.address
         self.log_debug("Sending: " + msg['message'][0])
+        self.stats.tx_msgs += 1
         self.interface.push_in_msg(msg)
 
     def close(self):
@@ -0,0 +1,326 @@
+"""
+    Token bucket rate limiting of published events.
+
+    Each user gets one TokenBucket per process, shared by all the user's
+    EventSockets (and so by the AppEventProxy of every application hosted
+    for the user).  The bucket refills at the SLA rate,
+    max_tx_events_per_minute / 60 events per second, and holds at most
+    burst_seconds worth of events.  With the default of 60 seconds, a
+    quiet user may still send a whole minute's worth in one burst.
+
+    What happens to an event which finds the bucket empty depends on the
+    overflow policy:
+
+        drop     - the event is dropped.
+        sample   - one in every sample_every overflowing events is sent
+                   anyway, the others are dropped.  Subscribers still see
+                   a trickle of what the application is doing.  Sampled
+                   events borrow their tokens, down to one burst of debt,
+                   so they still count against the rate.
+        coalesce - the latest event of each type/name is held, replacing
+                   any earlier one, and sent when tokens are available
+                   again.  Subscribers see the latest value, late, rather
+                   than every value.
+
+    The events of the host's own telemetry (SYSTEM_TYPES: vitals, which
+    include the STATS exports, and alerts) are charged to a second bucket
+    per user, of system_events_per_minute, always under the drop policy.
+    So a busy application does not silence its vitals, and the vitals
+    do not use up the application's SLA.  Only the host's own senders
+    use it (see EventSocket.send()): VITAL or ALERT events published by
+    an application are charged to the application's bucket.
+
+    A message carrying a batch of more events than the burst costs the
+    whole burst, rather than never fitting.
+"""
+import threading
+import time
+import system
+
+POLICIES = ["drop", "sample", "coalesce"]
+SYSTEM_TYPES = ["VITAL", "ALERT"]
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        # rate in tokens per second, burst in tokens.
+        assert(rate > 0)
+        assert(burst >= 1)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def __refill(self, now):
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last_time = now
+
+    def consume(self, nr_tokens=1, now=None):
+        # Returns True if the tokens were available, and takes them.
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.__refill(now)
+            if self.tokens >= nr_tokens:
+                self.tokens -= nr_tokens
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def borrow(self, nr_tokens=1, now=None):
+        # Takes the tokens even if they are not there, as long as the
+        # debt stays within one burst.  Returns False if it would not.
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.__refill(now)
+            if self.tokens - nr_tokens < -self.burst:
+                return False
+            self.tokens -= nr_tokens
+            return True
+        finally:
+            self.lock.release()
+
+    def wait_time(self, nr_tokens=1, now=None):
+        # Seconds until nr_tokens are available.
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.__refill(now)
+            if self.tokens >= nr_tokens:
+                return 0.0
+            return (nr_tokens - self.tokens) / self.rate
+        finally:
+            self.lock.release()
+
+
+class RateLimiter(object):
+
+    """
+        Applies the user's bucket and the overflow policy to the events
+        of one EventSocket.  The caller serializes the calls.
+    """
+
+    policy = "drop"
+    sample_every = 10
+    burst_seconds = 60
+    system_events_per_minute = 600
+
+    # user name, or (user name, "system") -> TokenBucket
+    buckets = {}
+    buckets_lock = threading.Lock()
+
+    class Stats():
+        def __init__(self):
+            self.accepted = 0
+            self.dropped = 0
+            self.sampled = 0
+            self.coalesced = 0
+            # Every event which found the bucket empty
+            self.overflows = 0
+
+    def __init__(self, user_name, policy=None, system=False):
+        # system selects the user's SYSTEM_TYPES bucket.
+        if system is True:
+            policy = "drop"
+        if policy is None:
+            policy = RateLimiter.policy
+        assert(policy in POLICIES)
+
+        self.user_name = user_name
+        self.policy = policy
+        self.bucket = RateLimiter.GetBucket(user_name, system)
+        self.stats = RateLimiter.Stats()
+        # (type, name) -> latest held message, in arrival order
+        self.pending = {}
+        self.pending_order = []
+        self.sample_count = 0
+
+    @staticmethod
+    def GetBucket(user_name, system_bucket=False):
+        key = user_name
+        if system_bucket is True:
+            key = (user_name, "system")
+        RateLimiter.buckets_lock.acquire()
+        try:
+            bucket = RateLimiter.buckets.get(key)
+            if bucket is None:
+                if system_bucket is True:
+                    per_minute = RateLimiter.system_events_per_minute
+                else:
+                    sla = system.System.GetSLA()
+                    per_minute = sla['max_tx_events_per_minute']
+                rate = per_minute / 60.0
+                bucket = TokenBucket(rate,
+                                     max(1, rate * RateLimiter.burst_seconds))
+                RateLimiter.buckets[key] = bucket
+            return bucket
+        finally:
+            RateLimiter.buckets_lock.release()
+
+    def max_batch(self):
+        # Largest number of events worth sending in one message
+        return int(self.bucket.burst)
+
+    def __cost(self, nr_events):
+        # Tokens taken by a message of nr_events events.  Capped at the
+        # burst, or a large batch could never be sent, and under
+        # coalesce would hold up every later event.
+        return min(nr_events, self.bucket.burst)
+
+    def check(self, key, msg, nr_events=1):
+        # Returns True if the message may be sent now.  Otherwise the
+        # message has been dropped, or held for take_pending().
+        if len(self.pending_order) == 0 and \
+           self.bucket.consume(self.__cost(nr_events)) is True:
+            self.stats.accepted += nr_events
+            return True
+
+        self.stats.overflows += nr_events
+        if self.policy == "coalesce":
+            if key in self.pending:
+                # The held message is replaced
+                self.stats.coalesced += 1
+            else:
+                self.pending_order.append(key)
+            self.pending[key] = (msg, nr_events)
+            return False
+
+        if self.policy == "sample":
+            self.sample_count += 1
+            if self.sample_count % self.sample_every == 0 and \
+               self.bucket.borrow(self.__cost(nr_events)) is True:
+                self.stats.sampled += nr_events
+                return True
+
+        self.stats.dropped += nr_events
+        return False
+
+    def take_pending(self):
+        # Returns the held messages which now fit in the bucket, in the
+        # order their type/name was first held.
+        msgs = []
+        while len(self.pending_order) > 0:
+            key = self.pending_order[0]
+            msg, nr_events = self.pending[key]
+            if self.bucket.consume(self.__cost(nr_events)) is False:
+                break
+            self.pending_order.pop(0)
+            del self.pending[key]
+            self.stats.accepted += nr_events
+            msgs.append(msg)
+        return msgs
+
+    def pending_wait_time(self):
+        # Seconds until the next held message fits, or None.
+        if len(self.pending_order) == 0:
+            return None
+        msg, nr_events = self.pending[self.pending_order[0]]
+        return self.bucket.wait_time(self.__cost(nr_events))
+
+
+def test1():
+
+    bucket = TokenBucket(10, 5)
+    now = bucket.last_time
+    for i in range(5):
+        assert(bucket.consume(1, now) is True)
+    assert(bucket.consume(1, now) is False)
+    assert(abs(bucket.wait_time(1, now) - 0.1) < 1e-6)
+    # 0.35s later, 3 tokens have come back
+    assert(bucket.consume(3, now + 0.35) is True)
+    assert(bucket.consume(1, now + 0.35) is False)
+    # Never more than the burst
+    assert(bucket.consume(6, now + 100) is False)
+    assert(bucket.consume(5, now + 100) is True)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # The overflow policies
+    RateLimiter.buckets = {}
+    RateLimiter.buckets["drop"] = TokenBucket(1, 2)
+    limiter = RateLimiter("drop", "drop")
+    results = [limiter.check(("V", "x"), i) for i in range(5)]
+    assert(results == [True, True, False, False, False])
+    assert(limiter.stats.dropped == 3)
+
+    RateLimiter.buckets["sample"] = TokenBucket(1, 2)
+    limiter = RateLimiter("sample", "sample")
+    limiter.sample_every = 3
+    results = [limiter.check(("V", "x"), i) for i in range(8)]
+    assert(results == [True, True, False, False, True, False, False, True])
+    assert(limiter.stats.sampled == 2)
+    assert(limiter.stats.overflows == 6)
+    # The sampled events are in debt to the bucket, up to one burst
+    assert(limiter.bucket.tokens < -1)
+    results = [limiter.check(("V", "x"), i) for i in range(9)]
+    assert(results == [False] * 9)
+    assert(limiter.stats.sampled == 2)
+
+    RateLimiter.buckets["coalesce"] = TokenBucket(1000, 2)
+    limiter = RateLimiter("coalesce", "coalesce")
+    limiter.bucket.tokens = 2
+    limiter.bucket.rate = 1e-9
+    assert(limiter.check(("V", "x"), "x0") is True)
+    assert(limiter.check(("V", "y"), "y0") is True)
+    assert(limiter.check(("V", "x"), "x1") is False)
+    assert(limiter.check(("V", "y"), "y1") is False)
+    assert(limiter.check(("V", "x"), "x2") is False)
+    assert(limiter.stats.coalesced == 1)
+    assert(limiter.take_pending() == [])
+    assert(limiter.pending_wait_time() > 0)
+    limiter.bucket.tokens = 2
+    # Latest value of each, in order
+    assert(limiter.take_pending() == ["x2", "y1"])
+    assert(limiter.pending_wait_time() is None)
+    RateLimiter.buckets = {}
+    print "test2() PASSED"
+
+
+def test3():
+
+    # A batch larger than the burst costs the burst, and under coalesce
+    # does not hold up the events behind it.
+    RateLimiter.buckets = {}
+    RateLimiter.buckets["big"] = TokenBucket(1000, 100)
+    limiter = RateLimiter("big", "coalesce")
+    assert(limiter.max_batch() == 100)
+    assert(limiter.check(("NUMERIC", "x"), "batch", 150) is True)
+    assert(limiter.bucket.tokens < 1)
+    assert(limiter.check(("NUMERIC", "x"), "batch2", 150) is False)
+    assert(limiter.pending_wait_time() <= 0.1 + 1e-6)
+    limiter.bucket.tokens = 100
+    assert(limiter.take_pending() == ["batch2"])
+    assert(limiter.check(("STATE", "y"), "state") is False)
+    limiter.bucket.tokens = 1
+    assert(limiter.take_pending() == ["state"])
+
+    # The system types have their own bucket
+    RateLimiter.buckets = {}
+    RateLimiter.buckets["app"] = TokenBucket(1e-9, 1)
+    limiter = RateLimiter("app")
+    vitals = RateLimiter("app", "coalesce", system=True)
+    assert(vitals.policy == "drop")
+    assert(vitals.bucket is not limiter.bucket)
+    assert(vitals.bucket.rate == RateLimiter.system_events_per_minute / 60.0)
+    assert(limiter.check(("NUMERIC", "x"), "a") is True)
+    assert(limiter.check(("NUMERIC", "x"), "b") is False)
+    assert(vitals.check(("VITAL", "x"), "v") is True)
+    RateLimiter.buckets = {}
+    print "test3() PASSED"
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
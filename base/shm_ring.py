@@ -0,0 +1,267 @@
+"""
+    Shared memory ring buffer.
+
+    A single-producer/single-consumer ring of fixed-size binary records,
+    kept in a memory-mapped file.  It is used to move numeric tick
+    events from a hosted application to the host without paying for a
+    ZMQ message and string formatting per event.
+
+    The host (consumer) creates the ring file in the application's
+    working directory before the application starts.  The application
+    (producer) opens it and appends records.
+
+    File layout (all integers little-endian):
+
+        offset   0: magic "APRB", version, record size, capacity (slots)
+        offset  64: head  - number of records written    (producer owned)
+                    drops - records dropped on a full ring (producer owned)
+        offset 128: tail  - number of records consumed   (consumer owned)
+        offset 192: capacity * record size bytes of records
+
+    Each record is:
+
+        <commit sequence> <timestamp ns> <value> <event name>
+            uint64            int64      float64   24 bytes
+
+    The producer fills in the record body first and writes the commit
+    sequence (head + 1) last.  The consumer only accepts a slot whose
+    commit sequence is exactly tail + 1, so it never reads a partially
+    written record, and never needs to read the producer's head.
+
+    There is no cross-process wakeup primitive available to both Python 2
+    and Java, so the consumer polls, backing off while the ring is empty.
+"""
+import mmap
+import os
+import struct
+import time
+
+MAGIC = "APRB"
+VERSION = 1
+
+HEADER_FORMAT = "<4sIII"
+RECORD_FORMAT = "<Qqd24s"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+NAME_SIZE = 24
+
+HEAD_OFFSET = 64
+DROPS_OFFSET = 72
+TAIL_OFFSET = 128
+DATA_OFFSET = 192
+
+
+def ring_file_name(user_name, application_name):
+    return ":".join([user_name, application_name]) + ".ring"
+
+
+class RingBuffer(object):
+
+    """
+        Base class for the RingProducer/Consumer.  Maps the ring file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "r+b")
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+
+        magic, version, record_size, capacity = \
+            struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        assert(magic == MAGIC)
+        assert(version == VERSION)
+        assert(record_size == RECORD_SIZE)
+        assert(len(self.mm) >= DATA_OFFSET + capacity * RECORD_SIZE)
+        self.capacity = capacity
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = None
+        if self.f is not None:
+            self.f.close()
+        self.f = None
+
+    def get_drops(self):
+        return struct.unpack_from("<Q", self.mm, DROPS_OFFSET)[0]
+
+    def get_depth(self):
+        head = struct.unpack_from("<Q", self.mm, HEAD_OFFSET)[0]
+        tail = struct.unpack_from("<Q", self.mm, TAIL_OFFSET)[0]
+        return head - tail
+
+
+class RingProducer(RingBuffer):
+
+    """
+        Producer side of the ring.  Only one producer may write to a
+        ring at a time.
+    """
+
+    def __init__(self, path):
+        RingBuffer.__init__(self, path)
+        self.head = struct.unpack_from("<Q", self.mm, HEAD_OFFSET)[0]
+        self.drops = struct.unpack_from("<Q", self.mm, DROPS_OFFSET)[0]
+
+    def send(self, event_name, value, timestamp_ns=None):
+        # Returns False if the ring is full and the record was dropped.
+        tail = struct.unpack_from("<Q", self.mm, TAIL_OFFSET)[0]
+        if self.head - tail >= self.capacity:
+            self.drops += 1
+            struct.pack_into("<Q", self.mm, DROPS_OFFSET, self.drops)
+            return False
+
+        if timestamp_ns is None:
+            timestamp_ns = int(time.time() * 1000000000)
+
+        offset = DATA_OFFSET + (self.head % self.capacity) * RECORD_SIZE
+        # Body first, then the commit sequence.
+        struct.pack_into("<qd24s", self.mm, offset + 8,
+                         timestamp_ns, value, event_name[:NAME_SIZE])
+        self.head += 1
+        struct.pack_into("<Q", self.mm, offset, self.head)
+        struct.pack_into("<Q", self.mm, HEAD_OFFSET, self.head)
+        return True
+
+
+class RingConsumer(RingBuffer):
+
+    """
+        Consumer side of the ring.  Creating the consumer creates (or
+        truncates) the ring file.
+    """
+    # Polling backoff, in seconds, used by wait().
+    min_poll = 0.0001
+    max_poll = 0.01
+
+    def __init__(self, path, capacity=65536):
+        assert(capacity > 0)
+
+        f = open(path, "w+b")
+        f.truncate(DATA_OFFSET + capacity * RECORD_SIZE)
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT,
+                            MAGIC, VERSION, RECORD_SIZE, capacity))
+        f.close()
+
+        RingBuffer.__init__(self, path)
+        self.tail = 0
+        self.poll_interval = self.min_poll
+
+    def recv_batch(self, max_records):
+        # Returns a list of (event_name, value, timestamp_ns) tuples,
+        # possibly empty.  The tail is published once per batch.
+        records = []
+        while len(records) < max_records:
+            offset = DATA_OFFSET + (self.tail % self.capacity) * RECORD_SIZE
+            seq, timestamp_ns, value, event_name = \
+                struct.unpack_from(RECORD_FORMAT, self.mm, offset)
+            if seq != self.tail + 1:
+                # Not yet committed by the producer
+                break
+            records.append((event_name.rstrip("\0"), value, timestamp_ns))
+            self.tail += 1
+
+        if len(records) > 0:
+            struct.pack_into("<Q", self.mm, TAIL_OFFSET, self.tail)
+        return records
+
+    def wait(self, max_records, timeout=None):
+        # Block until at least one record is available, polling with
+        # an exponential backoff while the ring stays empty.  Returns
+        # an empty list if timeout seconds pass first.
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            records = self.recv_batch(max_records)
+            if len(records) > 0:
+                self.poll_interval = self.min_poll
+                return records
+            if deadline is not None and time.time() >= deadline:
+                return records
+            time.sleep(self.poll_interval)
+            self.poll_interval = min(self.poll_interval * 2, self.max_poll)
+
+    def remove(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def test1():
+
+    # Basic send/recv, wrap-around and ring-full behaviour.
+    path = "test1.ring"
+    consumer = RingConsumer(path, 8)
+    producer = RingProducer(path)
+
+    assert(consumer.recv_batch(10) == [])
+
+    for i in range(8):
+        assert(producer.send("tick", float(i), i) is True)
+    # The ring is full.
+    assert(producer.send("tick", 8.0, 8) is False)
+    assert(consumer.get_drops() == 1)
+    assert(consumer.get_depth() == 8)
+
+    records = consumer.recv_batch(5)
+    assert(len(records) == 5)
+    assert(records[0] == ("tick", 0.0, 0))
+
+    # Wrap around the end of the ring
+    for i in range(5):
+        assert(producer.send("tock", float(i), i) is True)
+
+    records = consumer.recv_batch(100)
+    assert(len(records) == 8)
+    assert(records[2] == ("tick", 7.0, 7))
+    assert(records[3] == ("tock", 0.0, 0))
+    assert(records[7] == ("tock", 4.0, 4))
+    assert(consumer.get_depth() == 0)
+
+    # An empty ring times out
+    start = time.time()
+    assert(consumer.wait(10, 0.05) == [])
+    assert(time.time() - start >= 0.05)
+    producer.send("tick", 1.0, 1)
+    assert(consumer.wait(10, 0.05) == [("tick", 1.0, 1)])
+
+    producer.close()
+    consumer.remove()
+    print "test1() PASSED"
+
+
+def bench1():
+
+    # Producer/consumer throughput across two processes.
+    path = "bench1.ring"
+    nr_records = 1000000
+    consumer = RingConsumer(path, 65536)
+
+    pid = os.fork()
+    if pid == 0:
+        producer = RingProducer(path)
+        i = 0
+        while i < nr_records:
+            if producer.send("tick", 1.2345) is True:
+                i += 1
+        producer.close()
+        os._exit(0)
+
+    start = time.time()
+    received = 0
+    while received < nr_records:
+        received += len(consumer.wait(4096))
+    elapsed = time.time() - start
+    os.waitpid(pid, 0)
+    consumer.remove()
+    print "bench1() " + str(nr_records) + " records in " \
+          + "%.2f" % elapsed + "s (" \
+          + str(int(nr_records / elapsed)) + " records/s)"
+
+
+if __name__ == '__main__':
+    test1()
+    bench1()
@@ -0,0 +1,228 @@
+"""
+    Process-wide registry of the objects keeping stats.
+
+    ZSockets, Interfaces, Protocols and EventDispatchers register
+    themselves when created.  Each keeps its counters in a Stats object
+    (self.stats); the registry only holds a weak reference to the owner
+    and reads the numeric Stats attributes when asked for a snapshot, so
+    registering costs nothing on the paths which update the counters.
+
+    An object may also define:
+
+        stats_label() - the label for its counters, e.g. the socket
+                        location.  Defaults to the object's id.
+        stats_extra() - a dict of extra values computed on demand, e.g.
+                        the current queue depth.
+
+    Other sources of values (e.g. the vital statistics) add a provider:
+    a function returning a list of (name, value) pairs.
+"""
+import numbers
+import sys
+import threading
+import time
+import weakref
+
+
+class StatsRegistry(object):
+
+    # id(object) -> (kind, weakref)
+    objects = {}
+    providers = []
+    lock = threading.Lock()
+
+    @staticmethod
+    def Register(kind, obj):
+        assert(hasattr(obj, "stats"))
+        key = id(obj)
+        ref = weakref.ref(obj, lambda ref: StatsRegistry.Remove(key, ref))
+        StatsRegistry.lock.acquire()
+        try:
+            StatsRegistry.objects[key] = (kind, ref)
+        finally:
+            StatsRegistry.lock.release()
+
+    @staticmethod
+    def Unregister(obj):
+        StatsRegistry.lock.acquire()
+        try:
+            StatsRegistry.objects.pop(id(obj), None)
+        finally:
+            StatsRegistry.lock.release()
+
+    @staticmethod
+    def Remove(key, ref):
+        # Called when a registered object is garbage collected.  The id
+        # may already belong to a newer object.
+        StatsRegistry.lock.acquire()
+        try:
+            entry = StatsRegistry.objects.get(key)
+            if entry is not None and entry[1] is ref:
+                del StatsRegistry.objects[key]
+        finally:
+            StatsRegistry.lock.release()
+
+    @staticmethod
+    def AddProvider(provider):
+        StatsRegistry.lock.acquire()
+        try:
+            if provider not in StatsRegistry.providers:
+                StatsRegistry.providers.append(provider)
+        finally:
+            StatsRegistry.lock.release()
+
+    @staticmethod
+    def Objects():
+        # Returns a list of (kind, label, object) for the live objects.
+        StatsRegistry.lock.acquire()
+        entries = StatsRegistry.objects.values()
+        StatsRegistry.lock.release()
+
+        objects = []
+        for kind, ref in entries:
+            obj = ref()
+            if obj is None:
+                continue
+            label = None
+            if hasattr(obj, "stats_label"):
+                label = obj.stats_label()
+            if label is None or label == "":
+                label = "%x" % id(obj)
+            objects.append((kind, label, obj))
+        return objects
+
+    @staticmethod
+    def Counters(obj):
+        # The numeric Stats counters of one object, as a dict.
+        counters = {}
+        for name, value in vars(obj.stats).items():
+            if isinstance(value, numbers.Number) and \
+               not isinstance(value, bool):
+                counters[name] = value
+        return counters
+
+    @staticmethod
+    def Values(obj):
+        # The counters and the extra values of one object, as a dict.
+        values = StatsRegistry.Counters(obj)
+        if hasattr(obj, "stats_extra"):
+            values.update(obj.stats_extra())
+        return values
+
+    @staticmethod
+    def Snapshot():
+        # Returns a list of (name, value) pairs for everything
+        # registered.  Counter names are <kind>.<label>.<counter>.
+        snapshot = []
+        for kind, label, obj in StatsRegistry.Objects():
+            for name, value in StatsRegistry.Values(obj).items():
+                snapshot.append((".".join([kind, label, name]), value))
+        snapshot.append(("process.threads", threading.active_count()))
+
+        StatsRegistry.lock.acquire()
+        providers = StatsRegistry.providers[:]
+        StatsRegistry.lock.release()
+        for provider in providers:
+            snapshot += provider()
+        return snapshot
+
+
+class StatsRates(object):
+
+    """
+        Rates of the registered counters, per second, between successive
+        calls to update().  Each user of the rates keeps its own.
+    """
+
+    def __init__(self):
+        # (kind, label, counter) -> (time, total)
+        self.last = {}
+
+    def update(self, kind, label, counters, now=None):
+        # Returns a dict of counter -> rate for one object's counters.
+        # The first call for a counter gives a rate of 0.
+        if now is None:
+            now = time.time()
+        rates = {}
+        for name, total in counters.items():
+            key = (kind, label, name)
+            last = self.last.get(key)
+            self.last[key] = (now, total)
+            if last is None or now <= last[0]:
+                rates[name] = 0.0
+            else:
+                rates[name] = (total - last[1]) / (now - last[0])
+        return rates
+
+    def forget(self, live):
+        # Drop the counters of the objects no longer in live, a set of
+        # (kind, label).
+        for key in self.last.keys():
+            if key[:2] not in live:
+                del self.last[key]
+
+
+# The base modules are imported both as top-level modules and as the
+# apphost.base package.  Share one registry between the two copies of
+# this module.
+for module_name in ["stats", "apphost.base.stats"]:
+    module = sys.modules.get(module_name)
+    if module_name != __name__ and module is not None and \
+       hasattr(module, "StatsRegistry"):
+        StatsRegistry = module.StatsRegistry
+        break
+
+
+def test1():
+
+    class Owner(object):
+        class Stats():
+            def __init__(self):
+                self.rx_ok = 0
+                self.name = "not a counter"
+
+        def __init__(self, label):
+            self.stats = Owner.Stats()
+            self.label = label
+
+        def stats_label(self):
+            return self.label
+
+        def stats_extra(self):
+            return {'queue_depth': 3}
+
+    StatsRegistry.objects = {}
+    StatsRegistry.providers = []
+    first = Owner("first")
+    second = Owner("")
+    StatsRegistry.Register("test", first)
+    StatsRegistry.Register("test", second)
+    StatsRegistry.AddProvider(lambda: [("provided", 1.5)])
+    first.stats.rx_ok = 5
+
+    snapshot = dict(StatsRegistry.Snapshot())
+    assert(snapshot["test.first.rx_ok"] == 5)
+    assert(snapshot["test.first.queue_depth"] == 3)
+    assert(snapshot["test.%x.rx_ok" % id(second)] == 0)
+    assert(snapshot["provided"] == 1.5)
+    assert(snapshot["process.threads"] >= 1)
+    assert("test.first.name" not in snapshot)
+
+    # Collected objects drop out
+    second = None
+    assert(len(StatsRegistry.objects) == 1)
+
+    rates = StatsRates()
+    assert(rates.update("test", "first", {'rx_ok': 5}, 100.0) == \
+           {'rx_ok': 0.0})
+    assert(rates.update("test", "first", {'rx_ok': 25}, 102.0) == \
+           {'rx_ok': 10.0})
+    rates.forget(set())
+    assert(rates.last == {})
+    StatsRegistry.objects = {}
+    StatsRegistry.providers = []
+    print "test1() PASSED"
+
+
+if __name__ == '__main__':
+    test1()
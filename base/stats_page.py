@@ -0,0 +1,430 @@
+"""
+    Shared memory stats page.
+
+    Each process keeps a snapshot of its stats (see stats.py) in a
+    memory-mapped file, apphost-<pid>.stats, under /dev/shm (or the
+    current directory where there is no /dev/shm).  A background thread
+    refreshes the page every StatsPage.period seconds.  Local readers map
+    the file and read it at any rate, without sending a message to the
+    process or touching the paths which update the counters.  A process
+    publishes a page only if it asks to, with
+    System.Init(..., publish_stats=True) or StatsPage.Start().
+
+    File layout (all integers little-endian):
+
+        offset   0: magic "APST", version, pid, number of slots
+        offset  16: sequence    - odd while the page is being written
+        offset  24: update time - ns since the epoch
+        offset  32: slots used, slots dropped on a full page
+        offset  64: process name, <user>:<app>:<module>
+        offset 128: number of slots * slot size bytes of slots
+
+    Each slot is:
+
+        <name> <value>
+         120s  float64
+
+    A counter keeps its slot for the life of the process, so a reader
+    may cache the offset of a counter.  The page is a seqlock: the writer
+    bumps the sequence to odd, writes, then bumps it to even.  A reader
+    copies the page, and retries if the sequence was odd or has changed.
+"""
+import array
+import atexit
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import stats
+import system
+from local_log import *
+
+MAGIC = "APST"
+VERSION = 1
+
+HEADER_FORMAT = "<4sIII"
+SEQUENCE_OFFSET = 16
+TIME_OFFSET = 24
+USED_OFFSET = 32
+NAME_OFFSET = 64
+NAME_SIZE = 64
+SLOTS_OFFSET = 128
+
+SLOT_FORMAT = "<120sd"
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+SLOT_NAME_SIZE = 120
+# The values, as an array of doubles over the slots, are every
+# SLOT_STRIDE'th double from VALUE_INDEX.
+SLOT_STRIDE = SLOT_SIZE // 8
+VALUE_INDEX = SLOT_NAME_SIZE // 8
+
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def stats_directory():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return os.getcwd()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == 1
+    return True
+
+
+class StatsPage(object):
+
+    """
+        Writer side of the page.  Only one per process, see Start().
+    """
+
+    period = 0.1
+    nr_slots = 1024
+    page = None
+
+    def __init__(self, path, nr_slots=None, period=None):
+        if nr_slots is None:
+            nr_slots = StatsPage.nr_slots
+        if period is None:
+            period = StatsPage.period
+        assert(nr_slots > 0)
+        assert(period > 0)
+
+        self.path = path
+        self.nr_slots = nr_slots
+        self.period = period
+        # counter name -> slot
+        self.slots = {}
+        self.dropped = 0
+        self.sequence = 0
+        # Failed updates; only the first is logged.
+        self.errors = 0
+        self.alive = True
+
+        f = open(path, "w+b")
+        f.truncate(SLOTS_OFFSET + nr_slots * SLOT_SIZE)
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT,
+                            MAGIC, VERSION, os.getpid(), nr_slots))
+        f.flush()
+        self.f = f
+        self.mm = mmap.mmap(f.fileno(), 0)
+        self.set_process_name(":".join([system.System.GetUserName(),
+                                        system.System.GetApplicationName(),
+                                        system.System.GetModuleName()]))
+
+        self.thread = threading.Thread(target=self.__thread_entry)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def Start(directory=None):
+        # Start this process's page, if not already started.
+        if StatsPage.page is not None:
+            return StatsPage.page
+        if directory is None:
+            directory = stats_directory()
+        StatsPage.RemoveStale(directory)
+        path = os.path.join(directory, "apphost-%d.stats" % os.getpid())
+        try:
+            StatsPage.page = StatsPage(path)
+        except (IOError, OSError) as e:
+            # Stats pages are a convenience; never fail the process.
+            return None
+        atexit.register(StatsPage.page.close)
+        return StatsPage.page
+
+    @staticmethod
+    def RemoveStale(directory):
+        # Pages left behind by processes which did not exit cleanly
+        for path in glob.glob(os.path.join(directory, "apphost-*.stats")):
+            try:
+                pid = int(os.path.basename(path).split("-")[1].split(".")[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and pid_alive(pid) is False:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def set_process_name(self, name):
+        struct.pack_into("<64s", self.mm, NAME_OFFSET, name[:NAME_SIZE])
+
+    def update(self, snapshot=None):
+        # Write a snapshot, a list of (name, value), to the page.
+        if snapshot is None:
+            snapshot = stats.StatsRegistry.Snapshot()
+
+        values = []
+        for name, value in snapshot:
+            slot = self.slots.get(name)
+            if slot is None:
+                if len(self.slots) >= self.nr_slots:
+                    self.dropped += 1
+                    continue
+                slot = len(self.slots)
+                self.slots[name] = slot
+                struct.pack_into("<120s", self.mm,
+                                 SLOTS_OFFSET + slot * SLOT_SIZE,
+                                 name[:SLOT_NAME_SIZE])
+            values.append((slot, float(value)))
+
+        self.sequence += 1
+        struct.pack_into("<Q", self.mm, SEQUENCE_OFFSET, self.sequence)
+        for slot, value in values:
+            struct.pack_into("<d", self.mm,
+                             SLOTS_OFFSET + slot * SLOT_SIZE
+                             + SLOT_NAME_SIZE,
+                             value)
+        struct.pack_into("<qII", self.mm, TIME_OFFSET,
+                         int(time.time() * 1000000000),
+                         len(self.slots),
+                         self.dropped)
+        self.sequence += 1
+        struct.pack_into("<Q", self.mm, SEQUENCE_OFFSET, self.sequence)
+
+    def __thread_entry(self):
+        while self.alive is True:
+            try:
+                self.update()
+            except Exception as e:
+                # Keep the page going; a bad provider must not stop it.
+                self.errors += 1
+                if self.errors == 1:
+                    Llog.LogError("Stats page update failed: "
+                                  + repr(e))
+            time.sleep(self.period)
+
+    def close(self):
+        self.alive = False
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        if StatsPage.page is self:
+            StatsPage.page = None
+
+
+class StatsPageReader(object):
+
+    """
+        Reader side of a page.
+    """
+
+    # Attempts at a consistent copy before giving up
+    max_retries = 100
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, pid, nr_slots = \
+            struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        assert(magic == MAGIC)
+        assert(version == VERSION)
+        assert(len(self.mm) >= SLOTS_OFFSET + nr_slots * SLOT_SIZE)
+        self.pid = pid
+        self.nr_slots = nr_slots
+        # A slot's name never changes, so they are only read once.
+        self.names = []
+
+    def read(self):
+        # Returns a dict: pid, process, timestamp_ns, dropped and values,
+        # a dict of counter name -> value.  None if the writer kept the
+        # page busy.
+        for i in range(self.max_retries):
+            sequence = struct.unpack_from("<Q", self.mm, SEQUENCE_OFFSET)[0]
+            if sequence % 2 == 1:
+                time.sleep(0)
+                continue
+            header = self.mm[:SLOTS_OFFSET]
+            used = min(struct.unpack_from("<I", header, USED_OFFSET)[0],
+                       self.nr_slots)
+            slots = self.mm[SLOTS_OFFSET:SLOTS_OFFSET + used * SLOT_SIZE]
+            if struct.unpack_from("<Q", self.mm, SEQUENCE_OFFSET)[0] \
+               != sequence:
+                continue
+            return self.__parse(header, used, slots)
+        return None
+
+    def __parse(self, header, used, slots):
+        timestamp_ns, used, dropped = \
+            struct.unpack_from("<qII", header, TIME_OFFSET)
+        process = struct.unpack_from("<64s", header, NAME_OFFSET)[0]
+        for slot in range(len(self.names), used):
+            name = struct.unpack_from("<120s", slots, slot * SLOT_SIZE)[0]
+            self.names.append(name.rstrip("\0"))
+
+        doubles = array.array('d')
+        doubles.fromstring(slots)
+        if LITTLE_ENDIAN is False:
+            doubles.byteswap()
+        values = dict(zip(self.names[:used],
+                          doubles[VALUE_INDEX::SLOT_STRIDE]))
+        return {'pid': self.pid,
+                'process': process.rstrip("\0"),
+                'timestamp_ns': timestamp_ns,
+                'dropped': dropped,
+                'values': values}
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = None
+
+
+def read_all(directory=None):
+    # Read the pages of every live process.  Returns a list of the
+    # read() dicts.
+    if directory is None:
+        directory = stats_directory()
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory,
+                                              "apphost-*.stats"))):
+        try:
+            reader = StatsPageReader(path)
+        except (IOError, OSError, AssertionError, struct.error):
+            # Gone, or not yet written
+            continue
+        try:
+            if pid_alive(reader.pid) is False:
+                continue
+            page = reader.read()
+            if page is not None:
+                pages.append(page)
+        finally:
+            reader.close()
+    return pages
+
+
+def test1():
+
+    path = "test1.stats"
+    page = StatsPage(path, nr_slots=4, period=3600)
+    page.set_process_name("sysadmin:statstest:test1")
+    reader = StatsPageReader(path)
+    page.update([("zsocket.a.rx_ok", 5), ("zsocket.a.tx_ok", 7)])
+    result = reader.read()
+    assert(result['pid'] == os.getpid())
+    assert(result['process'] == "sysadmin:statstest:test1")
+    assert(result['values'] == {"zsocket.a.rx_ok": 5, "zsocket.a.tx_ok": 7})
+
+    # Slots are kept, new names are added, and extra names dropped.
+    page.update([("zsocket.a.tx_ok", 8), ("b", 1), ("c", 2), ("d", 3)])
+    result = reader.read()
+    assert(result['values']["zsocket.a.tx_ok"] == 8)
+    assert(result['values']["zsocket.a.rx_ok"] == 5)
+    assert(len(result['values']) == 4 and "d" not in result['values'])
+    assert(result['dropped'] == 1)
+
+    # A page mid-update is not read
+    struct.pack_into("<Q", page.mm, SEQUENCE_OFFSET, page.sequence + 1)
+    reader.max_retries = 3
+    assert(reader.read() is None)
+    reader.close()
+    page.close()
+    assert(os.path.exists(path) is False)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # The registry, through a started page
+    import zmq
+    import zsocket
+    system.System.Init("sysadmin", "statstest", "test2")
+    server = zsocket.ZSocketServer(zmq.PULL, "tcp", "127.0.0.1",
+                                   "STATSTEST", [9400, 9500])
+    server.bind()
+    client = zsocket.ZSocketClient(zmq.PUSH, "tcp", "127.0.0.1",
+                                   "STATSTEST", server.port)
+    client.connect()
+    for i in range(10):
+        client.send({'message':["hello", str(i)]})
+        server.recv()
+
+    StatsPage.period = 0.05
+    page = StatsPage.Start(".")
+    time.sleep(0.3)
+    pages = [p for p in read_all(".") if p['pid'] == os.getpid()]
+    assert(len(pages) == 1)
+    assert(pages[0]['process'] == "sysadmin:statstest:test2")
+    values = pages[0]['values']
+    assert(values["zsocket." + server.stats_label() + ".rx_ok"] == 10)
+    assert(values["zsocket." + client.stats_label() + ".tx_ok"] == 10)
+    assert(values["process.threads"] >= 2)
+    page.close()
+
+    # An interface is labelled by its first socket
+    import interface
+    intf = interface.Interface(rx_cback=lambda msg: None)
+    assert(intf.stats_label() == intf.thread.name)
+    intf.add_socket(server)
+    assert(intf.stats_label() == server.stats_label())
+    names = [name for name, value in stats.StatsRegistry.Snapshot()]
+    assert("interface." + server.stats_label() + ".queue_depth" in names)
+    intf.remove_socket(server)
+    intf.close()
+    client.close()
+    print "test2() PASSED"
+
+
+def test3():
+
+    # A failing update is logged once and the page keeps going
+    def provider():
+        raise ValueError("bad provider")
+
+    stats.StatsRegistry.AddProvider(provider)
+    path = "test3.stats"
+    page = StatsPage(path, period=0.01)
+    time.sleep(0.2)
+    assert(page.errors > 1)
+    assert(page.thread.is_alive() is True)
+    stats.StatsRegistry.providers.remove(provider)
+    errors = page.errors
+    time.sleep(0.2)
+    assert(page.errors == errors)
+    page.close()
+    print "test3() PASSED"
+
+
+def bench1():
+
+    # Reads per second of a full page
+    path = "bench1.stats"
+    page = StatsPage(path, period=3600)
+    page.update([("counter.%d" % i, i) for i in range(200)])
+    reader = StatsPageReader(path)
+    nr_reads = 2000
+    start = time.time()
+    for i in xrange(nr_reads):
+        reader.read()
+    elapsed = time.time() - start
+    print "bench1() " + str(int(nr_reads / elapsed)) \
+          + " reads/s of 200 counters"
+    reader.close()
+    page.close()
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
+    bench1()
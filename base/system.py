@@ -34,7 +34,18 @@ class System():
         return sla
 
     @staticmethod
-    def Init(user_name, app_name, module_name):
+    def Init(user_name, app_name, module_name, publish_stats=False):
         System.__user_name = user_name
         System.__application_name = app_name
         System.__module_name = module_name
+
+        if publish_stats is not True:
+            return
+        # Publish our stats for local readers, see stats_page.py.  This
+        # costs a thread and a page under /dev/shm, so it is opt-in.
+        import stats_page
+        page = stats_page.StatsPage.Start()
+        if page is not None:
+            page.set_process_name(":".join([user_name,
+                                            app_name,
+                                            module_name]))
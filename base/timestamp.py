@@ -0,0 +1,83 @@
+"""
+    Timestamp
+
+    Cheap timestamps for events and logs.
+
+    Time is carried as an integer number of nanoseconds since the epoch.
+    Events put it on the wire as-is, so collectors get a number they can
+    order and subtract without parsing any text.
+
+    For display, the per-second part of the text
+    (MM/DD/YY-HH:MM:SS, the same layout the Java EventSource uses) is
+    formatted once and cached; only the milliseconds are appended per
+    call.  The layout is fixed, so it does not depend on the locale.
+"""
+import time
+
+
+class Timestamp(object):
+
+    FORMAT = "%m/%d/%y-%H:%M:%S"
+
+    # (epoch second, formatted text) for the last second formatted.
+    # Replaced as a whole, so readers in other threads always see a
+    # matching pair.
+    cache = (-1, "")
+
+    @staticmethod
+    def Now():
+        return int(time.time() * 1000000000)
+
+    @staticmethod
+    def Format(timestamp_ns):
+        sec = timestamp_ns // 1000000000
+        cached_sec, text = Timestamp.cache
+        if sec != cached_sec:
+            text = time.strftime(Timestamp.FORMAT, time.localtime(sec))
+            Timestamp.cache = (sec, text)
+        return "%s.%03d" % (text, (timestamp_ns // 1000000) % 1000)
+
+    @staticmethod
+    def NowText():
+        return Timestamp.Format(Timestamp.Now())
+
+    @staticmethod
+    def Seconds(timestamp_ns):
+        return timestamp_ns / 1e9
+
+
+def test1():
+    ns = 1357034400 * 1000000000 + 123456789
+    text = Timestamp.Format(ns)
+    assert(text == time.strftime(Timestamp.FORMAT,
+                                 time.localtime(1357034400)) + ".123")
+    # Same second, cached prefix
+    assert(Timestamp.Format(ns + 500000000)[-4:] == ".623")
+    assert(Timestamp.cache[0] == 1357034400)
+
+    before = Timestamp.Now()
+    time.sleep(0.01)
+    assert(Timestamp.Now() > before)
+    assert(abs(Timestamp.Seconds(Timestamp.Now()) - time.time()) < 1)
+    print "test1() PASSED"
+
+
+def bench1():
+    nr_calls = 200000
+    start = time.time()
+    for i in xrange(nr_calls):
+        time.strftime("%x-%X")
+    strftime_elapsed = time.time() - start
+
+    start = time.time()
+    for i in xrange(nr_calls):
+        Timestamp.NowText()
+    cached_elapsed = time.time() - start
+    print "bench1() strftime: " + "%.3f" % strftime_elapsed \
+          + "s cached: " + "%.3f" % cached_elapsed + "s (" \
+          + str(nr_calls) + " calls)"
+
+
+if __name__ == '__main__':
+    test1()
+    bench1()
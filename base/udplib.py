@@ -4,13 +4,20 @@
 import socket
 import select
 
-MAX_RECV = 1024
+# Port of the discovery broadcasts
+PORT = 9411
+# Largest datagram payload sent, to fit an ethernet MTU of 1500 bytes
+# less the IP and UDP headers.
+MAX_PAYLOAD = 1472
+MAX_RECV = MAX_PAYLOAD
 
 class UDP:
 
     """simple UDP send/recv class"""
 
-    def __init__(self, port=9411, broadcast='255.255.255.255'):
+    def __init__(self, port=PORT, broadcast='255.255.255.255'):
+        # port 0 binds an ephemeral port, for sockets only sending
+        # with sendto() and receiving the replies.
 
         self.broadcast = broadcast
         self.port = port
@@ -38,6 +45,10 @@ class UDP:
         assert(self.socket)
         self.socket.sendto(buf, 0, (self.broadcast, self.port))
 
+    def sendto(self, buf, address):
+        assert(self.socket)
+        self.socket.sendto(buf, 0, address)
+
     def recv(self):
         assert(self.socket)
         return self.socket.recv(MAX_RECV)
@@ -56,3 +67,22 @@ class UDP:
                 # Our socket is readable
                 return self.socket.recv(MAX_RECV)
         return None
+
+    def recvfrom_timeout(self, timeout):
+        # Returns (datagram, sender address), or None on timeout.
+        assert(self.socket)
+        assert(timeout >= 0)
+
+        (ready_read, ready_write, in_error) = select.select([self.socket], [], [], timeout)
+        if self.socket in ready_read:
+            return self.socket.recvfrom(MAX_RECV)
+        return None
+
+
+def recv_any(udps, timeout):
+    # Wait on several UDP objects at once.  Returns a list of
+    # (udp, datagram) for those readable, one datagram each.
+    (ready_read, ready_write, in_error) = select.select(
+                                [udp.socket for udp in udps], [], [], timeout)
+    return [(udp, udp.socket.recv(MAX_RECV)) for udp in udps
+            if udp.socket in ready_read]
@@ -0,0 +1,695 @@
+"""
+    Threshold alerting over vital statistics.
+
+    The AlertEngine sits behind a VitalEventCollector and checks every
+    vital event against a list of rules.  A rule is written:
+
+        <rule name> <pattern> <condition>
+
+    where the pattern is a shell pattern on the vital name (instance
+    labels included, e.g. "requests_failed/*"), optionally prefixed by
+    user and application patterns: "sysadmin:*:requests_failed".  The
+    conditions are:
+
+        value > X           also >=, < and <=
+        rate > Y/min        also Y/s.  The increase of the value, from
+                            the delta of ERROR, CRITICAL and COUNTER
+                            events, or the change of the value
+        threshold           while a gauge is above its own threshold
+        absent Zs           no event for Z seconds
+
+    Rules are compiled once per statistic: the first event of each
+    (user, app, name) key finds the matching rules and gives the key one
+    evaluator per rule.  An evaluator keeps only what its condition
+    needs (the last value, two one minute buckets for a rate, or the
+    time last seen), so each event costs a dict lookup and a constant
+    amount of work per matching rule, whatever the history.  The engine
+    thread only visits the evaluators which may change without an
+    event: absent rules, kept in order of the time last seen, and rates
+    which are firing.
+
+    Rate rules only go above their limit on an event, so only > and >=
+    are allowed; use an absent rule for a statistic going quiet.  An
+    absent rule only covers the keys seen since the engine started.
+
+    When a rule starts or stops firing for a key, the alert_cback is
+    given an event in the EventCollector format, with the type "ALERT",
+    the rule name as the name and the contents:
+
+        <FIRING|RESOLVED> <user> <app> <vital name> <value> <condition>
+
+    The AlertCollector also sends the alerts as ALERT events, so any
+    EventCollector can watch them.
+"""
+import collections
+import fnmatch
+import operator
+import threading
+import time
+import types
+import event_source
+import system
+import vitals
+from timestamp import Timestamp
+from local_log import *
+
+
+class Evaluator(object):
+
+    """
+        State of one rule for one key.  update() is called with each
+        event of the key and tick() from the engine thread, when the
+        engine asks for it; both return whether the rule is firing.
+    """
+
+    def __init__(self, rule, key):
+        self.rule = rule
+        self.key = key
+        self.firing = False
+        # The value reported in the alerts
+        self.value = None
+
+    def update(self, event, now):
+        value = event.get('value')
+        if value is not None:
+            self.value = value
+        return self.firing
+
+    def tick(self, now):
+        return self.firing
+
+
+class ValueEvaluator(Evaluator):
+
+    def update(self, event, now):
+        value = event.get('value')
+        if value is None:
+            return self.firing
+        self.value = value
+        return self.rule.compare(value, self.rule.limit)
+
+
+class RateEvaluator(Evaluator):
+
+    """
+        Sliding window count over the last minute, estimated from the
+        count of the current and the previous one minute buckets.
+    """
+
+    def __init__(self, rule, key):
+        Evaluator.__init__(self, rule, key)
+        self.bucket_start = None
+        self.current = 0
+        self.previous = 0
+        self.last_value = None
+
+    def __roll(self, now):
+        window = self.rule.window
+        start = now - now % window
+        if self.bucket_start is None:
+            self.bucket_start = start
+        elif start > self.bucket_start:
+            if start - self.bucket_start == window:
+                self.previous = self.current
+            else:
+                self.previous = 0
+            self.current = 0
+            self.bucket_start = start
+
+    def rate(self, now):
+        # Estimated increase over the last window
+        self.__roll(now)
+        elapsed = (now - self.bucket_start) / self.rule.window
+        return self.previous * (1 - elapsed) + self.current
+
+    def update(self, event, now):
+        value = event.get('value')
+        if value is None:
+            return self.firing
+        delta = event.get('delta')
+        if delta is None:
+            if self.last_value is None:
+                delta = 0
+            elif value < self.last_value:
+                # Restarted
+                delta = value
+            else:
+                delta = value - self.last_value
+        self.last_value = value
+
+        self.__roll(now)
+        self.current += delta
+        self.value = self.rate(now)
+        return self.rule.compare(self.value, self.rule.limit)
+
+    def tick(self, now):
+        self.value = self.rate(now)
+        return self.rule.compare(self.value, self.rule.limit)
+
+
+class ThresholdEvaluator(Evaluator):
+
+    def update(self, event, now):
+        state = event.get('state')
+        if state is None:
+            return self.firing
+        self.value = event.get('value')
+        return state == "above"
+
+
+class AbsentEvaluator(Evaluator):
+
+    def __init__(self, rule, key, now):
+        Evaluator.__init__(self, rule, key)
+        self.last_seen = now
+
+    def update(self, event, now):
+        self.last_seen = now
+        self.value = 0
+        return False
+
+    def tick(self, now):
+        self.value = now - self.last_seen
+        return self.value >= self.rule.seconds
+
+
+class AlertRule(object):
+
+    """
+        Base class of the rules.  A rule names its condition with kind
+        and creates an evaluator_class for each key.  The base class has
+        neither, and the AlertEngine rejects it.
+    """
+
+    kind = None
+    evaluator_class = None
+
+    OPERATORS = {">": operator.gt,
+                 ">=": operator.ge,
+                 "<": operator.lt,
+                 "<=": operator.le}
+
+    def __init__(self, name, pattern):
+        assert(isinstance(name, types.StringType))
+        assert(name.count(" ") == 0)
+        self.name = name
+        self.pattern = pattern
+        patterns = pattern.split(":")
+        if len(patterns) == 3:
+            self.user_pattern, self.app_pattern, self.name_pattern = patterns
+        else:
+            assert(len(patterns) == 1)
+            self.user_pattern = "*"
+            self.app_pattern = "*"
+            self.name_pattern = pattern
+
+    def matches(self, key):
+        user_name, application_name, name = key
+        return fnmatch.fnmatchcase(name, self.name_pattern) and \
+               fnmatch.fnmatchcase(user_name, self.user_pattern) and \
+               fnmatch.fnmatchcase(application_name, self.app_pattern)
+
+    def evaluator(self, key, now):
+        return self.evaluator_class(self, key)
+
+    def condition(self):
+        return self.kind
+
+    def __str__(self):
+        return " ".join([self.name, self.pattern, self.condition()])
+
+    @staticmethod
+    def Parse(text):
+        # Returns the rule written in text, see above.  Raises ValueError
+        # on a bad rule.
+        words = text.split()
+        if len(words) < 3:
+            raise ValueError("Bad rule: " + text)
+        name, pattern, kind = words[:3]
+        args = words[3:]
+
+        if kind == "value" and len(args) == 2 and \
+           args[0] in AlertRule.OPERATORS:
+            return ValueRule(name, pattern, args[0], float(args[1]))
+
+        if kind == "rate" and len(args) == 2 and args[0] in [">", ">="]:
+            limit, sep, unit = args[1].partition("/")
+            if unit == "min":
+                return RateRule(name, pattern, args[0], float(limit))
+            if unit == "s":
+                return RateRule(name, pattern, args[0], float(limit) * 60)
+
+        if kind == "threshold" and len(args) == 0:
+            return ThresholdRule(name, pattern)
+
+        if kind == "absent" and len(args) == 1:
+            seconds = args[0]
+            if seconds.endswith("s"):
+                seconds = seconds[:-1]
+            return AbsentRule(name, pattern, float(seconds))
+
+        raise ValueError("Bad rule: " + text)
+
+
+class ValueRule(AlertRule):
+
+    kind = "value"
+    evaluator_class = ValueEvaluator
+
+    def __init__(self, name, pattern, op, limit):
+        AlertRule.__init__(self, name, pattern)
+        self.op = op
+        self.compare = AlertRule.OPERATORS[op]
+        self.limit = limit
+
+    def condition(self):
+        return self.kind + " " + self.op + " " + "%g" % self.limit
+
+
+class RateRule(AlertRule):
+
+    kind = "rate"
+    evaluator_class = RateEvaluator
+
+    # Length of the rate buckets, in seconds
+    window = 60.0
+
+    def __init__(self, name, pattern, op, per_minute):
+        assert(op in [">", ">="])
+        AlertRule.__init__(self, name, pattern)
+        self.op = op
+        self.compare = AlertRule.OPERATORS[op]
+        self.limit = per_minute
+
+    def condition(self):
+        return self.kind + " " + self.op + " " + "%g" % self.limit + "/min"
+
+
+class ThresholdRule(AlertRule):
+
+    kind = "threshold"
+    evaluator_class = ThresholdEvaluator
+
+
+class AbsentRule(AlertRule):
+
+    kind = "absent"
+    evaluator_class = AbsentEvaluator
+
+    def __init__(self, name, pattern, seconds):
+        assert(seconds > 0)
+        AlertRule.__init__(self, name, pattern)
+        self.seconds = seconds
+
+    def evaluator(self, key, now):
+        return AbsentEvaluator(self, key, now)
+
+    def condition(self):
+        return self.kind + " " + "%g" % self.seconds + "s"
+
+
+class AlertEngine(object):
+
+    class Stats():
+        def __init__(self):
+            self.rx_events = 0
+            self.keys = 0
+            self.evaluators = 0
+            self.firing = 0
+            self.alerts = 0
+
+    def __init__(self, rules, alert_cback, period=1.0):
+        # rules is a list of AlertRule, or of rule texts.  The absent
+        # and firing rate rules are checked every period seconds.
+        assert(isinstance(rules, types.ListType))
+        assert(isinstance(alert_cback, types.FunctionType) or
+               isinstance(alert_cback, types.MethodType))
+
+        self.rules = []
+        for rule in rules:
+            if isinstance(rule, types.StringType):
+                rule = AlertRule.Parse(rule)
+            if rule.evaluator_class is None:
+                raise ValueError("Not a concrete rule: " + rule.name)
+            self.rules.append(rule)
+        self.alert_cback = alert_cback
+        self.period = period
+        self.stats = AlertEngine.Stats()
+
+        # (user, app, name) -> list of evaluators, empty if no rule
+        # matches the key
+        self.evaluators = {}
+        # AbsentRule -> {id(evaluator): evaluator}, in order of the time
+        # last seen.  Firing evaluators are taken out until their key is
+        # seen again.
+        self.absent = {}
+        for rule in self.rules:
+            if isinstance(rule, AbsentRule):
+                self.absent[rule] = collections.OrderedDict()
+        # id(evaluator) -> evaluator, for the firing rates
+        self.decaying = {}
+        self.lock = threading.Lock()
+
+        self.alive = True
+        self.thread = threading.Thread(target=self.__thread_entry)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __compile(self, key, now):
+        evaluators = [rule.evaluator(key, now) for rule in self.rules
+                      if rule.matches(key)]
+        self.evaluators[key] = evaluators
+        self.stats.keys += 1
+        self.stats.evaluators += len(evaluators)
+        return evaluators
+
+    def event_cback(self, event, now=None):
+        # Pass this method to the VitalEventCollector as its rx_cback.
+        if now is None:
+            now = time.time()
+        key = (event['user_name'], event['application_name'], event['name'])
+
+        alerts = []
+        self.lock.acquire()
+        try:
+            self.stats.rx_events += 1
+            evaluators = self.evaluators.get(key)
+            if evaluators is None:
+                evaluators = self.__compile(key, now)
+            for evaluator in evaluators:
+                firing = evaluator.update(event, now)
+                if isinstance(evaluator, AbsentEvaluator):
+                    # Move to the end of the order
+                    waiting = self.absent[evaluator.rule]
+                    waiting.pop(id(evaluator), None)
+                    waiting[id(evaluator)] = evaluator
+                elif isinstance(evaluator, RateEvaluator):
+                    if firing is True:
+                        self.decaying[id(evaluator)] = evaluator
+                    else:
+                        self.decaying.pop(id(evaluator), None)
+                if firing != evaluator.firing:
+                    alerts.append(self.__transition(evaluator, firing, now))
+        finally:
+            self.lock.release()
+
+        for alert in alerts:
+            self.alert_cback(alert)
+
+    def tick(self, now=None):
+        # Check the rules which may change state without an event.
+        if now is None:
+            now = time.time()
+
+        alerts = []
+        self.lock.acquire()
+        try:
+            for rule, waiting in self.absent.items():
+                expired = []
+                for evaluator in waiting.itervalues():
+                    if now - evaluator.last_seen < rule.seconds:
+                        break
+                    expired.append(evaluator)
+                for evaluator in expired:
+                    del waiting[id(evaluator)]
+                    evaluator.tick(now)
+                    alerts.append(self.__transition(evaluator, True, now))
+
+            for evaluator in self.decaying.values():
+                if evaluator.tick(now) is False:
+                    del self.decaying[id(evaluator)]
+                    alerts.append(self.__transition(evaluator, False, now))
+        finally:
+            self.lock.release()
+
+        for alert in alerts:
+            self.alert_cback(alert)
+
+    def __thread_entry(self):
+        while self.alive is True:
+            time.sleep(self.period)
+            self.tick()
+
+    def __transition(self, evaluator, firing, now):
+        evaluator.firing = firing
+        self.stats.alerts += 1
+        if firing is True:
+            self.stats.firing += 1
+            state = "FIRING"
+        else:
+            self.stats.firing -= 1
+            state = "RESOLVED"
+        return AlertEngine.alert_event(evaluator, state,
+                                       int(now * 1000000000))
+
+    @staticmethod
+    def alert_event(evaluator, state, timestamp_ns):
+        user_name, application_name, name = evaluator.key
+        if evaluator.value is None:
+            value = ""
+        else:
+            value = "%g" % evaluator.value
+        contents = [state,
+                    user_name,
+                    application_name,
+                    name,
+                    value,
+                    evaluator.rule.condition()]
+        return {'type': "ALERT",
+                'name': evaluator.rule.name,
+                'timestamp': Timestamp.Format(timestamp_ns),
+                'timestamp_ns': timestamp_ns,
+                'user_name': user_name,
+                'application_name': application_name,
+                'contents': contents,
+                'state': state,
+                'vital': name,
+                'value': evaluator.value,
+                'condition': evaluator.rule.condition()}
+
+    def firing(self):
+        # The (rule name, key) of the rules firing now
+        self.lock.acquire()
+        try:
+            return sorted([(evaluator.rule.name, key)
+                           for key, evaluators in self.evaluators.items()
+                           for evaluator in evaluators
+                           if evaluator.firing is True])
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.alive = False
+
+
+class AlertCollector(object):
+
+    """
+        VitalEventCollector checking the vitals against the rules, and
+        sending the alerts as ALERT events of the calling process, one
+        event name per rule.
+    """
+
+    def __init__(self, rules, alert_cback=None,
+                       user_name="",
+                       application_name=""):
+        # user_name and application_name select the vitals watched.
+        self.user_cback = alert_cback
+        self.sources = {}
+        self.engine = AlertEngine(rules, self.alert_cback)
+        self.collector = vitals.VitalEventCollector(
+                                sorted(vitals.VStatEventDecoder.DECODERS),
+                                self.engine.event_cback,
+                                user_name,
+                                application_name)
+
+    def alert_cback(self, alert):
+        source = self.sources.get(alert['name'])
+        if source is None:
+            source = event_source.EventSource(
+                                    alert['name'],
+                                    "ALERT",
+                                    system.System.GetUserName(),
+                                    system.System.GetApplicationName(),
+                                    system=True)
+            self.sources[alert['name']] = source
+        source.send(alert['contents'])
+        Llog.LogInfo(alert['state'] + " " + alert['name'] + " "
+                     + ":".join(alert['contents'][1:4]))
+        if self.user_cback is not None:
+            self.user_cback(alert)
+
+    def close(self):
+        self.engine.close()
+
+
+def test1():
+
+    # Rules driven by event_cback() and tick() with explicit times, so
+    # the test does not depend on the clock or the network.
+    alerts = []
+
+    def alert_cback(alert):
+        alerts.append(alert)
+
+    def vital(name, **fields):
+        event = {'type': "VITAL",
+                 'name': name,
+                 'user_name': "sysadmin",
+                 'application_name': "alerttest"}
+        event.update(fields)
+        return event
+
+    engine = AlertEngine(["hot temp* value > 50",
+                          "failing sysadmin:*:errors/* rate > 10/min",
+                          "quiet heartbeat absent 30s",
+                          "full queue_depth threshold"],
+                         alert_cback)
+    engine.close()
+    assert(str(engine.rules[1]) == "failing sysadmin:*:errors/* "
+                                   "rate > 10/min")
+
+    # Value
+    engine.event_cback(vital("temperature", value=40.0), 1000)
+    engine.event_cback(vital("temperature", value=60.0), 1001)
+    engine.event_cback(vital("temperature", value=70.0), 1002)
+    assert(len(alerts) == 1 and alerts[0]['state'] == "FIRING")
+    assert(alerts[0]['name'] == "hot")
+    assert(alerts[0]['contents'] == ["FIRING", "sysadmin", "alerttest",
+                                     "temperature", "60", "value > 50"])
+    engine.event_cback(vital("temperature", value=20.0), 1003)
+    assert(alerts[-1]['state'] == "RESOLVED" and alerts[-1]['value'] == 20)
+
+    # Rate, from the deltas of one instance, decaying without events
+    del alerts[:]
+    engine.event_cback(vital("errors/a", value=5, delta=5), 1200)
+    assert(alerts == [])
+    engine.event_cback(vital("errors/a", value=11, delta=6), 1210)
+    assert(len(alerts) == 1 and alerts[0]['vital'] == "errors/a")
+    assert(alerts[0]['value'] == 11)
+    engine.tick(1250)
+    assert(len(alerts) == 1)
+    engine.tick(1300)
+    assert(len(alerts) == 2 and alerts[1]['state'] == "RESOLVED")
+    assert(engine.decaying == {})
+    # Other users are not matched
+    engine.event_cback({'type': "VITAL", 'name': "errors/a",
+                        'user_name': "other", 'application_name': "x",
+                        'value': 100, 'delta': 100}, 1300)
+    assert(len(alerts) == 2)
+
+    # Threshold
+    del alerts[:]
+    engine.event_cback(vital("queue_depth", value=120.0, threshold=100.0,
+                             state="above"), 1400)
+    engine.event_cback(vital("queue_depth", value=90.0, updates=1), 1401)
+    engine.event_cback(vital("queue_depth", value=90.0, threshold=100.0,
+                             state="below"), 1402)
+    assert([a['state'] for a in alerts] == ["FIRING", "RESOLVED"])
+
+    # Absent
+    del alerts[:]
+    engine.event_cback(vital("heartbeat", value=1), 2000)
+    engine.tick(2020)
+    assert(alerts == [])
+    engine.tick(2031)
+    assert(len(alerts) == 1 and alerts[0]['state'] == "FIRING")
+    assert(engine.firing() == [("quiet", ("sysadmin", "alerttest",
+                                          "heartbeat"))])
+    engine.tick(2100)
+    assert(len(alerts) == 1)
+    engine.event_cback(vital("heartbeat", value=2), 2101)
+    assert(len(alerts) == 2 and alerts[1]['state'] == "RESOLVED")
+    assert(engine.stats.firing == 0)
+
+    for text in ["x y", "x y value = 3", "x y rate < 3/min",
+                 "x y rate > 3/h", "x y absent"]:
+        try:
+            AlertRule.Parse(text)
+            assert(False)
+        except ValueError:
+            pass
+
+    # The base rule is abstract
+    rejected = False
+    try:
+        AlertEngine([AlertRule("any", "temp*")], alert_cback)
+    except ValueError:
+        rejected = True
+    assert(rejected is True)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # End to end: vitals in, ALERT events out.
+    import event_collector
+    system.System.Init("sysadmin", "alerttest", "test2")
+
+    alerts = []
+    received = []
+
+    def alert_cback(alert):
+        alerts.append(alert)
+
+    class Watcher(object):
+        def event_cback(self, event):
+            received.append(event)
+
+    watcher = Watcher()
+    collector = event_collector.EventCollector(["ALERT"],
+                                               watcher.event_cback,
+                                               "sysadmin")
+    alerter = AlertCollector(["busy load value > 10"], alert_cback,
+                             "sysadmin", "alerttest")
+    # Discovery of the vitals and the alerts
+    time.sleep(10)
+    vitals.VitalFlusher.SetPeriod(0.25)
+    gauge = vitals.VStatGauge("load", "Load")
+    gauge.set(50)
+    time.sleep(2)
+    assert(len(alerts) == 1 and alerts[0]['state'] == "FIRING")
+    time.sleep(10)
+    assert(len(received) >= 1)
+    assert(received[0]['name'] == "busy")
+    assert(received[0]['contents'][0] == "FIRING")
+    assert(received[0]['contents'][3] == "load")
+    gauge.close()
+    alerter.close()
+    print "test2() PASSED"
+
+
+def bench1():
+
+    # Events per second through an engine with a rule of each kind
+    # and a thousand keys.
+    alerts = []
+
+    def alert_cback(alert):
+        alerts.append(alert)
+
+    engine = AlertEngine(["hot temp* value > 50",
+                          "failing errors/* rate > 10/min",
+                          "quiet * absent 30s"],
+                         alert_cback)
+    engine.close()
+    events = []
+    for i in range(1000):
+        events.append({'type': "VITAL", 'name': "errors/%d" % i,
+                       'user_name': "sysadmin",
+                       'application_name': "alertbench",
+                       'value': i, 'delta': 1})
+    nr_events = 100000
+    now = 1000.0
+    start = time.time()
+    for i in xrange(nr_events):
+        engine.event_cback(events[i % 1000], now + i * 0.001)
+    elapsed = time.time() - start
+    print "bench1() " + str(int(nr_events / elapsed)) + " events/s, " \
+          + str(len(engine.rules)) + " rules, 1000 keys"
+
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    bench1()
@@ -5,8 +5,14 @@
 import system
 import event_source
 import event_collector
+import stats
+import math
+import threading
 import time
 import types
+import weakref
+from event import Event
+from timestamp import Timestamp
 from local_log import *
 
 
@@ -23,6 +29,32 @@ from local_log import *
 # statistics, (ie. ERROR, THRESHOLD, ...), have their own objects
 # below (VStatErrorEvent, VStatThresholdEvent, ...) and use the first
 # field of the event contents to indicate the vital statistic type.
+#
+# Updating a vital statistic does not send an event right away.  The
+# updates are accumulated, and a single VitalFlusher thread per process
+# sends one event per updated statistic every VitalFlusher.period
+# seconds, carrying the value, the delta since the last flush and the
+# number of updates.  So a statistic bumped in a hot error path costs a
+# few instructions per update, and one message per period.
+# CRITICAL statistics, and those created with immediate=True, are still
+# sent on every update.
+#
+# Besides ERROR and CRITICAL, there are COUNTER, GAUGE and HISTOGRAM
+# statistics (VStatCounter, VStatGauge, VStatHistogram), updated by
+# method calls rather than assignment.  Counters and histograms are
+# recorded into a per-thread shard without taking a lock; the shards
+# are merged when the statistic is flushed.
+#
+# ERROR and CRITICAL statistics keep a value per instance of the class
+# they are declared in, in a slot-based InstanceSlots registry.  An
+# instance with a vital_label attribute has its events sent as
+# <name>/<label>, e.g. "requests_failed/session-12".  The other
+# statistics take an optional label when created.  All the statistics
+# of a process send through the one shared EventSocket.
+#
+# The stats of the registered ZSockets, Protocols, Interfaces and
+# EventDispatchers (see stats.py) are published as STATS vitals by a
+# StatsExporter, on the VitalFlusher cycle.
 
 class VStatEvent(object):
 
@@ -47,23 +79,33 @@ class VStatEvent(object):
         # ensure the colon is not used in the name or description
         assert(vstat_type.count(":") == 0)
         assert(description.count(":") == 0)
+        # '/' separates the instance label
+        assert(name.count("/") == 0)
 
         self.user_name = system.System.GetUserName()
         self.application_name = system.System.GetApplicationName()
 
-        self.event = event_source.EventSource(name,
-                                              "VITAL",
-                                              self.user_name,
-                                              self.application_name)
+        self.socket = event_source.EventSource.GetSocket(
+                                                self.user_name,
+                                                self.application_name)
         self.description = description
         self.name = name
         self.vstat_type = vstat_type
 
-    def send(self, values):
+    def send(self, values, label=None):
         assert(isinstance(values, types.ListType))
-        msg = [self.vstat_type,
-               self.description] + values
-        self.event.send(msg)
+        name = self.name
+        if label is not None:
+            name += "/" + label
+        msg = {'message':["VITAL",
+                          name,
+                          str(Timestamp.Now()),
+                          self.user_name,
+                          self.application_name,
+                          self.vstat_type,
+                          self.description] + [str(value)
+                                               for value in values]}
+        self.socket.send(msg, system=True)
 
     @staticmethod
     def decode(event):
@@ -81,63 +123,791 @@ class VStatEvent(object):
         event['vital_type'] = msg[0]
         event['description'] = msg[1]
         event['values'] = msg[2:]
+        name, sep, label = event['name'].partition("/")
+        if sep != "":
+            event['instance'] = label
 
 
 class VStatErrorEvent(VStatEvent):
 
+    """
+        <value> <delta since the last event> <number of updates>
+
+        Older sources send only the value and the delta.
+    """
+
+    def __init__(self, name, description, vstat_type="ERROR"):
+        VStatEvent.__init__(self, name, vstat_type, description)
+
+    def send(self, value, delta, updates=1, label=None):
+        VStatEvent.send(self, [value, delta, updates], label)
+
+    @staticmethod
+    def decode_values(values):
+        if len(values) not in [2, 3]:
+            return None
+        fields = {'value': int(values[0]),
+                  'delta': int(values[1]),
+                  'updates': 1}
+        if len(values) == 3:
+            fields['updates'] = int(values[2])
+        return fields
+
+
+class VStatThresholdEvent(VStatEvent):
+
+    """
+        <value> <threshold> <above|below>
+
+        Sent when a gauge crosses its threshold, in either direction.
+    """
+
     def __init__(self, name, description):
-        VStatEvent.__init__(self, name, "ERROR", description)
+        VStatEvent.__init__(self, name, "THRESHOLD", description)
 
-    def send(self, value, delta):
-        VStatEvent.send(self, [value, delta])
+    def send(self, value, threshold, state, label=None):
+        VStatEvent.send(self, [value, threshold, state], label)
 
     @staticmethod
-    def decode(event):
-        if len(event['values']) != 2:
-            Llog.LogError("Invalid event values!")
+    def decode_values(values):
+        if len(values) != 3 or values[2] not in ["above", "below"]:
             return None
+        return {'value': float(values[0]),
+                'threshold': float(values[1]),
+                'state': values[2]}
 
-        event['value'] = int(event['values'][0])
-        event['delta'] = int(event['values'][1])
 
+class VStatCounterEvent(VStatEvent):
 
-class VStatError(object):
+    """
+        <total> <delta since the last event>
+    """
+
+    def __init__(self, name, description):
+        VStatEvent.__init__(self, name, "COUNTER", description)
+
+    def send(self, value, delta, label=None):
+        VStatEvent.send(self, [value, delta], label)
+
+    @staticmethod
+    def decode_values(values):
+        if len(values) != 2:
+            return None
+        return {'value': int(values[0]), 'delta': int(values[1])}
+
+
+class VStatGaugeEvent(VStatEvent):
+
+    """
+        <value> <number of updates since the last event>
+    """
+
+    def __init__(self, name, description):
+        VStatEvent.__init__(self, name, "GAUGE", description)
+
+    def send(self, value, updates, label=None):
+        VStatEvent.send(self, [value, updates], label)
+
+    @staticmethod
+    def decode_values(values):
+        if len(values) != 2:
+            return None
+        return {'value': float(values[0]), 'updates': int(values[1])}
+
+
+class VStatHistogramEvent(VStatEvent):
+
+    """
+        <count> <sum> <sub buckets> <bucket> <count> ... <bucket> <count>
+
+        Cumulative since the statistic was created.  Only the non-empty
+        buckets are sent, by index (see LogLinearBuckets).
+    """
 
     def __init__(self, name, description):
+        VStatEvent.__init__(self, name, "HISTOGRAM", description)
+
+    def send(self, count, total, sub_buckets, buckets, label=None):
+        values = [count, total, sub_buckets]
+        for index in sorted(buckets.keys()):
+            values += [index, buckets[index]]
+        VStatEvent.send(self, values, label)
+
+    @staticmethod
+    def decode_values(values):
+        # 'buckets' is a list of (lower bound, count), in order.
+        if len(values) < 3 or len(values) % 2 == 0:
+            return None
+        scale = LogLinearBuckets(int(values[2]))
+        buckets = []
+        for i in range(3, len(values), 2):
+            buckets.append((scale.lower_bound(int(values[i])),
+                            int(values[i + 1])))
+        return {'count': int(values[0]),
+                'sum': float(values[1]),
+                'buckets': buckets}
+
+    @staticmethod
+    def percentile(buckets, p):
+        # Lower bound of the bucket holding the p'th percentile, from
+        # decoded buckets.
+        count = sum([n for lower, n in buckets])
+        rank = p / 100.0 * count
+        seen = 0
+        for lower, n in buckets:
+            seen += n
+            if seen >= rank:
+                return lower
+        return 0
+
+
+def stats_name(name, label):
+    # Name of a statistic on the stats page (see stats_page.py)
+    if label is None:
+        return "vital." + name
+    return "vital." + name + "/" + label
+
+
+class VitalFlusher(object):
+
+    """
+        Sends the accumulated updates of every vital statistic in the
+        process, from a single background thread.
+    """
+
+    period = 1.0
+    vitals = []
+    lock = threading.Lock()
+    thread = None
+
+    @staticmethod
+    def Register(vital):
+        VitalFlusher.lock.acquire()
+        try:
+            VitalFlusher.vitals.append(vital)
+        finally:
+            VitalFlusher.lock.release()
+        VitalFlusher.Start()
+
+    @staticmethod
+    def Start():
+        # Started by the first statistic, along with the StatsExporter.
+        VitalFlusher.lock.acquire()
+        try:
+            if VitalFlusher.thread is not None:
+                return
+            if StatsExporter.enabled is True:
+                VitalFlusher.vitals.append(StatsExporter())
+            VitalFlusher.thread = threading.Thread(
+                                target=VitalFlusher.ThreadEntry)
+            VitalFlusher.thread.daemon = True
+            VitalFlusher.thread.start()
+        finally:
+            VitalFlusher.lock.release()
+
+    @staticmethod
+    def SetPeriod(period):
+        assert(period > 0)
+        VitalFlusher.period = period
+
+    @staticmethod
+    def Unregister(vital):
+        VitalFlusher.lock.acquire()
+        try:
+            if vital in VitalFlusher.vitals:
+                VitalFlusher.vitals.remove(vital)
+        finally:
+            VitalFlusher.lock.release()
+
+    @staticmethod
+    def Flush():
+        VitalFlusher.lock.acquire()
+        vitals = VitalFlusher.vitals[:]
+        VitalFlusher.lock.release()
+        for vital in vitals:
+            vital.flush()
+
+    @staticmethod
+    def Values():
+        # (name, value) of every statistic, for the stats page
+        VitalFlusher.lock.acquire()
+        vitals = VitalFlusher.vitals[:]
+        VitalFlusher.lock.release()
+        values = []
+        for vital in vitals:
+            values += vital.stats_values()
+        return values
+
+    @staticmethod
+    def ThreadEntry():
+        while True:
+            time.sleep(VitalFlusher.period)
+            try:
+                VitalFlusher.Flush()
+            except Exception as e:
+                Llog.LogError("Vital statistics flush failed: " + str(e))
+
+
+class InstanceSlots(object):
+
+    """
+        Per-instance numeric fields of a statistic, held in one list per
+        field rather than on each instance.  An instance is given a slot
+        on its first update.  Once the instance has been garbage
+        collected, its slot is freed for reuse by the next release().
+        An instance that cannot be weakly referenced (e.g. its class has
+        __slots__ without __weakref__) is pinned instead: it is kept
+        alive, and its slot held, for the life of the statistic.  The
+        caller serializes the calls.
+    """
+
+    def __init__(self, fields, release_cback):
+        # release_cback(slot) is called before a slot is freed.
+        # Lists rather than typed arrays: a value may be a float or a
+        # long beyond the range of a C long.
+        self.fields = dict([(field, []) for field in fields])
+        self.labels = []
+        self.refs = []
+        # id(instance) -> instance, for the instances without weakref
+        # support.  Holding them keeps their ids from being reused.
+        self.pinned = {}
+        # id(instance) -> slot
+        self.slots = {}
+        self.free = []
+        # ids of the collected instances, appended by the garbage
+        # collector in any thread.
+        self.dead = []
+        self.release_cback = release_cback
+
+    def find(self, instance):
+        return self.slots.get(id(instance))
+
+    def get(self, instance):
+        slot = self.slots.get(id(instance))
+        if slot is not None:
+            return slot
+
+        instance_id = id(instance)
+        try:
+            ref = weakref.ref(instance,
+                              lambda ref: self.dead.append(instance_id))
+        except TypeError:
+            self.pinned[instance_id] = instance
+            ref = None
+        label = getattr(instance, "vital_label", None)
+        if len(self.free) > 0:
+            slot = self.free.pop()
+            self.refs[slot] = ref
+            self.labels[slot] = label
+            for values in self.fields.values():
+                values[slot] = 0
+        else:
+            slot = len(self.refs)
+            self.refs.append(ref)
+            self.labels.append(label)
+            for values in self.fields.values():
+                values.append(0)
+        self.slots[instance_id] = slot
+        return slot
+
+    def used(self):
+        return self.slots.values()
+
+    def release(self):
+        # Free the slots of the collected instances
+        while len(self.dead) > 0:
+            instance_id = self.dead.pop()
+            slot = self.slots.pop(instance_id, None)
+            if slot is None:
+                continue
+            self.release_cback(slot)
+            self.refs[slot] = None
+            self.free.append(slot)
+
+
+class VStatError(object):
+
+    vstat_type = "ERROR"
+
+    def __init__(self, name, description, immediate=False):
         self.name = name
         self.description = description
-        self.event = VStatErrorEvent(name, description)
-        self.value = 0
+        self.event = VStatErrorEvent(name, description, self.vstat_type)
+        self.immediate = immediate
+        self.lock = threading.Lock()
+        # Per instance: value, value at the last flush, updates since
+        self.instances = InstanceSlots(["value", "flushed", "updates"],
+                                       self.__flush)
+        self.values = self.instances.fields["value"]
+        self.flushed = self.instances.fields["flushed"]
+        self.updates = self.instances.fields["updates"]
+        VitalFlusher.Register(self)
 
     def __set__(self, instance, value):
-        delta = value - self.value
+        self.lock.acquire()
+        try:
+            if len(self.instances.dead) > 0:
+                # Before a collected instance's id is reused
+                self.instances.release()
+            slot = self.instances.get(instance)
+            if value == self.values[slot]:
+                # Nothing has changed.  Nothing else to do...
+                return
+            self.values[slot] = value
+            self.updates[slot] += 1
+            if self.immediate is True:
+                self.__flush(slot)
+        finally:
+            self.lock.release()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if len(self.instances.dead) > 0:
+            self.lock.acquire()
+            try:
+                self.instances.release()
+            finally:
+                self.lock.release()
+        # A live instance's slot cannot change under us
+        slot = self.instances.find(instance)
+        if slot is None:
+            return 0
+        return self.values[slot]
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.instances.release()
+            for slot in self.instances.used():
+                self.__flush(slot)
+        finally:
+            self.lock.release()
 
-        if delta == 0:
-            # Nothing has changed.  Nothing else to do...
+    def stats_values(self):
+        self.lock.acquire()
+        try:
+            return [(stats_name(self.name, self.instances.labels[slot]),
+                     self.values[slot])
+                    for slot in self.instances.used()]
+        finally:
+            self.lock.release()
+
+    def __flush(self, slot):
+        if self.updates[slot] == 0:
             return
+        value = self.values[slot]
+        self.event.send(value,
+                        value - self.flushed[slot],
+                        self.updates[slot],
+                        self.instances.labels[slot])
+        self.flushed[slot] = value
+        self.updates[slot] = 0
+
+
+class VStatCritical(VStatError):
+
+    """
+        Like VStatError, but every update is sent right away.
+    """
+
+    vstat_type = "CRITICAL"
+
+    def __init__(self, name, description):
+        VStatError.__init__(self, name, description, immediate=True)
+
+
+# Alias kept for the agents
+VitalStatisticError = VStatError
+
+stats.StatsRegistry.AddProvider(VitalFlusher.Values)
+
+
+class LogLinearBuckets(object):
+
+    """
+        Histogram buckets which are linear within each power of two.
+        Bucket 0 holds the values below 1.  Each power of two range above
+        that is split into sub_buckets equal buckets, so a value is known
+        to within 1 / sub_buckets of itself.
+    """
+
+    def __init__(self, sub_buckets=8):
+        assert(sub_buckets > 0)
+        self.sub_buckets = sub_buckets
+
+    def index(self, value):
+        if value < 1:
+            return 0
+        # value = mantissa * 2^exponent, 0.5 <= mantissa < 1
+        mantissa, exponent = math.frexp(value)
+        return 1 + (exponent - 1) * self.sub_buckets + \
+               int((2 * mantissa - 1) * self.sub_buckets)
+
+    def lower_bound(self, index):
+        if index == 0:
+            return 0
+        exponent, sub_bucket = divmod(index - 1, self.sub_buckets)
+        return (2 ** exponent) * (1 + float(sub_bucket) / self.sub_buckets)
+
+
+class ThreadShards(object):
+
+    """
+        One copy of a statistic's state per recording thread, so threads
+        never contend on a lock to record.  The shards of threads which
+        have exited are folded into a retired shard when merged.
+    """
+
+    def __init__(self, factory, fold):
+        # factory() returns a new shard, fold(into, shard) adds a shard
+        # into another.
+        self.factory = factory
+        self.fold = fold
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = factory()
+
+    def get(self):
+        # The calling thread's shard
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.factory()
+            self.local.shard = shard
+            self.lock.acquire()
+            self.shards.append((threading.current_thread(), shard))
+            self.lock.release()
+            return shard
+
+    def merge(self):
+        # Returns a new shard holding the sum of every shard
+        self.lock.acquire()
+        try:
+            live = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    self.fold(self.retired, shard)
+            self.shards = live
+            merged = self.factory()
+            self.fold(merged, self.retired)
+            for thread, shard in live:
+                self.fold(merged, shard)
+            return merged
+        finally:
+            self.lock.release()
+
+
+class VStatCounter(object):
+
+    """
+        Monotonic counter.  stat.inc(), stat.inc(n)
+    """
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.event = VStatCounterEvent(name, description)
+        self.shards = ThreadShards(VStatCounter.NewShard,
+                                   VStatCounter.FoldShard)
+        self.flushed_value = 0
+        VitalFlusher.Register(self)
+
+    @staticmethod
+    def NewShard():
+        return [0]
+
+    @staticmethod
+    def FoldShard(into, shard):
+        into[0] += shard[0]
 
+    def inc(self, count=1):
+        assert(count >= 0)
+        self.shards.get()[0] += count
+
+    @property
+    def value(self):
+        return self.shards.merge()[0]
+
+    def flush(self):
+        value = self.value
+        if value == self.flushed_value:
+            return
+        self.event.send(value, value - self.flushed_value, self.label)
+        self.flushed_value = value
+
+    def stats_values(self):
+        return [(stats_name(self.name, self.label), self.value)]
+
+    def close(self):
+        # Send what is pending, and stop flushing this statistic.
+        VitalFlusher.Unregister(self)
+        self.flush()
+
+
+class VStatGauge(object):
+
+    """
+        Last value wins.  stat.set(value)
+
+        With a threshold, a THRESHOLD event is also sent when a flushed
+        value crosses it.
+    """
+
+    def __init__(self, name, description, threshold=None, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.event = VStatGaugeEvent(name, description)
+        self.threshold = threshold
+        self.threshold_event = None
+        if threshold is not None:
+            self.threshold_event = VStatThresholdEvent(name, description)
+        # Single assignments, safe without a lock.  The update count is
+        # approximate when several threads set the gauge.
+        self.value = 0
+        self.updates = 0
+        self.above = False
+        VitalFlusher.Register(self)
+
+    def set(self, value):
         self.value = value
-        # The value has been updated.  Issue the event.
-        self.event.send(self.value, delta)
+        self.updates += 1
 
-    def __get__(self, instance, owner):
-        return self.value
+    def flush(self):
+        updates = self.updates
+        if updates == 0:
+            return
+        self.updates = 0
+        value = self.value
+        self.event.send(value, updates, self.label)
+
+        if self.threshold is None:
+            return
+        above = value > self.threshold
+        if above != self.above:
+            self.above = above
+            self.threshold_event.send(value,
+                                      self.threshold,
+                                      "above" if above else "below",
+                                      self.label)
+
+    def stats_values(self):
+        return [(stats_name(self.name, self.label), self.value)]
+
+    def close(self):
+        VitalFlusher.Unregister(self)
+        self.flush()
+
+
+class VStatHistogram(object):
+
+    """
+        Distribution of values, e.g. latencies in microseconds, in
+        log-linear buckets.  stat.record(value)
+    """
+
+    def __init__(self, name, description, sub_buckets=8, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.event = VStatHistogramEvent(name, description)
+        self.scale = LogLinearBuckets(sub_buckets)
+        self.shards = ThreadShards(VStatHistogram.NewShard,
+                                   VStatHistogram.FoldShard)
+        self.flushed_count = 0
+        VitalFlusher.Register(self)
+
+    @staticmethod
+    def NewShard():
+        # [count, sum, {bucket index: count}]
+        return [0, 0, {}]
+
+    @staticmethod
+    def FoldShard(into, shard):
+        into[0] += shard[0]
+        into[1] += shard[1]
+        # items() copies the dict in one step, so the owning thread may
+        # keep recording into it.
+        for index, count in shard[2].items():
+            into[2][index] = into[2].get(index, 0) + count
+
+    def record(self, value):
+        shard = self.shards.get()
+        index = self.scale.index(value)
+        buckets = shard[2]
+        buckets[index] = buckets.get(index, 0) + 1
+        shard[1] += value
+        shard[0] += 1
+
+    def snapshot(self):
+        # Returns (count, sum, {bucket index: count})
+        merged = self.shards.merge()
+        return (merged[0], merged[1], merged[2])
+
+    def flush(self):
+        count, total, buckets = self.snapshot()
+        if count == self.flushed_count:
+            return
+        self.event.send(count, total, self.scale.sub_buckets, buckets,
+                        self.label)
+        self.flushed_count = count
+
+    def stats_values(self):
+        count, total, buckets = self.snapshot()
+        name = stats_name(self.name, self.label)
+        return [(name + ".count", count), (name + ".sum", total)]
+
+    def close(self):
+        VitalFlusher.Unregister(self)
+        self.flush()
+
+
+class VStatStatsEvent(VStatEvent):
+
+    """
+        <name> <value> ... <name> <value>
+
+        The stats of one registered object (see stats.py): its counters,
+        any extra values such as queue depths, and the rate per second
+        of each counter, named <counter>/s.  Counters which are still 0
+        are left out.  The event is named
+        <kind>/<label>, e.g. zsocket/EVENT/PUB@tcp://127.0.0.1:7000 or
+        protocol/app-ctrl.
+    """
+
+    def __init__(self, kind):
+        VStatEvent.__init__(self, kind, "STATS", kind + " stats")
+
+    def send(self, values, label):
+        fields = []
+        for name in sorted(values.keys()):
+            fields += [name, values[name]]
+        VStatEvent.send(self, fields, label)
+
+    @staticmethod
+    def decode_values(values):
+        if len(values) % 2 != 0:
+            return None
+        fields = {}
+        for i in range(0, len(values), 2):
+            fields[values[i]] = float(values[i + 1])
+        return {'stats': fields}
+
+
+class StatsExporter(object):
+
+    """
+        Publishes the stats of the registered objects as STATS vitals,
+        every period seconds.  Objects whose counters have not moved
+        since they were last published are skipped.  Like the other
+        vitals, the events count against the user's system event budget
+        (see rate_limit.py), not the application's; the period is kept
+        well above the flush period so they take little of it.
+    """
+
+    enabled = True
+    period = 10.0
+    kinds = ["zsocket", "protocol", "interface", "dispatcher"]
+
+    def __init__(self):
+        self.rates = stats.StatsRates()
+        # kind -> VStatStatsEvent
+        self.events = {}
+        # (kind, label) -> (values published, all the rates were 0)
+        self.published = {}
+        self.last_time = 0
+
+    def flush(self):
+        now = time.time()
+        if now - self.last_time < self.period:
+            return
+        self.last_time = now
+
+        live = set()
+        for kind, label, obj in stats.StatsRegistry.Objects():
+            if kind not in self.kinds:
+                continue
+            key = (kind, label)
+            live.add(key)
+            rates = self.rates.update(kind, label,
+                                      stats.StatsRegistry.Counters(obj),
+                                      now)
+            values = stats.StatsRegistry.Values(obj)
+            idle = max(rates.values() + [0]) == 0
+            published = self.published.get(key)
+            if published is not None and published[0] == values and \
+               published[1] is True:
+                continue
+            self.published[key] = (dict(values), idle)
+
+            for name, rate in rates.items():
+                if values[name] == 0:
+                    # Keep the events short: counters which never
+                    # moved, mostly errors, are left out.
+                    del values[name]
+                    continue
+                values[name + "/s"] = "%.3f" % rate
+            event = self.events.get(kind)
+            if event is None:
+                event = VStatStatsEvent(kind)
+                self.events[kind] = event
+            event.send(values, label)
+
+        self.rates.forget(live)
+        for key in self.published.keys():
+            if key not in live:
+                del self.published[key]
+
+    def stats_values(self):
+        return []
 
 
 class VStatEventDecoder():
 
+    # vital type -> class with a decode_values(values) method
+    DECODERS = {"ERROR": VStatErrorEvent,
+                "CRITICAL": VStatErrorEvent,
+                "THRESHOLD": VStatThresholdEvent,
+                "COUNTER": VStatCounterEvent,
+                "GAUGE": VStatGaugeEvent,
+                "HISTOGRAM": VStatHistogramEvent,
+                "STATS": VStatStatsEvent}
+
+    @staticmethod
+    def DecodeValues(vital_type, values):
+        # Returns the dict of fields parsed out of the values, or None if
+        # they are not valid for the type.
+        decoder = VStatEventDecoder.DECODERS.get(vital_type)
+        if decoder is None:
+            return None
+        try:
+            return decoder.decode_values(values)
+        except ValueError:
+            return None
+
     @staticmethod
     def decode(event):
-        VStatEvent.decode(event)
-        if event['vital_type'] == "THRESHOLD":
-            VStatThresholdEvent.decode(event)
-            return
-        if event['vital_type'] == "ERROR":
-            VStatErrorEvent.decode(event)
+        if isinstance(event, Event):
+            # Event objects decode their vital fields on first use.
             return
+        VStatEvent.decode(event)
+        if event['vital_type'] not in VStatEventDecoder.DECODERS:
+            Llog.LogError("Invalid vital statistic type: "
+                          + event['vital_type'])
+            assert(False)
 
-        Llog.LogError("Invalid vital statistic type: " + event['vital_type'])
-        assert(False)
+        fields = VStatEventDecoder.DecodeValues(event['vital_type'],
+                                                event['values'])
+        if fields is None:
+            Llog.LogError("Invalid event values!")
+            return
+        for key, value in fields.items():
+            event[key] = value
 
 
 class VitalEventCollector():
@@ -160,29 +930,24 @@ class VitalEventCollector():
             self.vital_rx_cback(event)
 
 
+class EventWatcher():
+    def __init__(self, vital_types):
+        self.events = []
+        self.collector = VitalEventCollector(vital_types, self.event_cback)
+
+    def event_cback(self, event):
+        self.events.append(event)
+
+
 def test1():
 
-    class EventWatcher():
-        def __init__(self):
-            self.events = 0
-            self.value = 0
-            self.delta = 0
-            self.collector = VitalEventCollector(
-                                    ["ERROR"],
-                                    self.event_cback)
-
-        def event_cback(self, event):
-            assert(event['vital_type'] == "ERROR")
-            self.events += 1
-            self.value = event['value']
-            self.delta = event['delta']
-
-    evtwatch = EventWatcher()
+    evtwatch = EventWatcher(["ERROR"])
     # We need to wait for a while here.  The service below will not
     # output a discovery frame right away, causing our event watcher
     # to miss the broadcast.  We wait for approximately 1 beacon frame
     # period, then proceed, allowing time to discover the service.
     time.sleep(10)
+    VitalFlusher.SetPeriod(0.25)
 
     class Myclass(object):
         mystat = VStatError("mystat", "Some junk statistic")
@@ -190,21 +955,267 @@ def test1():
     mc = Myclass()
     mc.mystat += 1
     time.sleep(1)
-    assert(evtwatch.value == 1)
-    assert(evtwatch.delta == 1)
+    assert(evtwatch.events[-1]['value'] == 1)
+    assert(evtwatch.events[-1]['delta'] == 1)
 
     mc.mystat += 1
     time.sleep(1)
-    assert(evtwatch.value == 2)
-    assert(evtwatch.delta == 1)
+    assert(evtwatch.events[-1]['value'] == 2)
+    assert(evtwatch.events[-1]['delta'] == 1)
     mc.mystat += 12345
     time.sleep(1)
-    assert(evtwatch.value == 12347)
-    assert(evtwatch.delta == 12345)
+    assert(evtwatch.events[-1]['value'] == 12347)
+    assert(evtwatch.events[-1]['delta'] == 12345)
     time.sleep(1)
 
-    assert(evtwatch.events == 3)
-    print "PASSED"
+    assert(len(evtwatch.events) == 3)
+    print "test1() PASSED"
+
+
+def test2():
+
+    # Updates are coalesced, except for CRITICAL statistics.
+    evtwatch = EventWatcher(["ERROR", "CRITICAL"])
+    time.sleep(10)
+    VitalFlusher.SetPeriod(0.5)
+
+    class Myclass(object):
+        errors = VStatError("coalesced", "Coalesced statistic")
+        crashes = VStatCritical("crashes", "Critical statistic")
+
+    mc = Myclass()
+    for i in range(1000):
+        mc.errors += 1
+    mc.crashes += 1
+    time.sleep(0.1)
+    mc.crashes += 1
+    time.sleep(0.1)
+    critical = [event for event in evtwatch.events
+                if event['vital_type'] == "CRITICAL"]
+    assert([event['value'] for event in critical] == [1, 2])
+    time.sleep(1)
+
+    errors = [event for event in evtwatch.events
+              if event['vital_type'] == "ERROR"]
+    assert(len(errors) == 1)
+    assert(errors[0]['value'] == 1000)
+    assert(errors[0]['delta'] == 1000)
+    assert(errors[0]['updates'] == 1000)
+    print "test2() PASSED"
+
+
+def test3():
+
+    scale = LogLinearBuckets(8)
+    assert(scale.index(0.5) == 0)
+    assert(scale.index(1) == 1)
+    assert(scale.index(1.99) == 8)
+    assert(scale.index(2) == 9)
+    for value in [1, 3, 10, 1000, 123456.7]:
+        lower = scale.lower_bound(scale.index(value))
+        assert(lower <= value and value < lower * 1.125 + 1e-9)
+
+    # Counts recorded from several threads are all merged
+    counter = VStatCounter("requests", "Requests handled")
+    histogram = VStatHistogram("latency", "Request latency in us")
+
+    def record():
+        for i in range(10000):
+            counter.inc()
+            histogram.record(i % 100)
+
+    threads = [threading.Thread(target=record) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(5)
+    assert(counter.value == 40005)
+    count, total, buckets = histogram.snapshot()
+    assert(count == 40000)
+    assert(total == 4 * 100 * sum(range(100)))
+    assert(sum(buckets.values()) == 40000)
+    # The exited threads' shards are folded away
+    assert(len(counter.shards.shards) == 1)
+    assert(counter.value == 40005)
+    print "test3() PASSED"
+
+
+def test4():
+
+    # Counters, gauges and histograms through the VITAL event path
+    evtwatch = EventWatcher(["COUNTER", "GAUGE", "HISTOGRAM", "THRESHOLD"])
+    time.sleep(10)
+    VitalFlusher.SetPeriod(0.5)
+
+    class Myclass(object):
+        requests = VStatCounter("requests2", "Requests handled")
+        depth = VStatGauge("depth", "Queue depth", threshold=100)
+        latency = VStatHistogram("latency2", "Request latency in us")
+
+    mc = Myclass()
+    for i in range(1000):
+        mc.requests.inc()
+        mc.latency.record(i)
+    mc.depth.set(50)
+    mc.depth.set(150)
+    time.sleep(1)
+    mc.requests.inc(10)
+    time.sleep(1)
+
+    events = {}
+    for event in evtwatch.events:
+        # Discovery by query is quick enough to also catch the last
+        # flush of test3's statistics.
+        if event['name'] in ["requests2", "depth", "latency2"]:
+            events.setdefault(event['vital_type'], []).append(event)
+    counter = events["COUNTER"]
+    assert([(event['value'], event['delta']) for event in counter] == \
+           [(1000, 1000), (1010, 10)])
+    assert(len(events["GAUGE"]) == 1)
+    assert(events["GAUGE"][0]['value'] == 150)
+    assert(events["GAUGE"][0]['updates'] == 2)
+    threshold = events["THRESHOLD"][0]
+    assert(threshold['state'] == "above" and threshold['threshold'] == 100)
+    histogram = events["HISTOGRAM"][0]
+    assert(histogram['count'] == 1000)
+    assert(histogram['sum'] == sum(range(1000)))
+    median = VStatHistogramEvent.percentile(histogram['buckets'], 50)
+    assert(median >= 448 and median <= 500)
+    print "test4() PASSED"
+
+
+def bench1():
+
+    # Recording cost of a counter against an ERROR statistic
+    class Myclass(object):
+        errors = VStatError("bench_errors", "Benchmark errors")
+        requests = VStatCounter("bench_requests", "Benchmark requests")
+        latency = VStatHistogram("bench_latency", "Benchmark latency")
+
+    mc = Myclass()
+    nr_loops = 200000
+    for label, record in [("VStatError +=", None),
+                          ("VStatCounter.inc()", mc.requests.inc),
+                          ("VStatHistogram.record()", mc.latency.record)]:
+        start = time.time()
+        if record is None:
+            for i in xrange(nr_loops):
+                mc.errors += 1
+        else:
+            for i in xrange(nr_loops):
+                record(i)
+        elapsed = time.time() - start
+        print "bench1() " + label + ": " + \
+              "%.2f" % (elapsed / nr_loops * 1000000) + "us"
+
+
+def test5():
+
+    # Statistics kept per instance, labelled by instance
+    import gc
+    evtwatch = EventWatcher(["ERROR"])
+    time.sleep(10)
+    VitalFlusher.SetPeriod(0.5)
+
+    class Session(object):
+        failures = VStatError("failures", "Requests failed")
+
+        def __init__(self, session_id):
+            self.vital_label = "session-" + str(session_id)
+
+    sessions = [Session(i) for i in range(1000)]
+    sessions[1].failures += 1
+    sessions[2].failures += 5
+    sessions[2].failures += 1
+    assert(sessions[0].failures == 0)
+    assert(sessions[2].failures == 6)
+    assert(Session.failures.instances.find(sessions[0]) is None)
+    time.sleep(1)
+
+    events = dict([(event['instance'], event) for event in evtwatch.events])
+    assert(sorted(events.keys()) == ["session-1", "session-2"])
+    assert(events["session-2"]['value'] == 6)
+    assert(events["session-2"]['updates'] == 2)
+    assert(events["session-2"]['name'] == "failures/session-2")
+
+    # A collected instance sends what it had pending, and its slot is
+    # reused.
+    slot = Session.failures.instances.find(sessions[1])
+    sessions[1].failures += 1
+    sessions[1] = None
+    gc.collect()
+    time.sleep(1)
+    assert(evtwatch.events[-1]['instance'] == "session-1")
+    assert(evtwatch.events[-1]['value'] == 2)
+    sessions[3].failures += 1
+    assert(Session.failures.instances.find(sessions[3]) == slot)
+    assert(len(Session.failures.values) == 2)
+
+    # Instances without weakref support are pinned; floats and values
+    # beyond a C long are kept as they are.
+    class SlottedSession(object):
+        __slots__ = ["vital_label"]
+        failures = VStatError("slotted_failures", "Requests failed")
+
+        def __init__(self, session_id):
+            self.vital_label = "slotted-" + str(session_id)
+
+    slotted = SlottedSession(1)
+    slotted.failures = 2 ** 70
+    assert(slotted.failures == 2 ** 70)
+    slotted.failures = 0.5
+    assert(slotted.failures == 0.5)
+    instances = SlottedSession.failures.instances
+    assert(id(slotted) in instances.pinned)
+    slot = instances.find(slotted)
+    slotted = None
+    gc.collect()
+    assert(instances.find(instances.pinned.values()[0]) == slot)
+    print "test5() PASSED"
+
+
+def test6():
+
+    # ZSocket stats, exported as STATS vitals with their rates
+    import zmq
+    import zsocket
+    evtwatch = EventWatcher(["STATS"])
+    time.sleep(10)
+    VitalFlusher.SetPeriod(0.25)
+    StatsExporter.period = 1
+    VitalFlusher.Start()
+
+    server = zsocket.ZSocketServer(zmq.PULL, "tcp", "127.0.0.1",
+                                   "VITALTEST", [9400, 9500])
+    server.bind()
+    client = zsocket.ZSocketClient(zmq.PUSH, "tcp", "127.0.0.1",
+                                   "VITALTEST", server.port)
+    client.connect()
+    for i in range(2):
+        for j in range(50):
+            client.send({'message':["hello"]})
+            server.recv()
+        time.sleep(1.5)
+    time.sleep(1.5)
+
+    events = [event for event in evtwatch.events
+              if event['instance'] == server.stats_label()]
+    assert(events[0]['name'] == "zsocket/" + server.stats_label())
+    assert(events[-1]['stats']['rx_ok'] == 100)
+    assert(events[-1]['stats']['rx_bytes'] > 100)
+    assert('rx_err_short' not in events[-1]['stats'])
+    assert(max([event['stats']['rx_ok/s'] for event in events]) > 0)
+    # Idle sockets are only published until their rates drop to 0
+    assert(events[-1]['stats']['rx_ok/s'] == 0)
+    nr_events = len(events)
+    time.sleep(2)
+    assert(len([event for event in evtwatch.events
+                if event['instance'] == server.stats_label()]) == nr_events)
+    client.close()
+    server.close()
+    StatsExporter.period = 10.0
+    print "test6() PASSED"
 
 
 if __name__ == '__main__':
@@ -218,3 +1229,9 @@ if __name__ == '__main__':
 
     Llog.SetLevel("I")
     test1()
+    test2()
+    test3()
+    test4()
+    test5()
+    test6()
+    bench1()
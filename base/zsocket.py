@@ -24,6 +24,11 @@
     and the optional address.
     The recv function returns a dictionary with the message and address.
 
+    Framing can be disabled for sockets talking to peers which do not
+    speak the ZSocket framing (i.e. the Java EventSource).  Unframed
+    messages are received as a single string and sent as the message
+    pieces joined by spaces.
+
 """
 import zmq
 import types
@@ -33,6 +38,7 @@ import string
 import binascii
 import os
 import log
+import stats
 
 
 class ZSocket(log.Logger):
@@ -42,13 +48,27 @@ class ZSocket(log.Logger):
     """
     # Supported socket types
     socket_types = [zmq.PUB,
+                    zmq.XPUB,
                     zmq.SUB,
+                    zmq.XSUB,
                     zmq.ROUTER,
+                    zmq.DEALER,
                     zmq.PUSH,
                     zmq.PULL,
                     zmq.REQ,
                     zmq.REP,
                     zmq.PAIR]
+    socket_type_names = {zmq.PUB: "PUB",
+                         zmq.XPUB: "XPUB",
+                         zmq.SUB: "SUB",
+                         zmq.XSUB: "XSUB",
+                         zmq.ROUTER: "ROUTER",
+                         zmq.DEALER: "DEALER",
+                         zmq.PUSH: "PUSH",
+                         zmq.PULL: "PULL",
+                         zmq.REQ: "REQ",
+                         zmq.REP: "REP",
+                         zmq.PAIR: "PAIR"}
     # For inproc sockets, we must use the same context for
     # all servers and clients.  We create a single global context
     # for these.
@@ -58,6 +78,8 @@ class ZSocket(log.Logger):
         def __init__(self):
             self.rx_ok = 0
             self.tx_ok = 0
+            self.rx_bytes = 0
+            self.tx_bytes = 0
             self.rx_err_short = 0
             self.rx_err_bad_header = 0
             self.rx_err_bad_socket = 0
@@ -87,6 +109,7 @@ class ZSocket(log.Logger):
         self.signature = signature 
 
         self.socket = None
+        self.framing = True
         self.zmq_ctx = zmq.Context(1)
         self.location = ""
         self.port = 0
@@ -94,6 +117,14 @@ class ZSocket(log.Logger):
         if ZSocket.inproc_ctx is None:
             ZSocket.inproc_ctx = zmq.Context(1)
 
+        stats.StatsRegistry.Register("zsocket", self)
+
+    def stats_label(self):
+        # e.g. EVENT/PUB@tcp://127.0.0.1:7000
+        return self.signature + "/" \
+               + ZSocket.socket_type_names[self.socket_type] \
+               + "@" + self.location
+
     def __del__(self):
         self.close()
 
@@ -129,12 +160,21 @@ class ZSocket(log.Logger):
         if self.socket_type == zmq.ROUTER:
             self.set_identity(self.signature)
 
+        if self.socket_type == zmq.XPUB:
+            # Pass every subscribe and unsubscribe up to us, not just
+            # the first/last one for each topic, so we can track the
+            # number of live subscriptions.
+            self.socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+
     def subscribe(self, subscription):
         assert(self.socket is not None)
         assert(self.socket_type is zmq.SUB)
         self.log_debug("Subscribing to <" + subscription + ">")
         self.socket.setsockopt(zmq.SUBSCRIBE, subscription)
 
+    def set_framing(self, framing):
+        self.framing = framing
+
     def set_identity(self, identity):
         assert(self.socket is not None)
         self.log_debug("Setting identity to <" + str(identity) + ">")
@@ -194,10 +234,26 @@ class ZSocket(log.Logger):
             msg = {'message':msg_list, 'address':address}
         return msg
 
+    def __parse_subscription(self, msg_str):
+        # XPUB sockets receive the subscriptions of their peers:
+        # a 1 (subscribe) or 0 (unsubscribe) byte followed by the topic.
+        if len(msg_str) == 0 or msg_str[0] not in "\x00\x01":
+            self.log_debug("Invalid subscription message received!")
+            self.stats.rx_err_bad_header += 1
+            return None
+
+        self.stats.rx_ok += 1
+        if msg_str[0] == "\x01":
+            return {'message':["SUBSCRIBE", msg_str[1:]]}
+        return {'message':["UNSUBSCRIBE", msg_str[1:]]}
+
     def __construct_message(self, msg):
         assert(isinstance(msg, types.DictType))
         msg_lengths = []
         msg_list = msg['message']
+        if self.framing is False:
+            return " ".join([str(msg_element) for msg_element in msg_list])
+
         if 'address' in msg:
             address = msg['address']
         else:
@@ -222,10 +278,29 @@ class ZSocket(log.Logger):
 
         # For non-ROUTER sockets, just receive and process the
         # message
-        msg_str = self.socket.recv()
+        if self.socket_type == zmq.DEALER:
+            # DEALER messages carry the empty delimiter frame a ROUTER
+            # peer expects: ['', 'contents']
+            msg_list = self.socket.recv_multipart()
+            if len(msg_list) != 2:
+                self.log_info("Invalid message received! " + str(msg_list))
+                self.stats.rx_err_short += 1
+                return None
+            msg_str = msg_list[1]
+        else:
+            msg_str = self.socket.recv()
         if msg_str is None:
             return None
 
+        return self.__decode_message(msg_str)
+
+    def __decode_message(self, msg_str):
+        self.stats.rx_bytes += len(msg_str)
+        if self.socket_type == zmq.XPUB:
+            return self.__parse_subscription(msg_str)
+        if self.framing is False:
+            self.stats.rx_ok += 1
+            return {'message':[msg_str]}
         return self.__parse_message(msg_str)
 
     def __recv_multipart(self):
@@ -246,6 +321,7 @@ class ZSocket(log.Logger):
 
         address = msg_list[0]
         msg_str = msg_list[2]
+        self.stats.rx_bytes += len(msg_str)
         msg = self.__parse_message(msg_str)
         if msg is not None:
             # For ROUTER sockets, the address is sent OOB within ZMQ
@@ -273,19 +349,65 @@ class ZSocket(log.Logger):
         self.log_debug("Received: " + str(msg))
         return msg
 
+    def recv_batch(self, max_msgs):
+        # Drain up to max_msgs messages which are already queued on
+        # the socket, without blocking.  Used by receivers which want
+        # to amortize their per-message overhead across a batch.
+        assert(self.socket is not None)
+        assert(self.socket_type not in [zmq.ROUTER, zmq.DEALER])
+
+        msgs = []
+        while len(msgs) < max_msgs:
+            try:
+                msg_str = self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            except KeyboardInterrupt:
+                self.log_debug("Ctrl-c detected!")
+                raise KeyboardInterrupt
+            except:
+                self.log_error("Failed to receive message!")
+                self.stats.rx_err_bad_socket += 1
+                break
+
+            msg = self.__decode_message(msg_str)
+            if msg is not None:
+                msgs.append(msg)
+        return msgs
+
+    def recv_raw(self, flags=0):
+        # Receive a message as-is, without any de-framing.  Used by
+        # forwarders which pass messages through untouched.
+        assert(self.socket is not None)
+        msg_str = self.socket.recv(flags)
+        self.stats.rx_ok += 1
+        self.stats.rx_bytes += len(msg_str)
+        return msg_str
+
+    def send_raw(self, msg_str, flags=0):
+        assert(self.socket is not None)
+        self.socket.send(msg_str, flags)
+        self.stats.tx_ok += 1
+        self.stats.tx_bytes += len(msg_str)
+
     def __send_multipart(self, address, msg):
         assert(self.socket is not None)
         assert(self.socket_type == zmq.ROUTER)
         self.log_debug("Sending to " + address + " <" + msg + ">")
         self.socket.send_multipart([address, '', msg])
         self.stats.tx_ok += 1
+        self.stats.tx_bytes += len(msg)
 
     def __send(self, msg):
         assert(self.socket_type != zmq.ROUTER)
         assert(isinstance(msg, types.StringType))
         self.log_debug("Sending... <" + msg + ">")
-        self.socket.send(msg)
+        if self.socket_type == zmq.DEALER:
+            self.socket.send_multipart(['', msg])
+        else:
+            self.socket.send(msg)
         self.stats.tx_ok += 1
+        self.stats.tx_bytes += len(msg)
 
     def send(self, msg):
         assert(self.socket is not None)
@@ -412,12 +534,47 @@ class ZSocketClient(ZSocket):
             self.subscribe(self.signature)
 
 
+class ZSocketMultiClient(ZSocket):
+
+    """
+        Client socket connected to any number of servers at once,
+        e.g. an XSUB socket gathering the events of many PUB servers.
+    """
+
+    def __init__(self, socket_type, protocol_name, signature):
+        assert(protocol_name in ["tcp", "ipc", "inproc"])
+        ZSocket.__init__(self, socket_type, signature)
+        self.protocol_name = protocol_name
+        self.locations = []
+
+    def open(self):
+        self.create_socket()
+
+    def connect(self, location):
+        assert(self.socket is not None)
+        assert(location not in self.locations)
+        self.log_debug("Connecting to " + location)
+        self.socket.connect(location)
+        self.locations.append(location)
+
+    def disconnect(self, location):
+        assert(self.socket is not None)
+        if location not in self.locations:
+            return
+        self.log_debug("Disconnecting from " + location)
+        self.socket.disconnect(location)
+        self.locations.remove(location)
+
+
 def zpipe():
     addr = "zpipe-%s" % binascii.hexlify(os.urandom(8))
     c = ZSocketClient(zmq.PAIR, "inproc", addr, "zpipe")
     s = ZSocketServer(zmq.PAIR, "inproc", addr, "zpipe")
     s.bind()
     c.connect()
+    # Internal to an Interface, which reports its own queue depth
+    stats.StatsRegistry.Unregister(c)
+    stats.StatsRegistry.Unregister(s)
     return [c,s]
 
 